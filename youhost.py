@@ -10,8 +10,24 @@ import signal
 import sys
 import pickle
 import re
+import itertools
+import random
+import io
+import base64
+import hashlib
+import hmac
+import socket
+import ssl
+from collections import deque
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+import codecs
+from contextlib import asynccontextmanager
 from datetime import datetime
-from aiogram import Bot, Dispatcher, types
+from aiogram import BaseMiddleware, Bot, Dispatcher, types
+from aiogram.exceptions import TelegramUnauthorizedError
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, FSInputFile
 from aiogram.fsm.context import FSMContext
@@ -29,8 +45,216 @@ logger = logging.getLogger(__name__)
 # Токен бота
 BOT_TOKEN = "5002126853:AAFK0H5Z8sQbmgDfi7hGlWvHrc8DktOydjQ/test"  # Замените на реальный токен
 
-# Максимальное количество одновременно запущенных ботов
-MAX_CONCURRENT_BOTS = 8
+# Максимальное количество одновременно запущенных ботов (верхняя граница, фактически запуск решает контроль нагрузки)
+MAX_CONCURRENT_BOTS = 64
+
+# Максимальное количество одновременно запущенных ботов одного пользователя
+MAX_BOTS_PER_USER = 3
+
+# Контроль запуска по нагрузке: сколько памяти хоста (МБ) всегда оставлять свободной
+# и какая средняя нагрузка (loadavg за минуту на одно ядро) ещё допускает новый запуск
+ADMISSION_MEMORY_RESERVE_MB = 512
+ADMISSION_MAX_LOAD_PER_CPU = 1.5
+
+# Сколько памяти (МБ) закладывать на проект, потребление которого ещё ни разу не замерялось
+ADMISSION_DEFAULT_FOOTPRINT_MB = 64
+
+# Сколько секунд учитывать прогноз памяти только что запущенного проекта, пока он не отразится в MemAvailable
+ADMISSION_WARMUP = 30
+
+# Как часто (секунды) повторять запуск из очереди, если проекты ждут ресурсов, а не слотов
+ADMISSION_RETRY_INTERVAL = 10
+
+# Восстановление проектов после перезапуска хоста: сколько проектов одновременно проходят запуск,
+# пауза между запусками (секунды) и сколько секунд проект должен проработать, чтобы считаться восстановленным
+RESTORE_CONCURRENCY = 8
+RESTORE_STAGGER = 0.2
+RESTORE_STARTUP_GRACE = 3
+
+# Сколько секунд процесс получает на завершение после SIGTERM, прежде чем получить SIGKILL
+STOP_GRACE_PERIOD = 5
+
+# Сколько секунд снимок /proc годится для всех одновременно останавливаемых проектов
+PROCESS_SCAN_MAX_AGE = 0.1
+
+# Отсоединённые процессы: боты пишут вывод в файлы и продолжают работать при перезапуске хоста,
+# а следующий запуск хоста подхватывает их по PID и времени старта (только Linux)
+DETACH_PROJECTS = True
+
+# Как часто (секунды) дочитывать файлы вывода отсоединённых проектов
+OUTPUT_TAIL_INTERVAL = 0.5
+
+# Размер файла вывода, после которого полностью прочитанный файл обнуляется
+PROJECT_OUTPUT_MAX_SIZE = 10 * 1024 * 1024
+
+# Ограничения ресурсов проекта по умолчанию (None — без ограничения), переопределяются командой /limits:
+# memory_mb — память (memory.max), cpu_weight — доля CPU (cpu.weight, 100 — обычная), processes — процессы и потоки (pids.max):
+# эти три применяются только через cgroup v2, без неё не действуют;
+# cpu_seconds — процессорное время (RLIMIT_CPU), open_files — открытые файлы (RLIMIT_NOFILE)
+PROJECT_LIMITS = {
+    'memory_mb': 512,
+    'cpu_seconds': None,
+    'cpu_weight': 100,
+    'open_files': 1024,
+    'processes': 128,
+}
+
+# Проверки зависания проекта по умолчанию (None — проверка выключена), переопределяются командой /watchdog:
+# silence_minutes — нет вывода дольше N минут, idle_minutes — процесс не расходует CPU дольше N минут,
+# heartbeat_file — файл в папке проекта, который бот регулярно обновляет, heartbeat_minutes — допустимый возраст файла,
+# probe — проверять токен бота через getMe и то, что бот забирает обновления (getWebhookInfo)
+PROJECT_WATCHDOG = {
+    'silence_minutes': None,
+    'idle_minutes': None,
+    'heartbeat_file': None,
+    'heartbeat_minutes': 5,
+    'probe': False,
+}
+
+# Как часто (секунды) проверять запущенные проекты на зависание
+WATCHDOG_INTERVAL = 30
+
+# Сколько проверок подряд должно провалиться, чтобы проект был признан зависшим и перезапущен
+WATCHDOG_FAILURES = 2
+
+# Интервал (секунды) замеров CPU и памяти проектов и сколько последних замеров хранить
+SAMPLER_INTERVAL = 5
+SAMPLER_HISTORY_SIZE = 120
+
+# Родительская cgroup v2, внутри которой создаются cgroup проектов (используется, если доступна на запись)
+CGROUP_ROOT = '/sys/fs/cgroup/youhost'
+
+# Задержка перед авто-рестартом: начальная и максимальная (секунды), растёт вдвое после каждого падения
+RESTART_BACKOFF_BASE = 5
+RESTART_BACKOFF_MAX = 300
+
+# Сколько секунд проект должен проработать, чтобы счётчик падений сбросился
+RESTART_HEALTHY_UPTIME = 10 * 60
+
+# Сколько падений за окно (секунды) считается циклом падений: проект останавливается до ручного запуска
+CRASH_LOOP_MAX_FAILURES = 5
+CRASH_LOOP_WINDOW = 10 * 60
+
+# Сколько последних завершений проекта хранить и показывать в меню
+RESTART_HISTORY_SIZE = 5
+
+# Приоритеты очереди запуска (меньше — раньше)
+PRIORITY_USER = 0
+PRIORITY_RESTART = 1
+PRIORITY_RESTORE = 2
+
+# Размер пула соединений с базой данных
+DB_POOL_SIZE = 4
+
+# Размер кэша подготовленных выражений на одно соединение
+DB_CACHED_STATEMENTS = 256
+
+# PRAGMA, применяемые к каждому соединению пула
+DB_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA foreign_keys = ON",
+)
+
+# Максимальный размер журнала одного проекта (в символах), старые строки удаляются
+PROJECT_LOG_MAX_SIZE = 64000
+
+# Интервал (секунды) и размер пачки (строки) для записи логов в БД
+LOG_FLUSH_INTERVAL = 0.5
+LOG_FLUSH_MAX_LINES = 500
+
+# Сколько строк одного проекта может ждать записи, прежде чем новые начнут отбрасываться
+LOG_BUFFER_MAX_LINES = 5000
+
+# Сколько секунд вывод проекта ждёт записи буфера при переполнении
+LOG_BACKPRESSURE_TIMEOUT = 1.0
+
+# Сколько последних строк журнала читать для показа логов
+PROJECT_LOG_TAIL_LINES = 500
+
+# Размер порции чтения вывода процесса и максимальная длина одной строки лога
+PROCESS_OUTPUT_CHUNK_SIZE = 64 * 1024
+PROCESS_OUTPUT_MAX_LINE = 4000
+
+# Сколько секунд кэшировать статистику для админ-панели
+STATS_CACHE_TTL = 30
+
+# Сколько пользователей показывать на одной странице админских списков
+ADMIN_PAGE_SIZE = 20
+
+# Максимальная длина сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Как часто (секунды) сохранять в БД накопленную активность пользователей
+ACTIVITY_FLUSH_INTERVAL = 10
+
+# Полная проверка целостности БД (PRAGMA integrity_check) при запуске вместо быстрой quick_check
+DB_FULL_CHECK_ON_STARTUP = False
+
+# Интервал фоновой полной проверки целостности БД в секундах (0 — не проверять)
+DB_FULL_CHECK_INTERVAL = 7 * 24 * 60 * 60
+
+# Сколько строк журнала может ждать отправки одному подписчику потока логов, лишние отбрасываются
+LOG_STREAM_QUEUE_SIZE = 1000
+
+# Максимальный размер одного сообщения RPC супервизора в байтах
+SUPERVISOR_RPC_LIMIT = 16 * 1024 * 1024
+
+# Адрес (хост, порт), на котором хост принимает рабочих агентов, например ('0.0.0.0', 8765); None — без агентов
+CLUSTER_LISTEN = None
+
+# Общий секрет, которым рабочие агенты подтверждают регистрацию; с пустым или значением по умолчанию кластер не запускается
+CLUSTER_TOKEN = 'change-me'
+
+# TLS для соединений с агентами: сертификат и ключ управляющего хоста и CA, которым агенты проверяют его сертификат.
+# Без TLS токен и архивы с кодом ботов (вместе с их токенами) идут по сети открытым текстом — только для доверенной сети
+CLUSTER_TLS_CERT = None
+CLUSTER_TLS_KEY = None
+CLUSTER_TLS_CA = None
+
+# Запускать ли проекты на самом управляющем хосте наравне с агентами
+CLUSTER_RUN_LOCAL = True
+
+# Имя, под которым управляющий хост значится среди узлов
+LOCAL_NODE = 'local'
+
+# Как часто (секунды) агент присылает отчёт о ресурсах и запущенных проектах
+AGENT_REPORT_INTERVAL = 5
+
+# Таймауты запросов к агенту (секунды): обычного и развёртывания с установкой зависимостей
+AGENT_RPC_TIMEOUT = 30
+AGENT_DEPLOY_TIMEOUT = 600
+
+# Пауза (секунды) перед повторным подключением агента к управляющему хосту
+AGENT_RECONNECT_DELAY = 5
+
+# Запускать проекты форком заранее прогретого интерпретатора вместо нового python (Linux, отсоединённые процессы)
+FORKSERVER_ENABLED = False
+
+# Сколько прогретых интерпретаторов держать одновременно: у каждого окружения проекта свой, давно не использованные останавливаются
+FORKSERVER_MAX_SERVERS = 16
+
+# Отдельное виртуальное окружение (без системных site-packages) для каждого проекта: библиотеки пользователей
+# не попадают в окружение хоста и не конфликтуют между проектами
+PROJECT_VENVS = True
+
+# Имя папки окружения внутри папки проекта
+PROJECT_VENV_DIR = '.venv'
+
+# Пакеты, которые ставятся в каждое новое окружение: без них не запустятся боты, привыкшие к библиотекам хоста
+PROJECT_VENV_PACKAGES = ('aiogram',)
+
+# Создавать окружения и ставить пакеты через uv, если он установлен: он раскладывает пакеты из общего кэша жёсткими ссылками
+PROJECT_VENV_USE_UV = True
+
+# Модули, которые прогретый интерпретатор импортирует заранее; отсутствующие пропускаются
+FORKSERVER_PRELOAD = ('asyncio', 'ssl', 'json', 'sqlite3', 'aiohttp', 'aiogram', 'requests', 'telebot', 'telegram')
+
+# Строка в начале скрипта, при которой проект всегда запускается отдельным интерпретатором
+FORKSERVER_OPT_OUT_MARKER = '# youhost: exec'
 
 # Список админов (ID пользователей, которые имеют доступ к админ-панели)
 ADMIN_IDS = [5000282571, 123456789]  # Добавьте сюда ID админов
@@ -41,11 +265,22 @@ storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
 # Пути к директориям
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# YOUHOST_HOME позволяет держать данные отдельно от кода, например для нескольких агентов на одной машине
+BASE_DIR = os.environ.get('YOUHOST_HOME') or os.path.dirname(os.path.abspath(__file__))
 DB_DIR = os.path.join(BASE_DIR, 'data')
 PROJECTS_DIR = os.path.join(BASE_DIR, 'projects')
 TEMP_DIR = os.path.join(BASE_DIR, 'temp')
 STATE_FILE = os.path.join(DB_DIR, 'bot_state.pkl')
+OUTPUT_DIR = os.path.join(DB_DIR, 'output')
+SUPERVISOR_SOCKET = os.path.join(DB_DIR, 'supervisor.sock')
+DEPLOYMENTS_FILE = os.path.join(DB_DIR, 'deployments.json')
+# Сокет прогретого интерпретатора; в имя подставляется хэш пути к интерпретатору окружения
+FORKSERVER_SOCKET = os.path.join(DB_DIR, 'forkserver-{}.sock')
+# Общий кэш pip/uv для окружений всех проектов
+PACKAGE_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'packages')
+# Шаблонное окружение с PROJECT_VENV_PACKAGES: окружения проектов собираются из жёстких ссылок на его файлы.
+# К имени добавляется хэш интерпретатора и списка пакетов; чтобы обновить пакеты, шаблон достаточно удалить
+VENV_TEMPLATE_DIR = os.path.join(BASE_DIR, 'cache', 'venv-template')
 DB_PATH = os.path.join(DB_DIR, 'bot_database.db')
 
 # Определяем состояния FSM
@@ -61,8 +296,83 @@ class AdminStates(StatesGroup):
     waiting_for_bot_source = State()
 
 # Глобальные переменные
-running_count = 0
 active_processes = {}  # Stores subprocess objects
+stats_cache = {'time': 0.0, 'data': None}  # Кэш статистики для админ-панели
+db_ready = False  # База данных проверена и схема актуальна
+
+# Пул долгоживущих соединений с базой данных
+class DatabasePool:
+    """Держит несколько открытых соединений aiosqlite и раздаёт их хелперам"""
+
+    def __init__(self, db_path: str, size: int = DB_POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self._connections = []
+        self._queue = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return bool(self._connections)
+
+    async def _connect(self):
+        db = await aiosqlite.connect(self.db_path, timeout=30, cached_statements=DB_CACHED_STATEMENTS)
+        for pragma in DB_PRAGMAS:
+            await db.execute(pragma)
+        return db
+
+    async def open(self):
+        """Открывает соединения пула (повторный вызов ничего не делает)"""
+        async with self._lock:
+            if self._connections:
+                return
+            queue = asyncio.Queue()
+            try:
+                for _ in range(self.size):
+                    db = await self._connect()
+                    self._connections.append(db)
+                    queue.put_nowait(db)
+            except Exception:
+                for db in self._connections:
+                    await db.close()
+                self._connections = []
+                raise
+            self._queue = queue
+            logger.info(f"✅ Пул соединений с БД открыт: {self.size} соединений (WAL)")
+
+    async def close(self):
+        """Закрывает все соединения пула"""
+        async with self._lock:
+            connections, self._connections = self._connections, []
+            self._queue = None
+            for db in connections:
+                try:
+                    await db.close()
+                except Exception as e:
+                    logger.error(f"Ошибка закрытия соединения с БД: {e}")
+            if connections:
+                logger.info("✅ Пул соединений с БД закрыт")
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Выдаёт соединение из пула и возвращает его обратно после использования"""
+        if not self._connections:
+            await self.open()
+        queue = self._queue
+        db = await queue.get()
+        try:
+            yield db
+        finally:
+            # Незакоммиченная транзакция не должна достаться следующему хелперу
+            if db.in_transaction:
+                try:
+                    await db.rollback()
+                except Exception as e:
+                    logger.error(f"Ошибка отката транзакции: {e}")
+            if db in self._connections:
+                queue.put_nowait(db)
+
+db_pool = DatabasePool(DB_PATH)
 
 # Функция для проверки прав админа
 def is_admin(user_id: int) -> bool:
@@ -74,7 +384,9 @@ def create_necessary_directories():
     directories = [
         DB_DIR,
         PROJECTS_DIR,
-        TEMP_DIR
+        TEMP_DIR,
+        OUTPUT_DIR,
+        PACKAGE_CACHE_DIR
     ]
     
     for directory in directories:
@@ -88,14 +400,20 @@ def create_necessary_directories():
 # Функции для сохранения и восстановления состояния
 def save_bot_state():
     """Сохраняет состояние бота в файл"""
+    if process_control.remote:
+        # Файлом состояния владеет процесс супервизора
+        return
     try:
         state_data = {
-            'running_count': running_count,
             'active_processes_info': {
                 project_id: {
                     'user_id': process_info.get('user_id'),
                     'project_name': process_info.get('project_name'),
-                    'start_time': process_info.get('start_time')
+                    'start_time': process_info.get('start_time'),
+                    # Для отсоединённых процессов: чем опознать процесс и откуда дочитывать его вывод
+                    'pid': process_info['process'].pid,
+                    'start_token': getattr(process_info['process'], 'start_token', None),
+                    'output_offsets': getattr(process_info['process'], 'output_offsets', None)
                 }
                 for project_id, process_info in active_processes.items()
             }
@@ -108,24 +426,23 @@ def save_bot_state():
     except Exception as e:
         logger.error(f"❌ Ошибка сохранения состояния бота: {e}")
 
-def load_bot_state():
-    """Загружает состояние бота из файла"""
-    global running_count
-    
+def load_bot_state() -> dict:
+    """Загружает состояние бота из файла, возвращает сохранённые процессы по project_id"""
     if not os.path.exists(STATE_FILE):
         logger.info("Файл состояния не найден, начинаем с чистого состояния")
-        return
+        return {}
     
     try:
         with open(STATE_FILE, 'rb') as f:
             state_data = pickle.load(f)
         
-        running_count = state_data.get('running_count', 0)
-        logger.info(f"✅ Состояние бота загружено. running_count: {running_count}")
+        saved_processes = state_data.get('active_processes_info', {})
+        logger.info(f"✅ Состояние бота загружено. Процессов в сохранённом состоянии: {len(saved_processes)}")
+        return saved_processes
         
     except Exception as e:
         logger.error(f"❌ Ошибка загрузки состояния бота: {e}")
-        running_count = 0
+        return {}
 
 def cleanup_state_file():
     """Очищает файл состояния при корректном завершении"""
@@ -136,6 +453,128 @@ def cleanup_state_file():
         except Exception as e:
             logger.error(f"❌ Ошибка очистки файла состояния: {e}")
 
+# Миграции схемы базы данных
+async def migration_initial_schema(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS projects (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            name TEXT NOT NULL,
+            safe_name TEXT NOT NULL,
+            created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            file_path TEXT,
+            process_id INTEGER,
+            requirements TEXT DEFAULT '[]',
+            is_running BOOLEAN DEFAULT FALSE,
+            auto_restart BOOLEAN DEFAULT FALSE,
+            bot_username TEXT DEFAULT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE,
+            UNIQUE(user_id, name)
+        )
+    ''')
+
+async def migration_project_logs(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS project_logs (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            project_id INTEGER NOT NULL,
+            created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            line TEXT NOT NULL,
+            FOREIGN KEY (project_id) REFERENCES projects (id) ON DELETE CASCADE
+        )
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_project_logs_project ON project_logs (project_id, seq)')
+    await migrate_legacy_logs_column(db)
+
+async def migration_hot_query_indexes(db):
+    # Частичный индекс: запущенных проектов мало, а ищут именно их
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_projects_running ON projects (user_id) WHERE is_running = 1')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_projects_file_path ON projects (file_path)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active)')
+
+async def migration_project_limits(db):
+    # JSON с переопределениями PROJECT_LIMITS для проекта, NULL — лимиты по умолчанию
+    await db.execute('ALTER TABLE projects ADD COLUMN limits TEXT DEFAULT NULL')
+
+async def migration_project_node(db):
+    # Узел кластера, на котором размещён проект; NULL — ещё не размещался и запускается здесь
+    await db.execute('ALTER TABLE projects ADD COLUMN node TEXT DEFAULT NULL')
+
+async def migration_project_watchdog(db):
+    # JSON с переопределениями PROJECT_WATCHDOG для проекта, NULL — проверки по умолчанию
+    await db.execute('ALTER TABLE projects ADD COLUMN watchdog TEXT DEFAULT NULL')
+
+async def migrate_legacy_logs_column(db):
+    """Переносит логи из устаревшей колонки projects.logs в таблицу project_logs"""
+    cursor = await db.execute("PRAGMA table_info(projects)")
+    columns = {row[1] for row in await cursor.fetchall()}
+    if 'logs' not in columns:
+        return
+    cursor = await db.execute("SELECT id, logs FROM projects WHERE logs IS NOT NULL AND logs != ''")
+    rows = await cursor.fetchall()
+    for project_id, logs in rows:
+        await db.executemany(
+            'INSERT INTO project_logs (project_id, line) VALUES (?, ?)',
+            [(project_id, line) for line in logs.splitlines() if line.strip()]
+        )
+    await db.execute('ALTER TABLE projects DROP COLUMN logs')
+    logger.info(f"✅ Логи {len(rows)} проектов перенесены в таблицу project_logs")
+
+# Список миграций: (версия, описание, функция). Новые миграции добавляются только в конец
+MIGRATIONS = [
+    (1, "Таблицы users и projects", migration_initial_schema),
+    (2, "Таблица project_logs вместо колонки projects.logs", migration_project_logs),
+    (3, "Индексы для запущенных проектов, file_path и last_active", migration_hot_query_indexes),
+    (4, "Колонка projects.limits с лимитами ресурсов проекта", migration_project_limits),
+    (5, "Колонка projects.node с узлом кластера проекта", migration_project_node),
+    (6, "Колонка projects.watchdog с проверками зависания проекта", migration_project_watchdog),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+async def get_schema_version(db) -> int:
+    # Курсоры закрываются сразу, чтобы не держать открытую читающую транзакцию
+    async with db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='schema_version'") as cursor:
+        if not await cursor.fetchone():
+            return 0
+    async with db.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version') as cursor:
+        return (await cursor.fetchone())[0]
+
+async def run_migrations(db):
+    """Применяет к базе данных все ещё не применённые миграции, каждую в своей транзакции"""
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    current_version = await get_schema_version(db)
+    for version, description, migration in MIGRATIONS:
+        if version <= current_version:
+            continue
+        logger.info(f"Применяем миграцию {version}: {description}")
+        await db.execute('BEGIN')
+        try:
+            await migration(db)
+            await db.execute(
+                'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                (version, description)
+            )
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        logger.info(f"✅ Миграция {version} применена")
+
 # Инициализация базы данных
 async def init_db():
     logger.info(f"Инициализация базы данных: {DB_PATH}")
@@ -145,33 +584,7 @@ async def init_db():
         
         async with aiosqlite.connect(DB_PATH) as db:
             await db.execute("PRAGMA foreign_keys = ON")
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS projects (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    name TEXT NOT NULL,
-                    safe_name TEXT NOT NULL,
-                    created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    file_path TEXT,
-                    process_id INTEGER,
-                    requirements TEXT DEFAULT '[]',
-                    is_running BOOLEAN DEFAULT FALSE,
-                    logs TEXT DEFAULT '',
-                    auto_restart BOOLEAN DEFAULT FALSE,
-                    bot_username TEXT DEFAULT NULL,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE,
-                    UNIQUE(user_id, name)
-                )
-            ''')
-            await db.commit()
+            await run_migrations(db)
             logger.info("✅ База данных инициализирована успешно")
         
         # Устанавливаем правильные права доступа (только для Unix-систем)
@@ -183,9 +596,25 @@ async def init_db():
         logger.error(f"❌ Ошибка инициализации базы данных: {e}")
         raise
 
-async def check_and_create_tables():
+async def recreate_database():
+    """Удаляет файл базы данных и создаёт его заново, переоткрывая пул соединений"""
+    pool_was_open = db_pool.is_open
+    await db_pool.close()
+    for path in (DB_PATH, DB_PATH + '-wal', DB_PATH + '-shm'):
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+            except Exception as remove_error:
+                logger.error(f"Ошибка удаления старой БД: {remove_error}")
+    await init_db()
+    project_registry.invalidate()
+    if pool_was_open:
+        await db_pool.open()
+
+async def check_and_create_tables(full_check: bool = DB_FULL_CHECK_ON_STARTUP):
     """Проверяет и создает таблицы с улучшенной обработкой ошибок"""
     logger.info("Проверка существования таблиц")
+    check_pragma = "PRAGMA integrity_check" if full_check else "PRAGMA quick_check"
     max_retries = 5
     for attempt in range(1, max_retries + 1):
         try:
@@ -194,37 +623,27 @@ async def check_and_create_tables():
             
             async with aiosqlite.connect(DB_PATH, timeout=30) as db:
                 # Проверяем целостность базы данных
-                cursor = await db.execute("PRAGMA integrity_check")
-                result = await cursor.fetchone()
+                async with db.execute(check_pragma) as cursor:
+                    result = await cursor.fetchone()
                 if result and result[0] != "ok":
                     logger.warning(f"База данных повреждена на попытке {attempt}, пересоздаём")
                     await db.close()
-                    if os.path.exists(DB_PATH):
-                        os.remove(DB_PATH)
-                    await init_db()
+                    await recreate_database()
                     return
                 
-                # Проверяем существование таблиц
-                cursor = await db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name IN ('users', 'projects')")
-                tables = {row[0] async for row in cursor}
-                
-                if 'users' not in tables or 'projects' not in tables:
-                    logger.warning(f"Не все таблицы найдены на попытке {attempt}, инициализируем")
+                # Проверяем версию схемы и догоняем её миграциями
+                if await get_schema_version(db) < SCHEMA_VERSION:
+                    logger.warning(f"Схема базы данных устарела на попытке {attempt}, применяем миграции")
                     await init_db()
                 else:
-                    logger.info("✅ Все таблицы существуют")
+                    logger.info(f"✅ Схема базы данных актуальна (версия {SCHEMA_VERSION})")
                     return
                     
         except aiosqlite.OperationalError as e:
             logger.error(f"Ошибка базы данных на попытке {attempt}: {e}")
             if "unable to open database file" in str(e):
                 logger.info("Попытка пересоздать базу данных...")
-                if os.path.exists(DB_PATH):
-                    try:
-                        os.remove(DB_PATH)
-                    except Exception as remove_error:
-                        logger.error(f"Ошибка удаления старой БД: {remove_error}")
-                await init_db()
+                await recreate_database()
                 return
                 
             if attempt == max_retries:
@@ -238,12 +657,42 @@ async def check_and_create_tables():
                 raise
             await asyncio.sleep(2)
 
+async def ensure_db_ready():
+    """Проверяет базу данных только при первом обращении, дальше отвечает из памяти"""
+    global db_ready
+    if db_ready:
+        return
+    await check_and_create_tables()
+    db_ready = True
+
+async def periodic_integrity_check():
+    """Периодически выполняет полную проверку целостности БД и сообщает админам о проблемах"""
+    while True:
+        await asyncio.sleep(DB_FULL_CHECK_INTERVAL)
+        try:
+            async with db_pool.acquire() as db:
+                async with db.execute("PRAGMA integrity_check") as cursor:
+                    rows = await cursor.fetchall()
+            if rows and rows[0][0] == "ok":
+                logger.info("✅ Полная проверка целостности БД пройдена")
+                continue
+            details = "\n".join(row[0] for row in rows[:10])
+            logger.error(f"❌ Полная проверка целостности БД не пройдена:\n{details}")
+            for admin_id in ADMIN_IDS:
+                try:
+                    await bot.send_message(admin_id, f"❌ Проверка целостности базы данных не пройдена:\n{details}")
+                except Exception as e:
+                    logger.error(f"Не удалось уведомить админа {admin_id}: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка полной проверки целостности БД: {e}")
+
 # Функции для работы с пользователями
 async def add_user(user_id: int, username: str = None):
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.acquire() as db:
             await db.execute(
-                'INSERT OR REPLACE INTO users (user_id, username, last_active) VALUES (?, ?, ?)',
+                'INSERT INTO users (user_id, username, last_active) VALUES (?, ?, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, last_active = excluded.last_active',
                 (user_id, username, datetime.now())
             )
             await db.commit()
@@ -252,22 +701,69 @@ async def add_user(user_id: int, username: str = None):
         logger.error(f"Ошибка добавления пользователя {user_id}: {e}")
         raise
 
-async def update_user_activity(user_id: int):
-    try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                'UPDATE users SET last_active = ? WHERE user_id = ?',
-                (datetime.now(), user_id)
-            )
-            await db.commit()
-            logger.info(f"Активность пользователя {user_id} обновлена")
-    except Exception as e:
-        logger.error(f"Ошибка обновления активности пользователя {user_id}: {e}")
-        raise
+class UserActivityTracker:
+    """Копит отметки активности пользователей в памяти и сохраняет их одним UPDATE"""
+
+    def __init__(self):
+        self._dirty = {}  # user_id -> время последней активности
+        self._task = None
+
+    def touch(self, user_id: int):
+        self._dirty[user_id] = datetime.now()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Останавливает фоновое сохранение и записывает накопленные отметки"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        try:
+            async with db_pool.acquire() as db:
+                await db.executemany(
+                    'UPDATE users SET last_active = ? WHERE user_id = ?',
+                    [(last_active, user_id) for user_id, last_active in dirty.items()]
+                )
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Ошибка обновления активности {len(dirty)} пользователей: {e}")
+            # Не теряем отметки: более свежие значения из нового словаря важнее
+            self._dirty = {**dirty, **self._dirty}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+            await self.flush()
+
+activity_tracker = UserActivityTracker()
+
+class ActivityMiddleware(BaseMiddleware):
+    """Отмечает активность пользователя для каждого сообщения и нажатия кнопки"""
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user:
+            activity_tracker.touch(user.id)
+        return await handler(event, data)
+
+dp.message.outer_middleware(ActivityMiddleware())
+dp.callback_query.outer_middleware(ActivityMiddleware())
 
 async def get_all_users():
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.acquire() as db:
             cursor = await db.execute('SELECT user_id FROM users')
             rows = await cursor.fetchall()
             return [row[0] for row in rows]
@@ -275,41 +771,57 @@ async def get_all_users():
         logger.error(f"Ошибка получения списка пользователей: {e}")
         return []
 
-async def get_users_with_projects():
-    """Получает всех пользователей, у которых есть проекты"""
+async def get_users_with_projects_page(page: int):
+    """Страница пользователей с проектами и числом привязанных ботов, одним запросом"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.acquire() as db:
             cursor = await db.execute('''
-                SELECT DISTINCT u.user_id, u.username 
-                FROM users u 
+                SELECT u.user_id, u.username,
+                       SUM(p.file_path IS NOT NULL AND p.bot_username IS NOT NULL),
+                       COUNT(*) OVER ()
+                FROM users u
                 JOIN projects p ON u.user_id = p.user_id
-            ''')
+                GROUP BY u.user_id
+                ORDER BY u.user_id
+                LIMIT ? OFFSET ?
+            ''', (ADMIN_PAGE_SIZE, page * ADMIN_PAGE_SIZE))
             rows = await cursor.fetchall()
-            return [{'user_id': row[0], 'username': row[1]} for row in rows]
+            total = rows[0][3] if rows else 0
+            return [{'user_id': row[0], 'username': row[1], 'bot_count': row[2]} for row in rows], total
     except Exception as e:
         logger.error(f"Ошибка получения пользователей с проектами: {e}")
-        return []
+        return [], 0
 
-async def get_users_with_running_bots():
-    """Получает всех пользователей, у которых есть запущенные боты"""
-    try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute('''
-                SELECT DISTINCT u.user_id, u.username 
-                FROM users u 
-                JOIN projects p ON u.user_id = p.user_id 
-                WHERE p.is_running = 1
-            ''')
-            rows = await cursor.fetchall()
-            return [{'user_id': row[0], 'username': row[1]} for row in rows]
-    except Exception as e:
-        logger.error(f"Ошибка получения пользователей с запущенными ботами: {e}")
-        return []
+async def get_running_bots_page(page: int):
+    """Страница запущенных проектов, отсортированных по потреблению ресурсов, вместе с их владельцами"""
+    running = await process_control.running(page * ADMIN_PAGE_SIZE, ADMIN_PAGE_SIZE)
+    projects = []
+    for project_id, usage, health in running['projects']:
+        project = await get_project_by_id(project_id)
+        if project:
+            project['usage'] = usage
+            project['health'] = health
+            projects.append(project)
+    user_ids = sorted({project['user_id'] for project in projects})
+    usernames = {}
+    if user_ids:
+        try:
+            async with db_pool.acquire() as db:
+                cursor = await db.execute(
+                    f"SELECT user_id, username FROM users WHERE user_id IN ({', '.join('?' * len(user_ids))})",
+                    user_ids
+                )
+                usernames = dict(await cursor.fetchall())
+        except Exception as e:
+            logger.error(f"Ошибка получения владельцев запущенных ботов: {e}")
+    for project in projects:
+        project['username'] = usernames.get(project['user_id'])
+    return projects, running['total']
 
 async def get_user_projects_files(user_id: int):
     """Получает все файлы проектов пользователя"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.acquire() as db:
             cursor = await db.execute(
                 'SELECT name, file_path, bot_username FROM projects WHERE user_id = ? AND file_path IS NOT NULL',
                 (user_id,)
@@ -320,51 +832,322 @@ async def get_user_projects_files(user_id: int):
         logger.error(f"Ошибка получения файлов проектов пользователя {user_id}: {e}")
         return []
 
+# Кэш проектов в памяти
+class ProjectRegistry:
+    """Хранит записи проектов в памяти с индексами по id и по (user_id, name), синхронно с БД"""
+
+    # requirements в кэше не хранятся: их читает get_project_requirements только там, где они нужны
+    COLUMNS = 'id, user_id, name, safe_name, created, file_path, process_id, is_running, auto_restart, bot_username, node'
+
+    def __init__(self):
+        self._by_id = {}  # project_id -> запись проекта
+        self._by_name = {}  # (user_id, name) -> project_id
+        self._by_user = {}  # user_id -> {project_id: None} в порядке создания
+        self.loaded = False
+        # В раздельном режиме проекты в БД меняют и фронтенд, и супервизор: записи перечитываются при обращении
+        self.shared = False
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _normalize(key: str, value):
+        if key == 'created':
+            return datetime.fromisoformat(value) if isinstance(value, str) else value
+        if key in ('is_running', 'auto_restart'):
+            return bool(value)
+        return value
+
+    @classmethod
+    def _record_from_row(cls, row) -> dict:
+        keys = [column.strip() for column in cls.COLUMNS.split(',')]
+        return {key: cls._normalize(key, value) for key, value in zip(keys, row)}
+
+    def _snapshot(self, record: dict) -> dict:
+        project = dict(record)
+        project['process'] = active_processes.get(record['id'])
+        return project
+
+    async def load(self):
+        """Загружает все проекты из БД (прогрев кэша при запуске)"""
+        async with self._lock:
+            async with db_pool.acquire() as db:
+                cursor = await db.execute(f'SELECT {self.COLUMNS} FROM projects ORDER BY id')
+                rows = await cursor.fetchall()
+            self.clear()
+            for row in rows:
+                self.put(self._record_from_row(row))
+            self.loaded = True
+            logger.info(f"✅ Кэш проектов загружен: {len(rows)} проектов")
+
+    async def ensure_loaded(self):
+        if not self.loaded:
+            await self.load()
+
+    async def _select(self, where: str, params: tuple) -> list:
+        async with db_pool.acquire() as db:
+            cursor = await db.execute(f'SELECT {self.COLUMNS} FROM projects WHERE {where} ORDER BY id', params)
+            return await cursor.fetchall()
+
+    async def refresh_project(self, project_id: int):
+        """Перечитывает из БД запись одного проекта"""
+        rows = await self._select('id = ?', (project_id,))
+        if rows:
+            self.put(self._record_from_row(rows[0]))
+        else:
+            self.remove(project_id)
+
+    async def refresh_user(self, user_id: int):
+        """Перечитывает из БД все проекты пользователя"""
+        rows = await self._select('user_id = ?', (user_id,))
+        self.remove_user(user_id)
+        for row in rows:
+            self.put(self._record_from_row(row))
+
+    def clear(self):
+        self._by_id.clear()
+        self._by_name.clear()
+        self._by_user.clear()
+
+    def invalidate(self):
+        """Сбрасывает кэш, следующее обращение перечитает проекты из БД"""
+        self.clear()
+        self.loaded = False
+
+    def put(self, record: dict):
+        record = {key: self._normalize(key, value) for key, value in record.items()}
+        self._by_id[record['id']] = record
+        self._by_name[(record['user_id'], record['name'])] = record['id']
+        self._by_user.setdefault(record['user_id'], {})[record['id']] = None
+
+    def update(self, project_id: int, fields: dict):
+        record = self._by_id.get(project_id)
+        if not record:
+            return
+        for key, value in fields.items():
+            if key in record:
+                record[key] = self._normalize(key, value)
+
+    def remove(self, project_id: int):
+        record = self._by_id.pop(project_id, None)
+        if not record:
+            return
+        self._by_name.pop((record['user_id'], record['name']), None)
+        user_projects = self._by_user.get(record['user_id'], {})
+        user_projects.pop(project_id, None)
+        if not user_projects:
+            self._by_user.pop(record['user_id'], None)
+
+    def remove_user(self, user_id: int):
+        for project_id in list(self._by_user.get(user_id, {})):
+            self.remove(project_id)
+
+    def get(self, project_id: int):
+        record = self._by_id.get(project_id)
+        return self._snapshot(record) if record else None
+
+    def get_by_name(self, user_id: int, project_name: str):
+        project_id = self._by_name.get((user_id, project_name))
+        return self.get(project_id) if project_id is not None else None
+
+    def get_user_projects(self, user_id: int) -> list:
+        return [self._snapshot(self._by_id[project_id]) for project_id in self._by_user.get(user_id, {})]
+
+    def get_user_project_summaries(self, user_id: int) -> list:
+        """Только поля, нужные для кнопок главного меню"""
+        return [
+            {
+                'name': self._by_id[project_id]['name'],
+                'is_running': self._by_id[project_id]['is_running'],
+                'bot_username': self._by_id[project_id]['bot_username']
+            }
+            for project_id in self._by_user.get(user_id, {})
+        ]
+
+project_registry = ProjectRegistry()
+
+# Функции для статистики
+def get_directory_size(path: str, exclude=()) -> int:
+    """Считает суммарный размер файлов в директории, не заходя в поддиректории из exclude"""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [name for name in dirs if name not in exclude]
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def format_size(size: int) -> str:
+    for unit in ('Б', 'КБ', 'МБ', 'ГБ'):
+        if size < 1024 or unit == 'ГБ':
+            return f"{size:.0f} {unit}" if unit == 'Б' else f"{size:.1f} {unit}"
+        size /= 1024
+
+# Функция для форматирования замера потребления ресурсов проектом
+def format_usage(usage) -> str:
+    if not usage:
+        return "📈 Ресурсы: нет данных"
+    if usage['cpu'] is None:
+        cpu = "CPU: замеряется"
+    else:
+        cpu = f"CPU: {usage['cpu']:.1f}% (ср. {usage['cpu_avg']:.1f}%, пик {usage['cpu_peak']:.1f}%)"
+    return f"📈 {cpu}, RAM: {format_size(usage['rss'])} (пик {format_size(usage['rss_peak'])}), " \
+           f"потоков: {usage['threads']}, файлов: {usage['fds']}, процессов: {usage['processes']}"
+
+# Функция для форматирования состояния проверок зависания проекта
+def format_health(health) -> str:
+    if not health:
+        return ""
+    if health['state'] == 'ok':
+        return "🩺 Проверка зависания: ✅ в норме"
+    if health['state'] == 'suspect':
+        return f"🩺 Проверка зависания: ⚠️ {health['reason']} (проверка {health['failures']}/{WATCHDOG_FAILURES})"
+    return f"🩺 Проверка зависания: ⛔ завис — {health['reason']}"
+
+# Функция для форматирования свободных ресурсов хоста
+def format_host_capacity() -> str:
+    memory = admission.read_memory()
+    load = admission.read_load()
+    memory_text = f"доступно {format_size(memory[1])} из {format_size(memory[0])}" if memory else "нет данных"
+    load_text = f"{load:.2f}" if load is not None else "нет данных"
+    return f"🧮 Память хоста: {memory_text}, нагрузка на ядро: {load_text} (порог {ADMISSION_MAX_LOAD_PER_CPU})"
+
+async def get_host_statistics() -> dict:
+    """Считает статистику одним агрегирующим запросом, результат кэшируется на STATS_CACHE_TTL секунд"""
+    now = asyncio.get_running_loop().time()
+    if stats_cache['data'] and now - stats_cache['time'] < STATS_CACHE_TTL:
+        return stats_cache['data']
+    async with db_pool.acquire() as db:
+        cursor = await db.execute('''
+            WITH per_user AS (
+                SELECT COUNT(p.id) AS projects,
+                       COALESCE(SUM(p.is_running), 0) AS running,
+                       COALESCE(SUM(p.auto_restart), 0) AS auto_restart,
+                       COALESCE(SUM(p.bot_username IS NOT NULL AND p.bot_username != ''), 0) AS with_username,
+                       ROW_NUMBER() OVER (ORDER BY COUNT(p.id)) AS rank
+                FROM users u LEFT JOIN projects p ON p.user_id = u.user_id
+                GROUP BY u.user_id
+            ),
+            totals AS (SELECT COUNT(*) AS users FROM per_user)
+            SELECT totals.users,
+                   COALESCE(SUM(projects), 0),
+                   COALESCE(SUM(running), 0),
+                   COALESCE(SUM(auto_restart), 0),
+                   COALESCE(SUM(with_username), 0),
+                   COALESCE(MAX(CASE WHEN rank = (totals.users * 50 + 99) / 100 THEN projects END), 0),
+                   COALESCE(MAX(CASE WHEN rank = (totals.users * 90 + 99) / 100 THEN projects END), 0),
+                   COALESCE(MAX(CASE WHEN rank = (totals.users * 99 + 99) / 100 THEN projects END), 0),
+                   COALESCE(MAX(projects), 0)
+            FROM totals LEFT JOIN per_user
+        ''')
+        row = await cursor.fetchone()
+    # Окружения проектов — жёсткие ссылки на общий кэш пакетов, их размер не относится к коду проектов
+    projects_size = await asyncio.to_thread(get_directory_size, PROJECTS_DIR, (PROJECT_VENV_DIR,))
+    db_size = sum(os.path.getsize(path) for path in (DB_PATH, DB_PATH + '-wal') if os.path.exists(path))
+    data = {
+        'users': row[0],
+        'projects': row[1],
+        'running': row[2],
+        'auto_restart': row[3],
+        'with_username': row[4],
+        'projects_p50': row[5],
+        'projects_p90': row[6],
+        'projects_p99': row[7],
+        'projects_max': row[8],
+        'projects_size': projects_size,
+        'db_size': db_size
+    }
+    stats_cache['time'] = now
+    stats_cache['data'] = data
+    return data
+
 # Функции для работы с проектами
 async def add_project(user_id: int, project_name: str):
     safe_name = create_safe_directory_name(project_name)
+    created = datetime.now()
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
+        await project_registry.ensure_loaded()
+        async with db_pool.acquire() as db:
+            cursor = await db.execute(
                 'INSERT INTO projects (user_id, name, safe_name, created) VALUES (?, ?, ?, ?)',
-                (user_id, project_name, safe_name, datetime.now())
+                (user_id, project_name, safe_name, created)
             )
             await db.commit()
-            logger.info(f"Проект '{project_name}' для пользователя {user_id} создан")
+        project_registry.put({
+            'id': cursor.lastrowid,
+            'user_id': user_id,
+            'name': project_name,
+            'safe_name': safe_name,
+            'created': created,
+            'file_path': None,
+            'process_id': None,
+            'is_running': False,
+            'auto_restart': False,
+            'bot_username': None,
+            'node': None
+        })
+        logger.info(f"Проект '{project_name}' для пользователя {user_id} создан")
     except Exception as e:
         logger.error(f"Ошибка создания проекта '{project_name}': {e}")
         raise
 
 async def get_user_projects(user_id: int):
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute(
-                'SELECT id, name, safe_name, created, file_path, process_id, requirements, is_running, logs, auto_restart, bot_username FROM projects WHERE user_id = ?',
-                (user_id,)
-            )
-            rows = await cursor.fetchall()
-            projects = []
-            for row in rows:
-                project_data = {
-                    'id': row[0],
-                    'name': row[1],
-                    'safe_name': row[2],
-                    'created': datetime.fromisoformat(row[3]) if isinstance(row[3], str) else row[3],
-                    'file_path': row[4],
-                    'process_id': row[5],
-                    'requirements': json.loads(row[6]) if row[6] else [],
-                    'is_running': bool(row[7]),
-                    'logs': row[8] or '',
-                    'auto_restart': bool(row[9]),
-                    'bot_username': row[10],
-                    'process': active_processes.get(row[0])
-                }
-                projects.append(project_data)
-            return projects
+        await project_registry.ensure_loaded()
+        if project_registry.shared:
+            await project_registry.refresh_user(user_id)
+        return project_registry.get_user_projects(user_id)
+    except Exception as e:
+        logger.error(f"Ошибка получения проектов пользователя {user_id}: {e}")
+        return []
+
+async def get_user_project_summaries(user_id: int):
+    try:
+        await project_registry.ensure_loaded()
+        if project_registry.shared:
+            await project_registry.refresh_user(user_id)
+        return project_registry.get_user_project_summaries(user_id)
     except Exception as e:
         logger.error(f"Ошибка получения проектов пользователя {user_id}: {e}")
         return []
 
+async def get_project_requirements(project_id: int) -> list:
+    """Читает список зависимостей проекта отдельным узким запросом"""
+    try:
+        async with db_pool.acquire() as db:
+            cursor = await db.execute('SELECT requirements FROM projects WHERE id = ?', (project_id,))
+            row = await cursor.fetchone()
+        return json.loads(row[0]) if row and row[0] else []
+    except Exception as e:
+        logger.error(f"Ошибка получения зависимостей проекта {project_id}: {e}")
+        return []
+
+async def get_project_limits(project_id: int) -> dict:
+    """Возвращает лимиты ресурсов проекта: значения по умолчанию с переопределениями из БД"""
+    limits = dict(PROJECT_LIMITS)
+    try:
+        async with db_pool.acquire() as db:
+            cursor = await db.execute('SELECT limits FROM projects WHERE id = ?', (project_id,))
+            row = await cursor.fetchone()
+        if row and row[0]:
+            limits.update({key: value for key, value in json.loads(row[0]).items() if key in PROJECT_LIMITS})
+    except Exception as e:
+        logger.error(f"Ошибка получения лимитов проекта {project_id}: {e}")
+    return limits
+
+async def get_project_watchdog(project_id: int) -> dict:
+    """Возвращает проверки зависания проекта: значения по умолчанию с переопределениями из БД"""
+    checks = dict(PROJECT_WATCHDOG)
+    try:
+        async with db_pool.acquire() as db:
+            cursor = await db.execute('SELECT watchdog FROM projects WHERE id = ?', (project_id,))
+            row = await cursor.fetchone()
+        if row and row[0]:
+            checks.update({key: value for key, value in json.loads(row[0]).items() if key in PROJECT_WATCHDOG})
+    except Exception as e:
+        logger.error(f"Ошибка получения проверок зависания проекта {project_id}: {e}")
+    return checks
+
 async def update_project(project_id: int, **kwargs):
     if not kwargs:
         return
@@ -372,90 +1155,242 @@ async def update_project(project_id: int, **kwargs):
     values = list(kwargs.values())
     values.append(project_id)
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_pool.acquire() as db:
             await db.execute(f'UPDATE projects SET {set_clause} WHERE id = ?', values)
             await db.commit()
-            logger.info(f"Проект {project_id} обновлён")
+        project_registry.update(project_id, kwargs)
+        logger.info(f"Проект {project_id} обновлён")
     except Exception as e:
         logger.error(f"Ошибка обновления проекта {project_id}: {e}")
         raise
 
 async def delete_project(project_id: int):
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        await process_control.forget(project_id)
+        async with db_pool.acquire() as db:
             await db.execute('DELETE FROM projects WHERE id = ?', (project_id,))
             await db.commit()
-            logger.info(f"Проект {project_id} удалён")
-        if project_id in active_processes:
-            try:
-                process_info = active_processes[project_id]
-                if process_info and process_info['process'] and process_info['process'].poll() is None:
-                    if os.name == 'nt':  # Windows
-                        process_info['process'].terminate()
-                    else:  # Unix-like
-                        os.kill(process_info['process'].pid, signal.SIGTERM)
-                    process_info['process'].wait(timeout=5)
-            except Exception as e:
-                logger.error(f"Ошибка остановки процесса для проекта {project_id}: {e}")
-            del active_processes[project_id]
-        
-        # Сохраняем состояние после удаления
-        save_bot_state()
-        
+        project_registry.remove(project_id)
+        logger.info(f"Проект {project_id} удалён")
+        log_writer.discard(project_id)
     except Exception as e:
         logger.error(f"Ошибка удаления проекта {project_id}: {e}")
         raise
 
 async def get_project_by_name(user_id: int, project_name: str):
-    projects = await get_user_projects(user_id)
-    return next((p for p in projects if p['name'] == project_name), None)
+    try:
+        await project_registry.ensure_loaded()
+        if project_registry.shared:
+            await project_registry.refresh_user(user_id)
+        return project_registry.get_by_name(user_id, project_name)
+    except Exception as e:
+        logger.error(f"Ошибка получения проекта '{project_name}' пользователя {user_id}: {e}")
+        return None
 
 async def get_project_by_id(project_id: int):
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute(
-                'SELECT id, user_id, name, safe_name, created, file_path, process_id, requirements, is_running, logs, auto_restart, bot_username FROM projects WHERE id = ?',
-                (project_id,)
-            )
-            row = await cursor.fetchone()
-            if row:
-                return {
-                    'id': row[0],
-                    'user_id': row[1],
-                    'name': row[2],
-                    'safe_name': row[3],
-                    'created': datetime.fromisoformat(row[4]) if isinstance(row[4], str) else row[4],
-                    'file_path': row[5],
-                    'process_id': row[6],
-                    'requirements': json.loads(row[7]) if row[7] else [],
-                    'is_running': bool(row[8]),
-                    'logs': row[9] or '',
-                    'auto_restart': bool(row[10]),
-                    'bot_username': row[11],
-                    'process': active_processes.get(row[0])
-                }
-            return None
+        await project_registry.ensure_loaded()
+        if project_registry.shared:
+            await project_registry.refresh_project(project_id)
+        return project_registry.get(project_id)
     except Exception as e:
         logger.error(f"Ошибка получения проекта {project_id}: {e}")
         return None
 
-# Функция для извлечения токена бота из кода
-def extract_bot_token_from_code(file_path: str) -> str:
-    """Извлекает токен бота из Python файла"""
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # Паттерны для поиска токена
-        patterns = [
-            r"BOT_TOKEN\s*=\s*['\"]([^'\"]+)['\"]",
-            r"token\s*=\s*['\"]([^'\"]+)['\"]",
-            r"TOKEN\s*=\s*['\"]([^'\"]+)['\"]",
-            r"bot_token\s*=\s*['\"]([^'\"]+)['\"]",
-            r"getenv\s*\(\s*['\"]BOT_TOKEN['\"]\s*,\s*['\"]([^'\"]+)['\"]\s*\)",
-            r"environ\.get\s*\(\s*['\"]BOT_TOKEN['\"]\s*,\s*['\"]([^'\"]+)['\"]\s*\)"
-        ]
-        
+# Функции для работы с логами проектов
+def format_log_entry(message: str) -> str:
+    return f"[{datetime.now().strftime('%H:%M:%S')}] {message}"
+
+class ProjectLogWriter:
+    """Буферизует строки логов в памяти и пишет их в БД пачками одной транзакцией"""
+
+    def __init__(self):
+        self._buffers = {}  # project_id -> список строк, ожидающих записи
+        self._pending = 0
+        self._size_since_trim = {}  # project_id -> размер записей с последней очистки журнала
+        self.dropped = {}  # project_id -> число строк, отброшенных из-за переполнения буфера
+        self._dropped_unreported = {}
+        self._subscribers = {}  # project_id -> очереди подписчиков потока логов
+        self._wakeup = asyncio.Event()
+        self._flushed = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Останавливает фоновую запись и сбрасывает остаток буфера"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def write(self, project_id: int, message: str):
+        lines = [line.rstrip() for line in format_log_entry(message).splitlines() if line.strip()]
+        if not lines:
+            return
+        buffer = self._buffers.setdefault(project_id, [])
+        if len(buffer) + len(lines) > LOG_BUFFER_MAX_LINES:
+            # Обратное давление: даём фоновой записи разгрузить буфер, прежде чем отбрасывать строки
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(self._flushed.wait(), LOG_BACKPRESSURE_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            buffer = self._buffers.setdefault(project_id, [])
+        free = max(0, LOG_BUFFER_MAX_LINES - len(buffer))
+        if len(lines) > free:
+            dropped = len(lines) - free
+            self.dropped[project_id] = self.dropped.get(project_id, 0) + dropped
+            self._dropped_unreported[project_id] = self._dropped_unreported.get(project_id, 0) + dropped
+            lines = lines[:free]
+        buffer.extend(lines)
+        self._pending += len(lines)
+        if self._pending >= LOG_FLUSH_MAX_LINES:
+            self._wakeup.set()
+        for queue in self._subscribers.get(project_id, ()):
+            # Медленный подписчик теряет строки, а не задерживает вывод проекта
+            for line in lines[:queue.maxsize - queue.qsize()]:
+                queue.put_nowait(line)
+
+    def subscribe(self, project_id: int) -> asyncio.Queue:
+        """Возвращает очередь, в которую будут попадать новые строки журнала проекта"""
+        queue = asyncio.Queue(LOG_STREAM_QUEUE_SIZE)
+        self._subscribers.setdefault(project_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, project_id: int, queue: asyncio.Queue):
+        subscribers = self._subscribers.get(project_id)
+        if subscribers is not None:
+            subscribers.discard(queue)
+            if not subscribers:
+                del self._subscribers[project_id]
+
+    def discard(self, project_id: int):
+        """Забывает несохранённые строки удаляемого проекта"""
+        self._pending -= len(self._buffers.pop(project_id, []))
+        self._size_since_trim.pop(project_id, None)
+        self._dropped_unreported.pop(project_id, None)
+        self.dropped.pop(project_id, None)
+
+    async def flush(self):
+        async with self._flush_lock:
+            for project_id, count in self._dropped_unreported.items():
+                self._buffers.setdefault(project_id, []).append(
+                    format_log_entry(f"⚠️ Пропущено строк вывода (переполнение буфера): {count}")
+                )
+            self._dropped_unreported = {}
+            buffers, self._buffers = self._buffers, {}
+            self._pending = 0
+            rows = [(project_id, line, project_id) for project_id, lines in buffers.items() for line in lines]
+            if rows:
+                try:
+                    async with db_pool.acquire() as db:
+                        # Строки удалённых проектов отбрасываются, а не валят всю пачку
+                        await db.executemany(
+                            'INSERT INTO project_logs (project_id, line) SELECT ?, ? WHERE EXISTS (SELECT 1 FROM projects WHERE id = ?)',
+                            rows
+                        )
+                        for project_id, lines in buffers.items():
+                            size = self._size_since_trim.get(project_id, 0) + sum(len(line) + 1 for line in lines)
+                            if size > PROJECT_LOG_MAX_SIZE // 8:
+                                await trim_project_logs(db, project_id)
+                                size = 0
+                            self._size_since_trim[project_id] = size
+                        await db.commit()
+                except Exception as e:
+                    logger.error(f"Ошибка записи логов проектов ({len(rows)} строк): {e}")
+                    self._restore(buffers)
+            flushed, self._flushed = self._flushed, asyncio.Event()
+            flushed.set()
+
+    def _restore(self, buffers):
+        """Возвращает незаписанные строки в начало буфера, отбрасывая самые старые сверх лимита"""
+        for project_id, lines in buffers.items():
+            newer = self._buffers.get(project_id, [])
+            buffer = lines + newer
+            dropped = max(0, len(buffer) - LOG_BUFFER_MAX_LINES)
+            if dropped:
+                buffer = buffer[dropped:]
+                self.dropped[project_id] = self.dropped.get(project_id, 0) + dropped
+                self._dropped_unreported[project_id] = self._dropped_unreported.get(project_id, 0) + dropped
+            self._buffers[project_id] = buffer
+            self._pending += len(buffer) - len(newer)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), LOG_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+log_writer = ProjectLogWriter()
+
+async def append_project_log(project_id: int, message: str):
+    """Добавляет запись в журнал проекта через буферизующий писатель"""
+    await log_writer.write(project_id, message)
+
+async def trim_project_logs(db, project_id: int):
+    """Удаляет старые строки журнала сверх PROJECT_LOG_MAX_SIZE"""
+    await db.execute('''
+        DELETE FROM project_logs WHERE project_id = ? AND seq <= (
+            SELECT seq FROM (
+                SELECT seq, SUM(LENGTH(line) + 1) OVER (ORDER BY seq DESC) AS total
+                FROM project_logs WHERE project_id = ?
+            ) WHERE total > ? ORDER BY seq DESC LIMIT 1
+        )
+    ''', (project_id, project_id, PROJECT_LOG_MAX_SIZE))
+
+async def get_project_logs(project_id: int, max_chars: int = 4000) -> str:
+    """Возвращает хвост журнала проекта не длиннее max_chars символов"""
+    await log_writer.flush()
+    try:
+        async with db_pool.acquire() as db:
+            cursor = await db.execute(
+                'SELECT line FROM project_logs WHERE project_id = ? ORDER BY seq DESC LIMIT ?',
+                (project_id, PROJECT_LOG_TAIL_LINES)
+            )
+            rows = await cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Ошибка чтения логов проекта {project_id}: {e}")
+        return ""
+    lines = []
+    size = 0
+    truncated = len(rows) == PROJECT_LOG_TAIL_LINES
+    for (line,) in rows:
+        size += len(line) + 1
+        if size > max_chars:
+            truncated = True
+            break
+        lines.append(line)
+    text = '\n'.join(reversed(lines))
+    return "...\n" + text if truncated and text else text
+
+# Функция для извлечения токена бота из кода
+def extract_bot_token_from_code(file_path: str) -> str:
+    """Извлекает токен бота из Python файла"""
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        
+        # Паттерны для поиска токена
+        patterns = [
+            r"BOT_TOKEN\s*=\s*['\"]([^'\"]+)['\"]",
+            r"token\s*=\s*['\"]([^'\"]+)['\"]",
+            r"TOKEN\s*=\s*['\"]([^'\"]+)['\"]",
+            r"bot_token\s*=\s*['\"]([^'\"]+)['\"]",
+            r"getenv\s*\(\s*['\"]BOT_TOKEN['\"]\s*,\s*['\"]([^'\"]+)['\"]\s*\)",
+            r"environ\.get\s*\(\s*['\"]BOT_TOKEN['\"]\s*,\s*['\"]([^'\"]+)['\"]\s*\)"
+        ]
+        
         for pattern in patterns:
             match = re.search(pattern, content)
             if match:
@@ -525,7 +1460,7 @@ async def get_main_menu(user_id: int) -> InlineKeyboardMarkup:
         keyboard.inline_keyboard.append([InlineKeyboardButton(text="📊 Статистика", callback_data="stats")])
     
     keyboard.inline_keyboard.append([InlineKeyboardButton(text="➕ Создать проект", callback_data="create_project")])
-    user_projects = await get_user_projects(user_id)
+    user_projects = await get_user_project_summaries(user_id)
     if user_projects:
         for proj in user_projects:
             status = " 🟢" if proj['is_running'] else " 🔴"
@@ -541,7 +1476,31 @@ async def get_project_menu(project_name: str, user_id: int) -> tuple[str, Inline
         return "❌ Проект не найден.", InlineKeyboardMarkup(inline_keyboard=[])
     
     created_str = project['created'].strftime('%Y-%m-%d %H:%M')
-    status = "🟢 запущен" if project['is_running'] else "🔴 остановлен"
+    process_status = await process_control.status(project['id'])
+    queue_position = process_status['queue_position']
+    restart_in = process_status['restart_in']
+    # Состояние берётся у узла, где выполняется проект: запись в БД обновляется с задержкой
+    is_running = process_status['running']
+    health = process_status['health']
+    if process_status.get('offline'):
+        # Узел недоступен: бот на нём может работать дальше, а может быть остановлен
+        status = "❔ состояние неизвестно"
+    elif is_running and health and health['state'] == 'hung':
+        status = "🟠 завис, перезапускается"
+    elif is_running:
+        status = "🟢 запущен"
+    elif queue_position:
+        status = f"⏳ в очереди на запуск (позиция {queue_position})"
+        if process_status['blocked_reason']:
+            status += f", {process_status['blocked_reason']}"
+    elif restart_in is not None:
+        status = f"⏳ перезапуск через {restart_in} с"
+    elif process_status['parked']:
+        status = "🔁 остановлен: падает после запуска"
+    else:
+        status = "🔴 остановлен"
+    if process_status.get('node'):
+        status += f" (узел {process_status['node']}{', недоступен' if process_status.get('offline') else ''})"
     auto_restart_status = "✅ ВКЛ" if project['auto_restart'] else "❌ ВЫКЛ"
     bot_info = f"\n🤖 Бот: @{project['bot_username']}" if project['bot_username'] else "\n🤖 Бот: не указан"
     
@@ -551,15 +1510,29 @@ async def get_project_menu(project_name: str, user_id: int) -> tuple[str, Inline
            f"📊 Статус: {status}" \
            f"{bot_info}\n" \
            f"🔄 Авто-рестарт: {auto_restart_status}\n" \
-           f"🤖 Запущено ботов всего: {running_count}/{MAX_CONCURRENT_BOTS}"
+           f"🤖 Запущено ботов всего: {process_status['running_count']}/{MAX_CONCURRENT_BOTS}\n" \
+           f"⏳ В очереди на запуск: {process_status['queue_length']}"
+    if is_running:
+        text += f"\n{format_usage(process_status['usage'])}"
+    if health:
+        text += f"\n{format_health(health)}"
+    
+    restart_history = process_status['history']
+    if restart_history:
+        text += "\n\n📜 Последние завершения:"
+        for entry in reversed(restart_history):
+            text += f"\n• {datetime.fromisoformat(entry['time']).strftime('%m-%d %H:%M:%S')} — код {entry['returncode']}, " \
+                    f"проработал {format_uptime(entry['uptime'])}"
     
     inline_keyboard = []
     if not project['file_path']:
         inline_keyboard.append([InlineKeyboardButton(text="📤 Установить файл", callback_data=f"install_file_{project_name}")])
     else:
         inline_keyboard.append([InlineKeyboardButton(text="🔄 Сменить файл", callback_data=f"change_file_{project_name}")])
-        if project['is_running']:
+        if is_running:
             inline_keyboard.append([InlineKeyboardButton(text="⏹️ Остановить", callback_data=f"stop_{project_name}")])
+        elif queue_position or restart_in is not None:
+            inline_keyboard.append([InlineKeyboardButton(text="⏹️ Отменить запуск", callback_data=f"stop_{project_name}")])
         else:
             inline_keyboard.append([InlineKeyboardButton(text="▶️ Запуск", callback_data=f"run_{project_name}")])
         
@@ -570,7 +1543,7 @@ async def get_project_menu(project_name: str, user_id: int) -> tuple[str, Inline
             inline_keyboard.append([InlineKeyboardButton(text="🟢 Включить авто-рестарт", callback_data=f"toggle_restart_{project_name}")])
         
         inline_keyboard.append([InlineKeyboardButton(text="📚 Установить библиотеку", callback_data=f"install_lib_{project_name}")])
-        if project['is_running']:
+        if is_running:
             inline_keyboard.append([InlineKeyboardButton(text="📋 Логи", callback_data=f"logs_{project_name}")])
     
     inline_keyboard.append([InlineKeyboardButton(text="🗑️ Удалить проект", callback_data=f"delete_{project_name}")])
@@ -578,6 +1551,40 @@ async def get_project_menu(project_name: str, user_id: int) -> tuple[str, Inline
     keyboard = InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
     return text, keyboard
 
+# Функция для форматирования времени работы процесса
+def format_uptime(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds} с"
+    if seconds < 3600:
+        return f"{seconds // 60} мин {seconds % 60} с"
+    return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+
+# Функция для обрезки текста под лимит сообщения Telegram
+def fit_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> str:
+    if len(text) <= limit:
+        return text
+    return text[:limit - 2] + "\n…"
+
+# Функция для создания кнопок переключения страниц
+def get_pagination_row(callback_prefix: str, page: int, total: int) -> list:
+    pages = max(1, (total + ADMIN_PAGE_SIZE - 1) // ADMIN_PAGE_SIZE)
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton(text="⬅️", callback_data=f"{callback_prefix}{page - 1}"))
+    if page + 1 < pages:
+        row.append(InlineKeyboardButton(text="➡️", callback_data=f"{callback_prefix}{page + 1}"))
+    return row
+
+# Функция для получения номера страницы из callback
+def get_callback_page(data: str, callback_prefix: str) -> int:
+    if data.startswith(callback_prefix):
+        try:
+            return max(0, int(data[len(callback_prefix):]))
+        except ValueError:
+            return 0
+    return 0
+
 # Функция для создания админ-панели
 async def get_admin_panel() -> InlineKeyboardMarkup:
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -610,7 +1617,6 @@ async def admin_panel(callback: CallbackQuery):
         await callback.answer("❌ Доступ запрещён.")
         return
     
-    await update_user_activity(user_id)
     keyboard = await get_admin_panel()
     await callback.message.edit_text(
         "👑 Админ-панель\n\n"
@@ -619,58 +1625,191 @@ async def admin_panel(callback: CallbackQuery):
     )
     await callback.answer()
 
+# Хэндлер для команды /limits: просмотр и изменение лимитов ресурсов проекта
+@dp.message(Command("limits"))
+async def cmd_limits(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    args = message.text.split()[1:]
+    if not args or not args[0].isdigit():
+        await message.answer(
+            "Использование: /limits <id проекта> [ключ=значение ...]\n"
+            f"Ключи: {', '.join(PROJECT_LIMITS)}\n"
+            "Значение none — без ограничения, default — значение по умолчанию.\n"
+            "Новые лимиты применяются при следующем запуске проекта."
+        )
+        return
+    project = await get_project_by_id(int(args[0]))
+    if not project:
+        await message.answer("❌ Проект не найден.")
+        return
+    
+    async with db_pool.acquire() as db:
+        cursor = await db.execute('SELECT limits FROM projects WHERE id = ?', (project['id'],))
+        row = await cursor.fetchone()
+    overrides = json.loads(row[0]) if row and row[0] else {}
+    for arg in args[1:]:
+        key, _, value = arg.partition('=')
+        if key not in PROJECT_LIMITS:
+            await message.answer(f"❌ Неизвестный лимит: {key}")
+            return
+        if value == 'default':
+            overrides.pop(key, None)
+        elif value == 'none':
+            overrides[key] = None
+        elif value.isdigit() and int(value) > 0:
+            overrides[key] = int(value)
+        else:
+            await message.answer(f"❌ Некорректное значение для {key}: {value}")
+            return
+    if args[1:]:
+        await update_project(project['id'], limits=json.dumps(overrides) if overrides else None)
+    
+    limits = await get_project_limits(project['id'])
+    lines = [
+        f"• {key}: {value if value is not None else 'без ограничения'}{' (изменено)' if key in overrides else ''}"
+        for key, value in limits.items()
+    ]
+    await message.answer(f"📏 Лимиты проекта '{project['name']}' (ID: {project['id']}):\n" + "\n".join(lines))
+
+# Хэндлер для команды /watchdog: просмотр и изменение проверок зависания проекта
+@dp.message(Command("watchdog"))
+async def cmd_watchdog(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    args = message.text.split()[1:]
+    if not args or not args[0].isdigit():
+        await message.answer(
+            "Использование: /watchdog <id проекта> [ключ=значение ...]\n"
+            f"Ключи: {', '.join(PROJECT_WATCHDOG)}\n"
+            "Минуты — целое число, heartbeat_file — путь внутри папки проекта, probe — on или off.\n"
+            "Значение none — проверка выключена, default — значение по умолчанию.\n"
+            "Зависший проект останавливается как упавший и перезапускается, если включён авто-рестарт.\n"
+            "Новые проверки применяются при следующем запуске проекта."
+        )
+        return
+    project = await get_project_by_id(int(args[0]))
+    if not project:
+        await message.answer("❌ Проект не найден.")
+        return
+    
+    async with db_pool.acquire() as db:
+        cursor = await db.execute('SELECT watchdog FROM projects WHERE id = ?', (project['id'],))
+        row = await cursor.fetchone()
+    overrides = json.loads(row[0]) if row and row[0] else {}
+    for arg in args[1:]:
+        key, _, value = arg.partition('=')
+        if key not in PROJECT_WATCHDOG:
+            await message.answer(f"❌ Неизвестная проверка: {key}")
+            return
+        if value == 'default':
+            overrides.pop(key, None)
+        elif value == 'none':
+            overrides[key] = None
+        elif key == 'probe' and value in ('on', 'off'):
+            overrides[key] = value == 'on'
+        elif key == 'heartbeat_file' and value and not os.path.isabs(value) and '..' not in value.split('/'):
+            overrides[key] = value
+        elif key.endswith('_minutes') and value.isdigit() and int(value) > 0:
+            overrides[key] = int(value)
+        else:
+            await message.answer(f"❌ Некорректное значение для {key}: {value}")
+            return
+    if args[1:]:
+        await update_project(project['id'], watchdog=json.dumps(overrides) if overrides else None)
+    
+    checks = await get_project_watchdog(project['id'])
+    lines = [
+        f"• {key}: {value if value not in (None, False) else 'выключено'}{' (изменено)' if key in overrides else ''}"
+        for key, value in checks.items()
+    ]
+    await message.answer(f"🩺 Проверки зависания проекта '{project['name']}' (ID: {project['id']}):\n" + "\n".join(lines))
+
+@dp.message(Command("nodes"))
+async def cmd_nodes(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    lines = []
+    for node in await process_control.nodes():
+        flags = (" 🚚 выводится из работы" if node['draining'] else "") + (" ⚠️ не подключён" if node['offline'] else "")
+        if node['offline']:
+            lines.append(f"• {node['name']}:{flags}")
+            continue
+        load = f"{node['load']:.2f}" if node.get('load') is not None else "нет данных"
+        lines.append(
+            f"• {node['name']}{flags}: запущено {len(node['running'])}, в очереди {node['queue_length']}, "
+            f"память {format_size(node['available'])} из {format_size(node['total'])}, нагрузка на ядро {load}"
+        )
+    await message.answer("🖥️ Узлы:\n" + "\n".join(lines))
+
+@dp.message(Command("drain", "undrain"))
+async def cmd_drain(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    command, *args = message.text.split()
+    enabled = command.lstrip('/').split('@')[0] == 'drain'
+    if len(args) != 1:
+        await message.answer("Использование: /drain <имя агента> — перенести проекты с агента, /undrain <имя агента> — вернуть его в работу")
+        return
+    try:
+        migrated = await process_control.drain(args[0], enabled)
+    except SupervisorError as e:
+        await message.answer(f"❌ {e}")
+        return
+    if enabled:
+        await message.answer(f"🚚 Агент {args[0]} выведен из работы, перенесено проектов: {migrated}")
+    else:
+        await message.answer(f"✅ Агент {args[0]} снова принимает проекты")
+
 # Хэндлер для "Боты в хосте"
-@dp.callback_query(lambda c: c.data == "admin_bots_in_host")
+@dp.callback_query(lambda c: c.data == "admin_bots_in_host" or c.data.startswith("admin_bots_in_host_page_"))
 async def admin_bots_in_host(callback: CallbackQuery):
     user_id = callback.from_user.id
     if not is_admin(user_id):
         await callback.answer("❌ Доступ запрещён.")
         return
     
-    await update_user_activity(user_id)
+    page = get_callback_page(callback.data, "admin_bots_in_host_page_")
     
-    # Получаем пользователей с запущенными ботами
-    users_with_bots = await get_users_with_running_bots()
+    # Получаем запущенные проекты, самые затратные первыми
+    running_bots, total = await get_running_bots_page(page)
     
-    if not users_with_bots:
+    if not running_bots:
         text = "🤖 В настоящее время нет запущенных ботов в хосте."
     else:
-        text = "🤖 Боты в хосте:\n\n"
-        for user in users_with_bots:
-            username = user['username'] or "Без username"
-            
-            # Получаем проекты пользователя с информацией о ботах
-            user_projects = await get_user_projects(user['user_id'])
-            running_projects = [p for p in user_projects if p['is_running'] and p['bot_username']]
-            
-            text += f"👤 Пользователь: {username} (ID: {user['user_id']})\n"
-            
-            if running_projects:
-                for project in running_projects:
-                    text += f"   📁 {project['name']} → 🤖 @{project['bot_username']}\n"
-            else:
-                text += f"   📁 Без запущенных ботов\n"
+        pages = (total + ADMIN_PAGE_SIZE - 1) // ADMIN_PAGE_SIZE
+        text = f"🤖 Боты в хосте по потреблению ресурсов (стр. {page + 1}/{pages}):\n\n"
+        for index, project in enumerate(running_bots, start=page * ADMIN_PAGE_SIZE + 1):
+            username = project['username'] or "Без username"
+            bot_info = f" → 🤖 @{project['bot_username']}" if project['bot_username'] else ""
+            text += f"{index}. 📁 {project['name']}{bot_info}\n"
+            text += f"   👤 Пользователь: {username} (ID: {project['user_id']})\n"
+            text += f"   {format_usage(project['usage'])}\n"
+            if project['health']:
+                text += f"   {format_health(project['health'])}\n"
             text += "\n"
     
-    back_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬅️ Назад в админ-панель", callback_data="admin_panel")]
-    ])
+    back_keyboard = InlineKeyboardMarkup(inline_keyboard=[])
+    pagination_row = get_pagination_row("admin_bots_in_host_page_", page, total)
+    if pagination_row:
+        back_keyboard.inline_keyboard.append(pagination_row)
+    back_keyboard.inline_keyboard.append([InlineKeyboardButton(text="⬅️ Назад в админ-панель", callback_data="admin_panel")])
     
-    await callback.message.edit_text(text, reply_markup=back_keyboard)
+    await callback.message.edit_text(fit_message(text), reply_markup=back_keyboard)
     await callback.answer()
 
 # Хэндлер для "Исходники ботов"
-@dp.callback_query(lambda c: c.data == "admin_bot_sources")
+@dp.callback_query(lambda c: c.data == "admin_bot_sources" or c.data.startswith("admin_bot_sources_page_"))
 async def admin_bot_sources(callback: CallbackQuery):
     user_id = callback.from_user.id
     if not is_admin(user_id):
         await callback.answer("❌ Доступ запрещён.")
         return
     
-    await update_user_activity(user_id)
+    page = get_callback_page(callback.data, "admin_bot_sources_page_")
     
-    # Получаем всех пользователей с проектами
-    users_with_projects = await get_users_with_projects()
+    # Получаем пользователей с проектами и числом их ботов
+    users_with_projects, total = await get_users_with_projects_page(page)
     
     if not users_with_projects:
         text = "📁 Нет пользователей с ботами."
@@ -678,24 +1817,24 @@ async def admin_bot_sources(callback: CallbackQuery):
             [InlineKeyboardButton(text="⬅️ Назад в админ-панель", callback_data="admin_panel")]
         ])
     else:
-        text = "📁 Выберите пользователя для просмотра исходников:"
+        pages = (total + ADMIN_PAGE_SIZE - 1) // ADMIN_PAGE_SIZE
+        text = f"📁 Выберите пользователя для просмотра исходников (стр. {page + 1}/{pages}):"
         keyboard = InlineKeyboardMarkup(inline_keyboard=[])
         
         for user in users_with_projects:
             username = user['username'] or f"User_{user['user_id']}"
             
-            # Получаем проекты пользователя для отображения информации о ботах
-            user_projects = await get_user_projects_files(user['user_id'])
-            bot_count = sum(1 for p in user_projects if p['bot_username'])
-            
             button_text = f"👤 {username}"
-            if bot_count > 0:
-                button_text += f" ({bot_count} ботов)"
+            if user['bot_count'] > 0:
+                button_text += f" ({user['bot_count']} ботов)"
             
             keyboard.inline_keyboard.append([
                 InlineKeyboardButton(text=button_text, callback_data=f"admin_user_sources_{user['user_id']}")
             ])
         
+        pagination_row = get_pagination_row("admin_bot_sources_page_", page, total)
+        if pagination_row:
+            keyboard.inline_keyboard.append(pagination_row)
         keyboard.inline_keyboard.append([InlineKeyboardButton(text="⬅️ Назад в админ-панель", callback_data="admin_panel")])
     
     await callback.message.edit_text(text, reply_markup=keyboard)
@@ -709,8 +1848,6 @@ async def admin_user_sources(callback: CallbackQuery):
         await callback.answer("❌ Доступ запрещён.")
         return
     
-    await update_user_activity(user_id)
-    
     target_user_id = int(callback.data.replace("admin_user_sources_", ""))
     
     # Получаем проекты пользователя
@@ -744,8 +1881,6 @@ async def admin_view_source(callback: CallbackQuery):
         await callback.answer("❌ Доступ запрещён.")
         return
     
-    await update_user_activity(user_id)
-    
     # Парсим данные из callback
     data_parts = callback.data.replace("admin_view_source_", "").split("_")
     target_user_id = int(data_parts[0])
@@ -797,8 +1932,6 @@ async def admin_refresh_bot_info(callback: CallbackQuery):
         await callback.answer("❌ Доступ запрещён.")
         return
     
-    await update_user_activity(user_id)
-    
     # Парсим данные из callback
     data_parts = callback.data.replace("admin_refresh_bot_", "").split("_")
     target_user_id = int(data_parts[0])
@@ -832,8 +1965,6 @@ async def admin_download_file(callback: CallbackQuery):
         await callback.answer("❌ Доступ запрещён.")
         return
     
-    await update_user_activity(user_id)
-    
     # Парсим данные из callback
     data_parts = callback.data.replace("admin_download_", "").split("_")
     target_user_id = int(data_parts[0])
@@ -865,7 +1996,6 @@ async def admin_download_file(callback: CallbackQuery):
 @dp.callback_query(lambda c: c.data == "refresh")
 async def refresh_menu(callback: CallbackQuery):
     user_id = callback.from_user.id
-    await update_user_activity(user_id)
     keyboard = await get_main_menu(user_id)
     await callback.message.edit_reply_markup(reply_markup=keyboard)
     await callback.answer("✅ Меню обновлено")
@@ -882,8 +2012,7 @@ async def process_create_project(callback: CallbackQuery, state: FSMContext):
 async def process_project_name(message: types.Message, state: FSMContext):
     project_name = message.text.strip()
     user_id = message.from_user.id
-    existing_projects = await get_user_projects(user_id)
-    if any(p['name'] == project_name for p in existing_projects):
+    if await get_project_by_name(user_id, project_name):
         await message.answer("❌ Проект с таким названием уже существует. Введите другое название.")
         return
     try:
@@ -906,7 +2035,6 @@ async def process_project_name(message: types.Message, state: FSMContext):
 async def process_project_button(callback: CallbackQuery):
     project_name = callback.data.replace("project_", "")
     user_id = callback.from_user.id
-    await update_user_activity(user_id)
     text, keyboard = await get_project_menu(project_name, user_id)
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
@@ -915,7 +2043,6 @@ async def process_project_button(callback: CallbackQuery):
 @dp.callback_query(lambda c: c.data == "back_to_menu")
 async def back_to_menu(callback: CallbackQuery):
     user_id = callback.from_user.id
-    await update_user_activity(user_id)
     keyboard = await get_main_menu(user_id)
     await callback.message.edit_text(
         "👋 Привет! Добро пожаловать в бота для хостинга Python скриптов.\n\n"
@@ -930,7 +2057,6 @@ async def back_to_menu(callback: CallbackQuery):
 async def toggle_auto_restart(callback: CallbackQuery):
     project_name = callback.data.replace("toggle_restart_", "")
     user_id = callback.from_user.id
-    await update_user_activity(user_id)
     
     project = await get_project_by_name(user_id, project_name)
     if not project:
@@ -953,28 +2079,31 @@ async def show_stats(callback: CallbackQuery):
         await callback.answer("❌ Доступ запрещён.")
         return
     
-    all_users = await get_all_users()
-    total_projects = 0
-    running_projects = 0
-    auto_restart_projects = 0
-    bots_with_username = 0
-    
-    for user_id in all_users:
-        projects = await get_user_projects(user_id)
-        total_projects += len(projects)
-        running_projects += sum(1 for p in projects if p['is_running'])
-        auto_restart_projects += sum(1 for p in projects if p['auto_restart'])
-        bots_with_username += sum(1 for p in projects if p['bot_username'])
+    try:
+        stats = await get_host_statistics()
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики: {e}")
+        await callback.answer("❌ Ошибка получения статистики.")
+        return
+    host_status = await process_control.host_status()
+    usage = host_status['usage']
     
     stats_text = (
         f"📊 Статистика бота:\n\n"
-        f"👥 Всего пользователей: {len(all_users)}\n"
-        f"📁 Всего проектов: {total_projects}\n"
-        f"🟢 Запущено проектов: {running_projects}\n"
-        f"🔴 Остановлено проектов: {total_projects - running_projects}\n"
-        f"🤖 Ботов с username: {bots_with_username}\n"
-        f"🔄 Авто-рестарт: {auto_restart_projects}\n"
-        f"🚀 Лимит ботов: {running_count}/{MAX_CONCURRENT_BOTS}\n"
+        f"👥 Всего пользователей: {stats['users']}\n"
+        f"📁 Всего проектов: {stats['projects']}\n"
+        f"🟢 Запущено проектов: {stats['running']}\n"
+        f"🔴 Остановлено проектов: {stats['projects'] - stats['running']}\n"
+        f"🤖 Ботов с username: {stats['with_username']}\n"
+        f"🔄 Авто-рестарт: {stats['auto_restart']}\n"
+        f"📈 Проектов на пользователя (p50/p90/p99/max): "
+        f"{stats['projects_p50']}/{stats['projects_p90']}/{stats['projects_p99']}/{stats['projects_max']}\n"
+        f"💾 Диск: проекты {format_size(stats['projects_size'])}, база данных {format_size(stats['db_size'])}\n"
+        f"🚀 Запущено ботов: {host_status['running_count']} (предел {MAX_CONCURRENT_BOTS})\n"
+        f"{format_host_capacity()}\n"
+        f"⏳ В очереди на запуск: {host_status['queue_length']}\n"
+        f"🖥️ Проекты сейчас: CPU {usage['cpu']:.1f}%, RAM {format_size(usage['rss'])}, "
+        f"процессов {usage['processes']}, потоков {usage['threads']}, файлов {usage['fds']}\n"
         f"🐍 Используется: Python subprocess"
     )
     await callback.message.edit_text(stats_text)
@@ -1110,7 +2239,6 @@ async def process_file(message: types.Message, state: FSMContext):
     project_name = data['project_name']
     is_change = data.get('is_change', False)
     user_id = message.from_user.id
-    await update_user_activity(user_id)
     if not message.document:
         await message.answer("❌ Пожалуйста, отправьте файл.")
         return
@@ -1123,31 +2251,17 @@ async def process_file(message: types.Message, state: FSMContext):
         await message.answer("❌ Проект не найден.")
         await state.clear()
         return
+    if is_change:
+        # Новый файл может исправить ошибку, из-за которой проект падал
+        await process_control.reset(project['id'])
     if is_change and project['is_running']:
-        global running_count
-        if project.get('process'):
-            try:
-                process_info = project['process']
-                if process_info and process_info['process'] and process_info['process'].poll() is None:
-                    if os.name == 'nt':
-                        process_info['process'].terminate()
-                    else:
-                        os.kill(process_info['process'].pid, signal.SIGTERM)
-                    process_info['process'].wait(timeout=5)
-            except Exception as e:
-                logger.error(f"Ошибка остановки процесса: {e}")
-            active_processes.pop(project['id'], None)
-            running_count = max(0, running_count - 1)
+        if not await process_control.stop(project['id'], "Процесс остановлен для смены файла."):
+            await update_project(project['id'], is_running=False, process_id=None)
         project['is_running'] = False
-        project['logs'] += f"[{datetime.now().strftime('%H:%M:%S')}] Процесс остановлен для смены файла.\n"
-        await update_project(project['id'], is_running=False, process_id=None, logs=project['logs'])
-        
-        # Сохраняем состояние
-        save_bot_state()
         
     project_dir = get_project_path(user_id, project['safe_name'])
     if is_change and os.path.exists(project_dir):
-        shutil.rmtree(project_dir)
+        await asyncio.to_thread(shutil.rmtree, project_dir)
     os.makedirs(project_dir, exist_ok=True)
     try:
         file = await bot.get_file(message.document.file_id)
@@ -1177,7 +2291,8 @@ async def process_file(message: types.Message, state: FSMContext):
                     project['file_path'] = os.path.join(project_dir, pf)
                     break
             if not project['file_path']:
-                for root, _, files in os.walk(project_dir):
+                for root, dirs, files in os.walk(project_dir):
+                    dirs[:] = [name for name in dirs if name != PROJECT_VENV_DIR]
                     for f in files:
                         if f.endswith('.py'):
                             project['file_path'] = os.path.join(root, f)
@@ -1193,7 +2308,7 @@ async def process_file(message: types.Message, state: FSMContext):
             asyncio.create_task(update_bot_info_for_project(project['id'], project['file_path']))
             
             await message.answer(f"✅ Архив '{file_name}' {'заменён' if is_change else 'распакован'}! Главный файл: {os.path.basename(project['file_path'])}")
-        await update_project(project['id'], file_path=project['file_path'], logs=project['logs'])
+        await update_project(project['id'], file_path=project['file_path'])
     except Exception as e:
         await message.answer(f"❌ Ошибка при обработке файла: {str(e)}")
         await state.clear()
@@ -1208,7 +2323,7 @@ async def install_lib_start(callback: CallbackQuery, state: FSMContext):
     project_name = callback.data.replace("install_lib_", "")
     await state.update_data(project_name=project_name)
     try:
-        await check_and_create_tables()
+        await ensure_db_ready()
     except Exception as e:
         await callback.message.edit_text(f"❌ Ошибка базы данных: {str(e)}")
         await callback.answer()
@@ -1224,9 +2339,8 @@ async def process_lib_name(message: types.Message, state: FSMContext):
     project_name = data['project_name']
     lib_name = message.text.strip()
     user_id = message.from_user.id
-    await update_user_activity(user_id)
     try:
-        await check_and_create_tables()
+        await ensure_db_ready()
     except Exception as e:
         await message.answer(f"❌ Ошибка базы данных: {str(e)}")
         await state.clear()
@@ -1241,31 +2355,23 @@ async def process_lib_name(message: types.Message, state: FSMContext):
     try:
         install_msg = await message.reply(f"⏳ Устанавливаем '{lib_name}'...")
         
-        # Установка библиотеки через pip
-        process = await asyncio.create_subprocess_exec(
-            sys.executable, "-m", "pip", "install", lib_name,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            cwd=project_dir
-        )
-        
-        stdout, stderr = await process.communicate()
+        # Установка библиотеки через pip в окружение проекта
+        installed, output = await ensure_project_venv(project_dir)
+        if installed:
+            installed, output = await pip_install(project_dir, lib_name)
         
-        if process.returncode == 0:
-            requirements = project['requirements']
+        if installed:
+            requirements = await get_project_requirements(project['id'])
             if lib_name not in requirements:
                 requirements.append(lib_name)
                 await update_project(project['id'], requirements=json.dumps(requirements))
             
-            output = stdout.decode('utf-8', errors='ignore') if stdout else ""
-            project['logs'] += f"[{datetime.now().strftime('%H:%M:%S')}] Установлена библиотека: {lib_name}\n{output}\n"
-            await update_project(project['id'], logs=project['logs'])
+            await append_project_log(project['id'], f"Установлена библиотека: {lib_name}\n{output}")
             
             await install_msg.edit_text(f"✅ Библиотека '{lib_name}' установлена!\n{output[-500:]}")
         else:
-            error_output = stderr.decode('utf-8', errors='ignore') if stderr else "Неизвестная ошибка"
-            project['logs'] += f"[{datetime.now().strftime('%H:%M:%S')}] Ошибка установки {lib_name}:\n{error_output}\n"
-            await update_project(project['id'], logs=project['logs'])
+            error_output = output
+            await append_project_log(project['id'], f"Ошибка установки {lib_name}:\n{error_output}")
             await install_msg.edit_text(f"❌ Ошибка установки '{lib_name}':\n{error_output[-500:]}")
     except Exception as e:
         await message.answer(f"❌ Ошибка при установке библиотеки: {str(e)}")
@@ -1278,10 +2384,8 @@ async def process_lib_name(message: types.Message, state: FSMContext):
 # Хэндлер для "Запуск"
 @dp.callback_query(lambda c: c.data.startswith("run_"))
 async def run_project(callback: CallbackQuery):
-    global running_count
     project_name = callback.data.replace("run_", "")
     user_id = callback.from_user.id
-    await update_user_activity(user_id)
     project = await get_project_by_name(user_id, project_name)
     if not project:
         await callback.message.answer("❌ Проект не найден.")
@@ -1295,10 +2399,13 @@ async def run_project(callback: CallbackQuery):
         await callback.message.answer("❌ Сначала установите файл.")
         await callback.answer()
         return
-    if running_count >= MAX_CONCURRENT_BOTS:
-        await callback.message.answer(f"❌ Достигнут лимит запущенных ботов: {MAX_CONCURRENT_BOTS}.")
+    queue_position = (await process_control.status(project['id']))['queue_position']
+    if queue_position:
+        await callback.message.answer(f"⏳ Проект уже в очереди на запуск. Позиция: {queue_position}")
         await callback.answer()
         return
+    # Ручной запуск снимает проект с паузы после цикла падений и отменяет отложенный рестарт
+    await process_control.reset(project['id'])
     project_dir = os.path.dirname(project['file_path'])
     if not os.path.exists(project_dir):
         project_dir = get_project_path(user_id, project['safe_name'])
@@ -1308,64 +2415,35 @@ async def run_project(callback: CallbackQuery):
         await callback.answer()
         return
     try:
-        script_name = os.path.basename(project['file_path'])
-        
-        # Установка зависимостей если есть
-        if project['requirements']:
-            install_msg = await callback.message.answer("⏳ Устанавливаем зависимости...")
-            reqs_path = os.path.join(project_dir, 'requirements.txt')
-            with open(reqs_path, 'w', encoding='utf-8') as f:
-                f.write('\n'.join(project['requirements']))
-            
-            process = await asyncio.create_subprocess_exec(
-                sys.executable, "-m", "pip", "install", "-r", "requirements.txt",
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-                cwd=project_dir
+        # Установка зависимостей если есть; окружение проекта создаётся при первом запуске
+        requirements = await get_project_requirements(project['id'])
+        needs_venv = PROJECT_VENVS and get_project_python(project_dir) == sys.executable
+        if requirements or needs_venv:
+            install_msg = await callback.message.answer(
+                "⏳ Создаём окружение проекта и устанавливаем зависимости..." if needs_venv else "⏳ Устанавливаем зависимости..."
             )
+            if requirements:
+                reqs_path = os.path.join(project_dir, 'requirements.txt')
+                with open(reqs_path, 'w', encoding='utf-8') as f:
+                    f.write('\n'.join(requirements))
             
-            stdout, stderr = await process.communicate()
+            installed, error_output = await install_project_requirements(project_dir)
             
-            if process.returncode == 0:
+            if installed:
                 await install_msg.edit_text("✅ Зависимости установлены!")
-                project['logs'] += f"[{datetime.now().strftime('%H:%M:%S')}] Зависимости установлены.\n"
+                await append_project_log(project['id'], "Зависимости установлены.")
             else:
-                error_output = stderr.decode('utf-8', errors='ignore') if stderr else "Неизвестная ошибка"
-                project['logs'] += f"[{datetime.now().strftime('%H:%M:%S')}] Ошибка установки зависимостей:\n{error_output}\n"
-                await update_project(project['id'], logs=project['logs'])
+                await append_project_log(project['id'], f"Ошибка установки зависимостей:\n{error_output}")
                 await install_msg.edit_text(f"❌ Ошибка установки зависимостей:\n{error_output[-500:]}")
                 await callback.answer()
                 return
         
-        # Запуск основного скрипта
-        process = await asyncio.create_subprocess_exec(
-            sys.executable, script_name,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            cwd=project_dir
-        )
-        
-        # Сохраняем информацию о процессе
-        process_info = {
-            'process': process,
-            'user_id': user_id,
-            'project_name': project_name,
-            'start_time': datetime.now()
-        }
-        
-        active_processes[project['id']] = process_info
-        project['process'] = process_info
-        project['is_running'] = True
-        running_count += 1
-        project['logs'] += f"[{datetime.now().strftime('%H:%M:%S')}] Процесс запущен: PID {process.pid}\n"
-        await update_project(project['id'], is_running=True, logs=project['logs'], process_id=process.pid)
-        
-        # Сохраняем состояние
-        save_bot_state()
-        
-        # Мониторинг вывода процесса
-        asyncio.create_task(monitor_process_output(process, project['id']))
-        asyncio.create_task(wait_for_process(process, project['id'], user_id, project_name))
+        # Запуск основного скрипта через планировщик
+        queue_position = await process_control.start(project['id'], user_id, project_name)
+        if queue_position:
+            await callback.message.answer(
+                f"⏳ Сейчас хосту не хватает ресурсов, проект поставлен в очередь на запуск. Позиция: {queue_position}"
+            )
         
         text, keyboard = await get_project_menu(project_name, user_id)
         await callback.message.answer(text, reply_markup=keyboard)
@@ -1374,184 +2452,2664 @@ async def run_project(callback: CallbackQuery):
         logger.error(f"Ошибка запуска проекта: {e}")
     await callback.answer()
 
+# Функция для получения интерпретатора проекта: Python из его окружения, а если окружения нет — интерпретатор хоста
+def get_project_python(project_dir: str) -> str:
+    if os.name == 'nt':
+        path = os.path.join(project_dir, PROJECT_VENV_DIR, 'Scripts', 'python.exe')
+    else:
+        path = os.path.join(project_dir, PROJECT_VENV_DIR, 'bin', 'python')
+    return path if os.path.exists(path) else sys.executable
+
+# Функция для запуска команды установки; возвращает (успех, вывод при успехе или текст ошибки)
+async def run_install_command(args, cwd: str) -> tuple[bool, str]:
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        cwd=cwd
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode == 0:
+        return True, stdout.decode('utf-8', errors='ignore') if stdout else ""
+    return False, stderr.decode('utf-8', errors='ignore') if stderr else "Неизвестная ошибка"
+
+# Функция для создания пустого окружения через uv, если он есть, или через venv
+async def create_venv(venv_dir: str) -> tuple[bool, str]:
+    uv = shutil.which('uv') if PROJECT_VENV_USE_UV else None
+    if uv:
+        args = [uv, 'venv', '--quiet', '--python', sys.executable, '--cache-dir', PACKAGE_CACHE_DIR, venv_dir]
+    else:
+        # pip в окружение не ставится: пакеты в него ставит pip хоста через --python
+        args = [sys.executable, '-m', 'venv', '--without-pip', venv_dir]
+    return await run_install_command(args, os.path.dirname(venv_dir))
+
+# Функция для получения папки шаблонного окружения текущего интерпретатора и списка пакетов
+def get_venv_template_root() -> str:
+    key = f"{sys.executable}|{sys.version}|{','.join(PROJECT_VENV_PACKAGES)}"
+    return f"{VENV_TEMPLATE_DIR}-{hashlib.sha1(key.encode()).hexdigest()[:12]}"
+
+venv_template_lock = asyncio.Lock()
+
+# Функция для сборки шаблонного окружения: пакеты ставятся один раз, а не в каждое новое окружение
+async def ensure_venv_template() -> tuple[bool, str]:
+    root = get_venv_template_root()
+    ready_marker = os.path.join(root, '.ready')
+    async with venv_template_lock:
+        if os.path.exists(ready_marker):
+            return True, ""
+        # Недособранный шаблон от прерванной сборки собираем заново
+        await asyncio.to_thread(shutil.rmtree, root, True)
+        os.makedirs(root)
+        created, output = await create_venv(os.path.join(root, PROJECT_VENV_DIR))
+        if created and PROJECT_VENV_PACKAGES:
+            created, output = await pip_install(root, *PROJECT_VENV_PACKAGES)
+        if not created:
+            await asyncio.to_thread(shutil.rmtree, root, True)
+            return False, output
+        open(ready_marker, 'w').close()
+        logger.info(f"✅ Шаблонное окружение проектов собрано: {root}")
+        return True, output
+
+# Функция для копирования шаблонного окружения жёсткими ссылками
+def link_venv_template(template_dir: str, venv_dir: str):
+    def link(source, target):
+        try:
+            os.link(source, target)
+        except OSError:
+            # Шаблон на другой файловой системе
+            shutil.copy2(source, target)
+    
+    shutil.copytree(template_dir, venv_dir, symlinks=True, copy_function=link)
+    # Скрипты и pyvenv.cfg содержат путь к окружению: их переписываем в новые файлы, не трогая шаблон
+    old, new = template_dir.encode(), venv_dir.encode()
+    paths = [os.path.join(venv_dir, 'pyvenv.cfg')]
+    for scripts in ('bin', 'Scripts'):
+        scripts_dir = os.path.join(venv_dir, scripts)
+        if os.path.isdir(scripts_dir):
+            paths += [os.path.join(scripts_dir, name) for name in os.listdir(scripts_dir)]
+    for path in paths:
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            content = f.read()
+        if old not in content:
+            continue
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(content.replace(old, new))
+        shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+
+# Функция для создания окружения проекта, если окружения включены и его ещё нет
+async def ensure_project_venv(project_dir: str) -> tuple[bool, str]:
+    if not PROJECT_VENVS or get_project_python(project_dir) != sys.executable:
+        return True, ""
+    venv_dir = os.path.join(project_dir, PROJECT_VENV_DIR)
+    created, output = await ensure_venv_template()
+    if created:
+        # Недособранное окружение не должно подхватиться при запуске
+        await asyncio.to_thread(shutil.rmtree, venv_dir, True)
+        try:
+            template_dir = os.path.join(get_venv_template_root(), PROJECT_VENV_DIR)
+            await asyncio.to_thread(link_venv_template, template_dir, venv_dir)
+        except OSError as e:
+            created, output = False, str(e)
+    if not created:
+        await asyncio.to_thread(shutil.rmtree, venv_dir, True)
+        return False, output
+    logger.info(f"✅ Окружение проекта создано: {venv_dir}")
+    return True, output
+
+# Функция для установки пакетов в окружение проекта (или в окружение хоста, если окружения выключены)
+async def pip_install(project_dir: str, *args) -> tuple[bool, str]:
+    python = get_project_python(project_dir)
+    uv = shutil.which('uv') if PROJECT_VENV_USE_UV else None
+    if uv and python != sys.executable:
+        command = [uv, 'pip', 'install', '--python', python, '--cache-dir', PACKAGE_CACHE_DIR, '--link-mode', 'hardlink', *args]
+    else:
+        command = [sys.executable, '-m', 'pip']
+        if python != sys.executable:
+            command += ['--python', python]
+        command += ['install', '--disable-pip-version-check', '--cache-dir', PACKAGE_CACHE_DIR, *args]
+    return await run_install_command(command, project_dir)
+
+# Функция для установки зависимостей проекта из его requirements.txt (окружение создаётся при необходимости)
+async def install_project_requirements(project_dir: str) -> tuple[bool, str]:
+    ready, output = await ensure_project_venv(project_dir)
+    if not ready or not os.path.exists(os.path.join(project_dir, 'requirements.txt')):
+        return ready, output
+    return await pip_install(project_dir, '-r', 'requirements.txt')
+
 # Функция для мониторинга вывода процесса
-async def monitor_process_output(process, project_id):
+async def monitor_process_output(process_info, project_id):
+    """Одновременно читает stdout и stderr процесса до EOF обоих потоков"""
+    process = process_info['process']
+    streams = []
+    if process.stdout:
+        streams.append(pump_process_stream(process.stdout, project_id, "", process_info))
+    if process.stderr:
+        streams.append(pump_process_stream(process.stderr, project_id, "[stderr] ", process_info))
+    results = await asyncio.gather(*streams, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка чтения вывода процесса {process.pid}: {result}")
+
+async def pump_process_stream(stream, project_id, tag, process_info):
+    """Перекачивает поток вывода в журнал проекта, разбивая слишком длинные строки"""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ""
+    while True:
+        chunk = await stream.read(PROCESS_OUTPUT_CHUNK_SIZE)
+        if chunk:
+            process_info['last_output'] = datetime.now()
+        text = decoder.decode(chunk, final=not chunk)
+        pending += text
+        *lines, pending = pending.split("\n")
+        if len(pending) > PROCESS_OUTPUT_MAX_LINE:
+            cut = len(pending) - len(pending) % PROCESS_OUTPUT_MAX_LINE
+            lines.append(pending[:cut])
+            pending = pending[cut:]
+        for line in lines:
+            for start in range(0, len(line), PROCESS_OUTPUT_MAX_LINE):
+                piece = line[start:start + PROCESS_OUTPUT_MAX_LINE].strip()
+                if piece:
+                    await append_project_log(project_id, f"{tag}{piece}")
+        if not chunk:
+            break
+    if pending.strip():
+        await append_project_log(project_id, f"{tag}{pending.strip()}")
+
+# Функция для чтения /proc/<pid>/stat: (состояние, родитель, группа, такты CPU, потоки, RSS в страницах, момент старта)
+def read_proc_stat(pid):
     try:
-        while process.returncode is None:
-            if process.stdout:
-                line = await process.stdout.readline()
-                if line:
-                    decoded = line.decode('utf-8', errors='ignore').strip()
-                    if decoded:
-                        log_entry = f"[{datetime.now().strftime('%H:%M:%S')}] {decoded}\n"
-                        project = await get_project_by_id(project_id)
-                        if project:
-                            current_logs = project['logs'] + log_entry
-                            if len(current_logs) > 10000:
-                                current_logs = current_logs[-10000:]
-                            await update_project(project_id, logs=current_logs)
-            await asyncio.sleep(0.1)
-    except Exception as e:
-        logger.error(f"Ошибка чтения вывода процесса {process.pid}: {e}")
+        with open(f'/proc/{pid}/stat') as f:
+            data = f.read()
+    except OSError:
+        return None
+    # Имя процесса в скобках может содержать пробелы, поэтому разбираем всё после последней ')'
+    fields = data[data.rindex(')') + 2:].split()
+    return (
+        fields[0], int(fields[1]), int(fields[2]), int(fields[11]) + int(fields[12]),
+        int(fields[17]), int(fields[21]), int(fields[19])
+    )
 
-# Функция для ожидания завершения процесса
-async def wait_for_process(process, project_id, user_id, project_name):
-    global running_count
+# Функция для получения отпечатка запуска процесса: он отличает процесс от другого, получившего тот же PID
+def read_process_start(pid):
+    stat = read_proc_stat(pid)
+    if stat is None or stat[0] == 'Z':
+        return None
     try:
-        await process.wait()
-        returncode = process.returncode
-        
-        project = await get_project_by_id(project_id)
-        if project:
-            project['is_running'] = False
-            project['process'] = None
-            running_count = max(0, running_count - 1)
-            log_entry = f"[{datetime.now().strftime('%H:%M:%S')}] Процесс завершён с кодом: {returncode}\n"
-            await update_project(project_id, is_running=False, logs=project['logs'] + log_entry, process_id=None)
-            active_processes.pop(project_id, None)
-            
-            # Авто-рестарт если включен
-            if project['auto_restart'] and returncode != 0:
-                logger.info(f"🔄 Авто-рестарт проекта {project_name}")
-                await asyncio.sleep(5)  # Ждем 5 секунд перед рестартом
-                await restart_project(project_id, user_id, project_name)
-            else:
-                try:
-                    status_text = "успешно завершён" if returncode == 0 else f"завершён с ошибкой (код: {returncode})"
-                    await bot.send_message(user_id, f"📋 Проект '{project_name}' {status_text}.")
-                except Exception as e:
-                    logger.error(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
-            
-            # Сохраняем состояние
-            save_bot_state()
-            
-    except Exception as e:
-        logger.error(f"Ошибка ожидания процесса: {e}")
-        project = await get_project_by_id(project_id)
-        if project:
-            await update_project(project_id, is_running=False, logs=f"{project['logs']}\n[{datetime.now().strftime('%H:%M:%S')}] Ошибка ожидания процесса: {str(e)}", process_id=None)
-        active_processes.pop(project_id, None)
-        running_count = max(0, running_count - 1)
-        
-        # Сохраняем состояние
-        save_bot_state()
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            boot_id = f.read().strip()
+    except OSError:
+        boot_id = ''
+    return f"{boot_id}:{stat[6]}"
 
-# Функция для авто-рестарта проекта
-async def restart_project(project_id, user_id, project_name):
-    global running_count
-    
-    if running_count >= MAX_CONCURRENT_BOTS:
-        logger.warning(f"❌ Не могу перезапустить {project_name} - достигнут лимит ботов")
+# Функция для чтения /proc/<pid>/stat всех живых процессов хоста за один проход
+def scan_processes():
+    stats = {}
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return stats
+    for name in names:
+        if name.isdigit():
+            stat = read_proc_stat(int(name))
+            if stat and stat[0] != 'Z':
+                stats[int(name)] = stat
+    return stats
+
+# Функция для проверки, жив ли процесс (зомби считаются завершёнными)
+def is_process_alive(pid):
+    stat = read_proc_stat(pid)
+    return stat is not None and stat[0] != 'Z'
+
+# Функция для поиска живых процессов группы и всех потомков процесса
+def find_process_tree(pgid, root_pid=None, stats=None):
+    """Возвращает PID живых процессов группы pgid и потомков root_pid, в том числе ушедших в свою сессию"""
+    if stats is None:
+        stats = scan_processes()
+    tree = {pid for pid, stat in stats.items() if stat[2] == pgid}
+    if root_pid is not None and root_pid in stats:
+        tree.add(root_pid)
+    children = {}
+    for pid, stat in stats.items():
+        children.setdefault(stat[1], []).append(pid)
+    stack = list(tree)
+    while stack:
+        for child in children.get(stack.pop(), ()):
+            if child not in tree:
+                tree.add(child)
+                stack.append(child)
+    return tree
+
+# Общий снимок /proc: одновременные остановки проектов используют один проход в отдельном потоке вместо своего на каждый
+class ProcessTable:
+    """Отдаёт свежий снимок scan_processes(), не блокируя цикл событий; параллельные запросы ждут один и тот же проход"""
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._stats = None
+        self._time = None  # когда начат проход, давший текущий снимок
+        self._scan = None
+        self._scan_started = None
+
+    async def snapshot(self, fresh=False):
+        """Снимок не старше max_age; fresh — начатый уже после вызова (например, когда процесс только что завершился)"""
+        loop = asyncio.get_running_loop()
+        since = loop.time() if fresh else loop.time() - self.max_age
+        if self._stats is not None and self._time >= since:
+            return self._stats
+        if self._scan is None or self._scan_started < since:
+            self._scan_started = loop.time()
+            self._scan = asyncio.ensure_future(self._refresh(self._scan_started))
+        return await asyncio.shield(self._scan)
+
+    async def _refresh(self, started):
         try:
-            await bot.send_message(user_id, f"❌ Не удалось перезапустить '{project_name}' - достигнут лимит ботов.")
-        except:
-            pass
-        return
-    
-    project = await get_project_by_id(project_id)
-    if not project or not project['file_path'] or not os.path.exists(project['file_path']):
-        return
-    
+            stats = await asyncio.to_thread(scan_processes)
+            if self._time is None or started >= self._time:
+                self._stats, self._time = stats, started
+            return stats
+        finally:
+            if self._scan_started == started:
+                self._scan = None
+
+    async def find_tree(self, pgid, root_pid=None, fresh=False):
+        return find_process_tree(pgid, root_pid, await self.snapshot(fresh))
+
+process_table = ProcessTable(PROCESS_SCAN_MAX_AGE)
+
+# Функция для отправки сигнала группе процессов и отдельным потомкам вне её
+def signal_process_tree(pgid, pids, sig):
     try:
-        project_dir = os.path.dirname(project['file_path'])
-        script_name = os.path.basename(project['file_path'])
-        
-        process = await asyncio.create_subprocess_exec(
-            sys.executable, script_name,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            cwd=project_dir
-        )
-        
-        process_info = {
-            'process': process,
-            'user_id': user_id,
-            'project_name': project_name,
-            'start_time': datetime.now()
-        }
-        
-        active_processes[project_id] = process_info
-        project['process'] = process_info
-        project['is_running'] = True
-        running_count += 1
-        project['logs'] += f"[{datetime.now().strftime('%H:%M:%S')}] 🔄 Процесс перезапущен: PID {process.pid}\n"
-        await update_project(project_id, is_running=True, logs=project['logs'], process_id=process.pid)
-        
-        # Сохраняем состояние
-        save_bot_state()
-        
-        asyncio.create_task(monitor_process_output(process, project_id))
-        asyncio.create_task(wait_for_process(process, project_id, user_id, project_name))
-        
-        logger.info(f"✅ Проект {project_name} перезапущен")
-        
-    except Exception as e:
-        logger.error(f"❌ Ошибка при перезапуске проекта {project_name}: {e}")
+        os.killpg(pgid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+    for pid in pids:
         try:
-            await bot.send_message(user_id, f"❌ Ошибка при перезапуске '{project_name}': {str(e)}")
-        except:
+            os.kill(pid, sig)
+        except (ProcessLookupError, PermissionError):
             pass
 
-# Хэндлер для "Остановить"
-@dp.callback_query(lambda c: c.data.startswith("stop_"))
-async def stop_project(callback: CallbackQuery):
-    global running_count
-    project_name = callback.data.replace("stop_", "")
-    user_id = callback.from_user.id
-    await update_user_activity(user_id)
-    project = await get_project_by_name(user_id, project_name)
-    if not project:
-        await callback.message.answer("❌ Проект не найден.")
-        await callback.answer()
-        return
-    if not project['is_running']:
-        await callback.message.answer("⚠️ Проект уже остановлен.")
-        await callback.answer()
-        return
-    if project.get('process'):
+# Функция для получения путей файлов вывода отсоединённого проекта
+def get_output_paths(project_id):
+    return (
+        os.path.join(OUTPUT_DIR, f'project_{project_id}.out'),
+        os.path.join(OUTPUT_DIR, f'project_{project_id}.err'),
+    )
+
+# Функция для удаления файлов вывода проекта
+def remove_project_output(project_id):
+    for path in get_output_paths(project_id):
         try:
-            process_info = project['process']
-            if process_info and process_info['process'] and process_info['process'].poll() is None:
-                if os.name == 'nt':  # Windows
-                    process_info['process'].terminate()
-                else:  # Unix-like
-                    os.kill(process_info['process'].pid, signal.SIGTERM)
-                try:
-                    await asyncio.wait_for(process_info['process'].wait(), timeout=5)
-                except asyncio.TimeoutError:
-                    process_info['process'].kill()
-                    await process_info['process'].wait()
-        except Exception as e:
-            logger.error(f"Ошибка остановки процесса: {e}")
-        active_processes.pop(project['id'], None)
-        project['is_running'] = False
-        project['process'] = None
-        project['logs'] += f"[{datetime.now().strftime('%H:%M:%S')}] Процесс остановлен пользователем.\n"
-        running_count = max(0, running_count - 1)
-        await update_project(project['id'], is_running=False, logs=project['logs'], process_id=None)
-        
-        # Сохраняем состояние
-        save_bot_state()
-        
-    text, keyboard = await get_project_menu(project_name, user_id)
-    await callback.message.edit_text(text, reply_markup=keyboard)
-    await callback.answer()
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Ошибка удаления файла вывода {path}: {e}")
 
-# Хэндлер для "Логи"
+# Дочитывание файла вывода отсоединённого процесса
+class OutputTail:
+    """Читает файл, который дописывает процесс, как поток: read() ждёт новых данных, пока процесс жив"""
+
+    def __init__(self, path, process, offset=None):
+        self.path = path
+        self.process = process
+        # Без сохранённой позиции читаем только то, что будет написано дальше
+        self.offset = offset if offset is not None else self._size()
+        self._file = None
+
+    def _size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def _read_chunk(self, size):
+        try:
+            if self._file is None:
+                self._file = open(self.path, 'rb')
+            file_size = os.fstat(self._file.fileno()).st_size
+            if file_size < self.offset:
+                # Файл обнулили: начинаем с начала
+                self.offset = 0
+            elif file_size >= PROJECT_OUTPUT_MAX_SIZE and self.offset >= file_size:
+                # Всё прочитано, а файл разросся: обнуляем его, процесс пишет с O_APPEND и продолжит с начала
+                os.truncate(self.path, 0)
+                self.offset = 0
+                return b''
+            self._file.seek(self.offset)
+            data = self._file.read(size)
+        except OSError:
+            return b''
+        self.offset += len(data)
+        return data
+
+    async def read(self, size):
+        while True:
+            chunk = self._read_chunk(size)
+            if chunk:
+                return chunk
+            if self.process.returncode is not None:
+                # Процесс завершился: отдаём остаток файла, затем конец потока
+                chunk = self._read_chunk(size)
+                if not chunk and self._file:
+                    self._file.close()
+                    self._file = None
+                return chunk
+            await asyncio.sleep(OUTPUT_TAIL_INTERVAL)
+
+# Процесс проекта, не привязанный к жизни хоста
+class DetachedProcess:
+    """Процесс, переживающий перезапуск хоста: запущен с выводом в файлы или подхвачен по PID после перезапуска"""
+
+    def __init__(self, pid, start_token, popen=None, project_id=None, offsets=(None, None), exit_status=None, gate=None):
+        self.pid = pid
+        self.start_token = start_token
+        self.popen = popen
+        # Для процесса из форк-сервера: задача с кодом завершения (None — связь с сервером потеряна)
+        self.exit_status = exit_status
+        self._gate = gate
+        self.forked = exit_status is not None
+        # Код завершения подхваченного процесса узнать нельзя: его родитель теперь init
+        self.adopted = popen is None and exit_status is None
+        self._returncode = None
+        stdout_path, stderr_path = get_output_paths(project_id)
+        self.stdout = OutputTail(stdout_path, self, offsets[0])
+        self.stderr = OutputTail(stderr_path, self, offsets[1])
+
+    @classmethod
+    def spawn(cls, args, cwd, project_id):
+        stdout_path, stderr_path = get_output_paths(project_id)
+        # Позиции чтения фиксируются до запуска, чтобы не потерять первые строки вывода
+        offsets = tuple(os.path.getsize(path) if os.path.exists(path) else 0 for path in (stdout_path, stderr_path))
+        with open(stdout_path, 'ab') as stdout, open(stderr_path, 'ab') as stderr:
+            popen = subprocess.Popen(
+                args, cwd=cwd, stdin=subprocess.DEVNULL, stdout=stdout, stderr=stderr, start_new_session=True
+            )
+        return cls(popen.pid, read_process_start(popen.pid), popen, project_id, offsets)
+
+    @property
+    def output_offsets(self):
+        return self.stdout.offset, self.stderr.offset
+
+    def resume(self):
+        """Разрешает форкнутому процессу выполнять скрипт, когда к нему уже применены лимиты"""
+        if self._gate is not None:
+            self._gate.write(b'go\n')
+            self._gate = None
+
+    @property
+    def returncode(self):
+        if self._returncode is None:
+            if self.popen is not None:
+                self._returncode = self.popen.poll()
+            elif self.forked and not self.exit_status.done():
+                # Код завершения ещё сообщит форк-сервер
+                return None
+            elif self.forked and self.exit_status.result() is not None:
+                self._returncode = self.exit_status.result()
+            elif read_process_start(self.pid) != self.start_token:
+                self._returncode = -1
+        return self._returncode
+
+    async def wait(self):
+        """Ждёт завершения через pidfd, а где его нет — опросом /proc"""
+        if self.exit_status is not None:
+            # Форкнутый процесс — потомок форк-сервера, его код завершения приходит по соединению с сервером
+            await asyncio.shield(self.exit_status)
+        try:
+            pidfd = os.pidfd_open(self.pid)
+        except (AttributeError, OSError):
+            pidfd = None
+        loop = asyncio.get_running_loop()
+        try:
+            while self.returncode is None:
+                if pidfd is None:
+                    await asyncio.sleep(OUTPUT_TAIL_INTERVAL)
+                    continue
+                exited = loop.create_future()
+                loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+                try:
+                    await asyncio.wait_for(exited, timeout=5)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    loop.remove_reader(pidfd)
+        finally:
+            if pidfd is not None:
+                os.close(pidfd)
+        return self._returncode
+
+# Код прогретого интерпретатора: импортирует тяжёлые модули один раз и форкает из себя процессы проектов
+FORKSERVER_SOURCE = r'''
+import json, os, selectors, signal, socket, sys
+
+path, preload = sys.argv[1], sys.argv[2:]
+for name in preload:
+    try:
+        __import__(name)
+    except Exception:
+        pass
+
+parent = os.getppid()
+server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+server.bind(path)
+os.chmod(path, 0o600)
+server.listen(64)
+wakeup_r, wakeup_w = os.pipe()
+os.set_blocking(wakeup_w, False)
+signal.set_wakeup_fd(wakeup_w)
+signal.signal(signal.SIGCHLD, lambda *args: None)
+selector = selectors.DefaultSelector()
+selector.register(server, selectors.EVENT_READ)
+selector.register(wakeup_r, selectors.EVENT_READ)
+# pid -> [соединение с хостом, конец канала, которым форк удерживается до применения лимитов]
+children = {}
+
+
+def send(connection, message):
+    try:
+        connection.sendall(json.dumps(message).encode() + b'\n')
+    except OSError:
+        pass
+
+
+def fork_child(connection):
+    data, fds, _, _ = socket.recv_fds(connection, 1 << 20, 2)
+    if len(fds) != 2:
+        raise ValueError('expected stdout and stderr descriptors')
+    request = json.loads(data)
+    gate_r, gate_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(gate_w)
+        for other, other_gate in children.values():
+            if other is not None:
+                other.close()
+            if other_gate is not None:
+                os.close(other_gate)
+        connection.close()
+        return request, fds, gate_r
+    os.close(gate_r)
+    for fd in fds:
+        os.close(fd)
+    children[pid] = [connection, gate_w]
+    send(connection, {'pid': pid})
+    selector.register(connection, selectors.EVENT_READ, pid)
+    return None
+
+
+def release(pid):
+    connection, gate_w = children[pid]
+    try:
+        data = connection.recv(64)
+    except OSError:
+        data = b''
+    selector.unregister(connection)
+    if gate_w is not None:
+        if not data:
+            # Хост пропал до применения лимитов: без них процесс не запускаем
+            os.kill(pid, signal.SIGKILL)
+        os.close(gate_w)
+        children[pid][1] = None
+    if not data:
+        connection.close()
+        children[pid][0] = None
+
+
+def reap():
+    while children:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+        connection, gate_w = children.pop(pid, (None, None))
+        if gate_w is not None:
+            os.close(gate_w)
+        if connection is not None:
+            try:
+                selector.unregister(connection)
+            except KeyError:
+                pass
+            send(connection, {'exit': os.waitstatus_to_exitcode(status)})
+            connection.close()
+
+
+def serve():
+    while os.getppid() == parent:
+        for key, _ in selector.select(timeout=1):
+            if key.fileobj is server:
+                connection, _ = server.accept()
+                try:
+                    child = fork_child(connection)
+                except (OSError, ValueError) as e:
+                    send(connection, {'error': str(e)})
+                    connection.close()
+                    continue
+                if child:
+                    return child
+            elif key.fileobj == wakeup_r:
+                os.read(wakeup_r, 4096)
+            else:
+                release(key.data)
+        reap()
+    sys.exit(0)
+
+
+request, fds, gate = serve()
+# Дальше выполняется только форкнутый процесс проекта
+selector.close()
+server.close()
+signal.set_wakeup_fd(-1)
+signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+os.close(wakeup_r)
+os.close(wakeup_w)
+os.setsid()
+devnull = os.open(os.devnull, os.O_RDONLY)
+os.dup2(devnull, 0)
+os.dup2(fds[0], 1)
+os.dup2(fds[1], 2)
+for fd in (devnull, *fds):
+    os.close(fd)
+os.chdir(request['cwd'])
+os.environ.clear()
+os.environ.update(request['env'])
+# Ждём, пока хост применит лимиты: сервер закроет канал по его команде
+os.read(gate, 1)
+os.close(gate)
+del children, selector, server, fds, gate
+sys.argv = [request['script']]
+sys.path[0] = request['cwd']
+import runpy
+runpy.run_path(request['script'], run_name='__main__')
+'''
+
+
+# Функция для проверки, можно ли запускать скрипт форком прогретого интерпретатора
+def can_fork_project(file_path: str) -> bool:
+    try:
+        with open(file_path, encoding='utf-8', errors='ignore') as f:
+            return FORKSERVER_OPT_OUT_MARKER not in f.read(4096)
+    except OSError:
+        return False
+
+
+# Прогретый интерпретатор для быстрого запуска проектов
+class ForkServer:
+    """Держит процесс Python с заранее импортированными модулями и запускает проекты форком из него"""
+
+    def __init__(self, python, path, preload):
+        self.python = python
+        self.path = path
+        self.preload = preload
+        self.process = None
+
+    @property
+    def enabled(self):
+        return self.process is not None
+
+    def start(self):
+        if self.process is not None and self.process.poll() is None:
+            return
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.process = subprocess.Popen(
+            [self.python, '-c', FORKSERVER_SOURCE, self.path, *self.preload],
+            stdin=subprocess.DEVNULL, start_new_session=True
+        )
+        logger.info(f"🔥 Форк-сервер запущен для {self.python}: PID {self.process.pid}")
+
+    async def fork(self, script_name, cwd, project_id):
+        """Запускает скрипт форком прогретого интерпретатора. None, если сервер недоступен — тогда запускают обычно"""
+        if self.process.poll() is not None:
+            logger.warning(f"⚠️ Форк-сервер завершился с кодом {self.process.returncode}, перезапускаем")
+            self.start()
+            return None
+        if not os.path.exists(self.path):
+            # Ещё импортирует модули
+            return None
+        stdout_path, stderr_path = get_output_paths(project_id)
+        offsets = tuple(os.path.getsize(path) if os.path.exists(path) else 0 for path in (stdout_path, stderr_path))
+        request = {'script': script_name, 'cwd': cwd, 'env': dict(os.environ)}
+        try:
+            with open(stdout_path, 'ab') as stdout, open(stderr_path, 'ab') as stderr:
+                sock, pid = await asyncio.to_thread(self._request, request, [stdout.fileno(), stderr.fileno()])
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"⚠️ Форк-сервер не запустил проект {project_id}: {e}")
+            return None
+        reader, writer = await asyncio.open_unix_connection(sock=sock)
+        return DetachedProcess(
+            pid, read_process_start(pid), project_id=project_id, offsets=offsets,
+            exit_status=asyncio.create_task(self._read_exit(reader, writer)), gate=writer
+        )
+
+    def _request(self, request, fds):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(10)
+            sock.connect(self.path)
+            socket.send_fds(sock, [json.dumps(request).encode()], fds)
+            response = b''
+            while not response.endswith(b'\n'):
+                chunk = sock.recv(4096)
+                if not chunk:
+                    raise ConnectionError("форк-сервер закрыл соединение")
+                response += chunk
+            message = json.loads(response)
+            if 'error' in message:
+                raise ValueError(message['error'])
+            sock.setblocking(False)
+            return sock, message['pid']
+        except BaseException:
+            sock.close()
+            raise
+
+    @staticmethod
+    async def _read_exit(reader, writer):
+        """Код завершения от форк-сервера или None, если связь с ним потеряна"""
+        try:
+            line = await reader.readline()
+            return json.loads(line)['exit'] if line else None
+        except (ConnectionError, ValueError, KeyError):
+            return None
+        finally:
+            writer.close()
+
+    def close(self):
+        """Останавливает прогретый интерпретатор; запущенные из него проекты продолжают работать"""
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+# Прогретые интерпретаторы всех окружений
+class ForkServerPool:
+    """Держит по форк-серверу на интерпретатор: модули прогреваются из того же окружения, в котором работает проект"""
+
+    def __init__(self, preload):
+        self.preload = preload
+        self.servers = {}  # интерпретатор -> ForkServer, недавно использованные в конце
+        self.enabled = False
+
+    def start(self):
+        self.enabled = True
+        # Интерпретатор хоста нужен проектам без окружения, его прогреваем сразу
+        self._get(sys.executable)
+
+    def _get(self, python):
+        server = self.servers.pop(python, None)
+        if server is None:
+            digest = hashlib.sha1(python.encode()).hexdigest()[:12]
+            server = ForkServer(python, FORKSERVER_SOCKET.format(digest), self.preload)
+            # Окружение первого запуска прогревается в фоне, а сам запуск идёт обычным путём
+            server.start()
+        self.servers[python] = server
+        for stale in [name for name in self.servers if not os.path.exists(name)]:
+            # Окружение удалено вместе с проектом
+            self.servers.pop(stale).close()
+        while len(self.servers) > FORKSERVER_MAX_SERVERS:
+            self.servers.pop(next(iter(self.servers))).close()
+        return server
+
+    async def fork(self, python, script_name, cwd, project_id):
+        """Запускает скрипт форком интерпретатора окружения. None — запускать обычно"""
+        return await self._get(python).fork(script_name, cwd, project_id)
+
+    def close(self):
+        """Останавливает все прогретые интерпретаторы; запущенные из них проекты продолжают работать"""
+        self.enabled = False
+        for server in self.servers.values():
+            server.close()
+        self.servers = {}
+
+forkserver = ForkServerPool(FORKSERVER_PRELOAD)
+
+# Сбор статистики потребления ресурсов проектами
+class ProcessSampler:
+    """Периодически читает /proc и хранит кольцевой буфер CPU %, RSS, потоков и открытых файлов каждого проекта"""
+
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+    def __init__(self, interval, history_size):
+        self.interval = interval
+        self.history_size = history_size
+        # project_id -> deque[(время, CPU %, RSS в байтах, потоки, файлы, процессы)]
+        self.samples = {}
+        self._ticks = {}  # project_id -> {pid: такты CPU} на момент прошлого замера
+        self._progress = {}  # project_id -> время цикла событий, когда проект последний раз расходовал CPU
+        self._last_time = None
+        self._task = None
+
+    def start(self):
+        if not os.path.isdir('/proc'):
+            logger.warning("/proc недоступен, статистика потребления ресурсов проектами не собирается")
+            return
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def forget(self, project_id):
+        self.samples.pop(project_id, None)
+        self._ticks.pop(project_id, None)
+        self._progress.pop(project_id, None)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sample()
+            except Exception as e:
+                logger.error(f"Ошибка сбора статистики процессов: {e}")
+
+    @classmethod
+    def _measure(cls, roots):
+        # Один проход по /proc на все проекты; выполняется в отдельном потоке
+        stats = scan_processes()
+        result = {}
+        for project_id, pid in roots.items():
+            ticks, rss, threads, fds = {}, 0, 0, 0
+            for member in find_process_tree(pid, pid, stats):
+                stat = stats[member]
+                ticks[member] = stat[3]
+                rss += stat[5] * cls.PAGE_SIZE
+                threads += stat[4]
+                try:
+                    fds += len(os.listdir(f'/proc/{member}/fd'))
+                except OSError:
+                    pass
+            if ticks:
+                result[project_id] = (ticks, rss, threads, fds)
+        return result
+
+    async def sample(self):
+        """Делает один замер всех запущенных проектов"""
+        roots = {
+            project_id: info['process'].pid
+            for project_id, info in active_processes.items()
+            if info['process'].returncode is None
+        }
+        now = asyncio.get_running_loop().time()
+        measurements = await asyncio.to_thread(self._measure, roots)
+        elapsed = now - self._last_time if self._last_time is not None else None
+        self._last_time = now
+        
+        for project_id, (ticks, rss, threads, fds) in measurements.items():
+            previous = self._ticks.get(project_id)
+            cpu = None
+            if previous is not None and elapsed:
+                # Процессы, появившиеся после прошлого замера, считаем с нуля
+                delta = sum(max(0, value - previous.get(pid, 0)) for pid, value in ticks.items())
+                cpu = delta / self.CLOCK_TICKS / elapsed * 100
+            if previous is None or cpu:
+                self._progress[project_id] = now
+            self._ticks[project_id] = ticks
+            history = self.samples.setdefault(project_id, deque(maxlen=self.history_size))
+            history.append((datetime.now(), cpu, rss, threads, fds, len(ticks)))
+        # Замеры остановленных проектов остаются как их последний известный след, такты — нет
+        for project_id in list(self._ticks):
+            if project_id not in measurements:
+                del self._ticks[project_id]
+                self._progress.pop(project_id, None)
+
+    def idle_for(self, project_id):
+        """Сколько секунд процессы проекта не расходуют CPU, или None, если замеров ещё нет"""
+        if project_id not in self._progress:
+            return None
+        return asyncio.get_running_loop().time() - self._progress[project_id]
+
+    def summary(self, project_id, running_only=True):
+        """Последний замер проекта со средним и пиковым CPU и RSS по буферу"""
+        history = self.samples.get(project_id)
+        if not history or (running_only and project_id not in self._ticks):
+            return None
+        cpu_values = [sample[1] for sample in history if sample[1] is not None]
+        _, cpu, rss, threads, fds, processes = history[-1]
+        return {
+            'cpu': cpu,
+            'cpu_avg': sum(cpu_values) / len(cpu_values) if cpu_values else None,
+            'cpu_peak': max(cpu_values) if cpu_values else None,
+            'rss': rss,
+            'rss_peak': max(sample[2] for sample in history),
+            'threads': threads,
+            'fds': fds,
+            'processes': processes,
+        }
+
+    def host_totals(self):
+        """Суммарное потребление всех запущенных проектов по последним замерам"""
+        totals = {'cpu': 0.0, 'rss': 0, 'threads': 0, 'fds': 0, 'processes': 0, 'projects': 0}
+        for project_id in self._ticks:
+            summary = self.summary(project_id)
+            if not summary:
+                continue
+            totals['cpu'] += summary['cpu'] or 0.0
+            for key in ('rss', 'threads', 'fds', 'processes'):
+                totals[key] += summary[key]
+            totals['projects'] += 1
+        return totals
+
+    def cost(self, project_id):
+        return usage_cost(self.summary(project_id))
+
+process_sampler = ProcessSampler(SAMPLER_INTERVAL, SAMPLER_HISTORY_SIZE)
+
+# Функция для ключа сортировки «по стоимости»: средний CPU, затем память
+def usage_cost(usage) -> tuple:
+    if not usage:
+        return (0.0, 0)
+    return (usage['cpu_avg'] or 0.0, usage['rss'])
+
+# Ограничение ресурсов процессов проектов
+class ResourceLimiter:
+    """Применяет к процессу проекта rlimits и, если доступна cgroup v2, отдельную cgroup с memory.max, cpu.weight и pids.max"""
+
+    def __init__(self, cgroup_root):
+        self.cgroup_root = cgroup_root
+        self.cgroup_enabled = False
+        self._baselines = {}  # project_id -> счётчики событий cgroup на момент запуска
+
+    def setup(self):
+        """Проверяет, можно ли создавать cgroup проектов, и включает в них нужные контроллеры"""
+        parent = os.path.dirname(self.cgroup_root)
+        try:
+            with open(os.path.join(parent, 'cgroup.controllers')) as f:
+                available = set(f.read().split())
+            os.makedirs(self.cgroup_root, exist_ok=True)
+            controllers = [name for name in ('memory', 'cpu', 'pids') if name in available]
+            for path in (parent, self.cgroup_root):
+                with open(os.path.join(path, 'cgroup.subtree_control'), 'w') as f:
+                    f.write(' '.join(f'+{name}' for name in controllers))
+            self.cgroup_enabled = True
+            logger.info(f"✅ Лимиты проектов через cgroup v2 ({', '.join(controllers)}) в {self.cgroup_root}")
+        except OSError as e:
+            self.cgroup_enabled = False
+            logger.warning(f"cgroup v2 недоступна ({e}), лимиты памяти и числа процессов проектов не применяются")
+
+    def _cgroup_path(self, project_id):
+        return os.path.join(self.cgroup_root, f'project_{project_id}')
+
+    def _read_events(self, project_id):
+        events = {}
+        for name in ('memory.events', 'pids.events'):
+            try:
+                with open(os.path.join(self._cgroup_path(project_id), name)) as f:
+                    for line in f:
+                        key, value = line.split()
+                        events[f'{name}:{key}'] = int(value)
+            except OSError:
+                pass
+        return events
+
+    async def apply(self, project_id, pid, limits) -> list:
+        """Применяет лимиты к только что запущенному процессу; возвращает описание применённых ограничений"""
+        applied = []
+        in_cgroup = False
+        if self.cgroup_enabled:
+            # В cgroup переносится вся группа процессов: потомки, успевшие появиться до переноса, иначе остались бы вне лимитов
+            pids = await process_table.find_tree(pid, pid, fresh=True)
+            in_cgroup = self._apply_cgroup(project_id, pids or {pid}, limits, applied)
+        if not in_cgroup and (limits.get('memory_mb') or limits.get('processes')):
+            # RLIMIT_AS ломает многопоточных ботов, а RLIMIT_NPROC считает процессы всего пользователя хоста
+            logger.warning(f"⚠️ Проект {project_id}: лимиты памяти и числа процессов не применены — нет cgroup v2")
+        if resource is None:
+            return applied
+        
+        rlimits = []
+        if limits.get('cpu_seconds'):
+            rlimits.append((resource.RLIMIT_CPU, limits['cpu_seconds'], f"CPU {limits['cpu_seconds']} с"))
+        if limits.get('open_files'):
+            rlimits.append((resource.RLIMIT_NOFILE, limits['open_files'], f"файлов {limits['open_files']}"))
+        for limit, value, description in rlimits:
+            try:
+                _, hard = resource.prlimit(pid, limit)
+                if hard != resource.RLIM_INFINITY:
+                    value = min(value, hard)
+                # Для CPU жёсткий предел чуть выше мягкого: сначала SIGXCPU, затем SIGKILL
+                new_hard = value + 5 if limit == resource.RLIMIT_CPU and hard == resource.RLIM_INFINITY else value
+                resource.prlimit(pid, limit, (value, new_hard))
+                applied.append(description)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Не удалось применить лимит '{description}' к процессу {pid}: {e}")
+        return applied
+
+    def _apply_cgroup(self, project_id, pids, limits, applied) -> bool:
+        path = self._cgroup_path(project_id)
+        try:
+            os.makedirs(path, exist_ok=True)
+            memory_mb = limits.get('memory_mb')
+            settings = {
+                'memory.max': memory_mb * 1024 * 1024 if memory_mb else 'max',
+                # Без свопа лимит памяти нельзя обойти, выгрузив память на диск
+                'memory.swap.max': 0 if memory_mb else 'max',
+                'cpu.weight': limits.get('cpu_weight') or 100,
+                'pids.max': limits.get('processes') or 'max',
+            }
+            for name, value in settings.items():
+                if os.path.exists(os.path.join(path, name)):
+                    with open(os.path.join(path, name), 'w') as f:
+                        f.write(str(value))
+            if memory_mb:
+                applied.append(f"память {memory_mb} МБ (cgroup)")
+            if limits.get('cpu_weight'):
+                applied.append(f"вес CPU {limits['cpu_weight']}")
+            if limits.get('processes'):
+                applied.append(f"процессов {limits['processes']}")
+            # Ядро принимает в cgroup.procs один PID за запись
+            for pid in sorted(pids):
+                try:
+                    with open(os.path.join(path, 'cgroup.procs'), 'w') as f:
+                        f.write(str(pid))
+                except ProcessLookupError:
+                    pass
+            self._baselines[project_id] = self._read_events(project_id)
+            return True
+        except OSError as e:
+            logger.warning(f"Не удалось поместить проект {project_id} в cgroup: {e}")
+            return False
+
+    def adopt(self, project_id):
+        """Запоминает счётчики событий cgroup подхваченного процесса, чтобы распознать превышение лимитов"""
+        if self.cgroup_enabled and os.path.isdir(self._cgroup_path(project_id)):
+            self._baselines[project_id] = self._read_events(project_id)
+
+    def explain_exit(self, project_id, returncode):
+        """Определяет, завершился ли процесс из-за превышения лимита, и возвращает причину"""
+        reasons = []
+        if project_id in self._baselines:
+            before = self._baselines[project_id]
+            after = self._read_events(project_id)
+            grew = lambda key: after.get(key, 0) > before.get(key, 0)
+            if grew('memory.events:oom_kill'):
+                reasons.append("превышен лимит памяти, процесс убит OOM killer")
+            elif grew('memory.events:max'):
+                reasons.append("процесс упирался в лимит памяти")
+            if grew('pids.events:max'):
+                reasons.append("достигнут лимит числа процессов")
+        if not reasons and os.name != 'nt' and returncode == -signal.SIGXCPU:
+            reasons.append("превышен лимит процессорного времени")
+        return "; ".join(reasons) or None
+
+    def release(self, project_id):
+        """Удаляет cgroup проекта после завершения всех его процессов"""
+        self._baselines.pop(project_id, None)
+        if not self.cgroup_enabled:
+            return
+        try:
+            os.rmdir(self._cgroup_path(project_id))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Не удалось удалить cgroup проекта {project_id}: {e}")
+
+resource_limiter = ResourceLimiter(CGROUP_ROOT)
+
+# Политика авто-рестарта проектов
+class RestartPolicy:
+    """Перезапускает упавшие проекты с растущей задержкой и останавливает те, что падают в цикле"""
+
+    def __init__(self):
+        self.history = {}
+        self.failures = {}
+        self.parked = set()
+        self.pending = {}
+
+    def record_exit(self, project_id, returncode, uptime, auto_restart=True):
+        """Запоминает завершение процесса и возвращает задержку до рестарта или None, если рестарта не будет"""
+        now = datetime.now()
+        history = self.history.setdefault(project_id, [])
+        history.append({'time': now, 'returncode': returncode, 'uptime': uptime})
+        del history[:-max(RESTART_HISTORY_SIZE, CRASH_LOOP_MAX_FAILURES)]
+        # Без авто-рестарта падения не копятся: проект не перезапускается, значит и в цикле не падает
+        if returncode == 0 or not auto_restart:
+            self.failures.pop(project_id, None)
+            if not auto_restart:
+                self.parked.discard(project_id)
+            return None
+        
+        # Долго проработавший процесс считаем здоровым: его падение начинает отсчёт заново
+        failures = 1 if uptime >= RESTART_HEALTHY_UPTIME else self.failures.get(project_id, 0) + 1
+        self.failures[project_id] = failures
+        recent = [
+            entry for entry in history
+            if entry['returncode'] != 0 and (now - entry['time']).total_seconds() <= CRASH_LOOP_WINDOW
+        ]
+        if failures >= CRASH_LOOP_MAX_FAILURES and len(recent) >= CRASH_LOOP_MAX_FAILURES:
+            self.parked.add(project_id)
+            return None
+        
+        # Половина задержки фиксирована, половина случайна, чтобы упавшие вместе боты не рестартовали разом
+        delay = min(RESTART_BACKOFF_MAX, RESTART_BACKOFF_BASE * 2 ** (failures - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def schedule(self, project_id, user_id, project_name, delay):
+        self.cancel(project_id)
+        self.pending[project_id] = {
+            'time': datetime.now().timestamp() + delay,
+            'task': asyncio.create_task(self._restart_later(project_id, user_id, project_name, delay))
+        }
+
+    def cancel(self, project_id) -> bool:
+        """Отменяет запланированный рестарт; возвращает True, если он был"""
+        entry = self.pending.pop(project_id, None)
+        if not entry:
+            return False
+        entry['task'].cancel()
+        return True
+
+    def reset(self, project_id):
+        """Сбрасывает счётчик падений и снимает проект с паузы (ручной запуск или новый файл)"""
+        self.cancel(project_id)
+        self.failures.pop(project_id, None)
+        self.parked.discard(project_id)
+
+    def forget(self, project_id):
+        self.reset(project_id)
+        self.history.pop(project_id, None)
+
+    def close(self):
+        for project_id in list(self.pending):
+            self.cancel(project_id)
+
+    def restart_in(self, project_id):
+        entry = self.pending.get(project_id)
+        if not entry:
+            return None
+        return max(0, int(entry['time'] - datetime.now().timestamp()))
+
+    def get_history(self, project_id):
+        return self.history.get(project_id, [])[-RESTART_HISTORY_SIZE:]
+
+    async def _restart_later(self, project_id, user_id, project_name, delay):
+        await asyncio.sleep(delay)
+        self.pending.pop(project_id, None)
+        try:
+            project = await get_project_by_id(project_id)
+            if project and project['auto_restart'] and not project['is_running']:
+                await restart_project(project_id, user_id, project_name)
+        except Exception as e:
+            logger.error(f"Ошибка авто-рестарта проекта {project_name}: {e}")
+
+restart_policy = RestartPolicy()
+
+# Супервизор процессов проектов
+class ProcessSupervisor:
+    """Запускает процессы проектов, следит за их завершением и останавливает их без блокировки цикла событий"""
+
+    async def spawn(self, project_id, user_id, project_name, restarted=False):
+        project = await get_project_by_id(project_id)
+        if not project or not project['file_path'] or not os.path.exists(project['file_path']):
+            raise FileNotFoundError(f"Файл проекта '{project_name}' не найден")
+        
+        project_dir = os.path.dirname(project['file_path'])
+        script_name = os.path.basename(project['file_path'])
+        limits = await get_project_limits(project_id)
+        # Проект без своего окружения (созданный до их появления) работает на интерпретаторе хоста
+        python = get_project_python(project_dir)
+        
+        if DETACH_PROJECTS and os.name != 'nt':
+            process = None
+            if forkserver.enabled and can_fork_project(project['file_path']):
+                process = await forkserver.fork(python, script_name, project_dir, project_id)
+            if process is None:
+                # Процесс из asyncio убивается при закрытии цикла событий, поэтому отсоединённые запускаются через Popen
+                process = DetachedProcess.spawn([python, script_name], project_dir, project_id)
+        else:
+            process = await asyncio.create_subprocess_exec(
+                python, script_name,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=project_dir,
+                # Своя сессия и группа процессов, чтобы остановка задевала всех потомков бота
+                start_new_session=(os.name != 'nt')
+            )
+        # Лимиты применяются сразу после exec, пока интерпретатор ещё запускается и не породил потомков
+        applied_limits = await resource_limiter.apply(project_id, process.pid, limits)
+        forked = isinstance(process, DetachedProcess) and process.forked
+        if forked:
+            # Форкнутый процесс ждёт лимитов, прежде чем начать выполнять скрипт
+            process.resume()
+        
+        # Сохраняем информацию о процессе
+        process_info = {
+            'process': process,
+            'user_id': user_id,
+            'project_name': project_name,
+            'start_time': datetime.now(),
+            'stop_reason': None
+        }
+        active_processes[project_id] = process_info
+        if restarted:
+            await append_project_log(project_id, f"🔄 Процесс перезапущен: PID {process.pid}")
+        else:
+            await append_project_log(project_id, f"Процесс запущен: PID {process.pid}{' (форк прогретого интерпретатора)' if forked else ''}")
+        if applied_limits:
+            await append_project_log(project_id, f"Лимиты: {', '.join(applied_limits)}")
+        await update_project(project_id, is_running=True, process_id=process.pid)
+        
+        # Сохраняем состояние
+        save_bot_state()
+        
+        # Мониторинг вывода и завершения процесса
+        process_info['monitor'] = asyncio.create_task(monitor_process_output(process_info, project_id))
+        process_info['watcher'] = asyncio.create_task(self._watch(process, project_id, user_id, project_name))
+        
+        logger.info(f"✅ Проект {project_name} {'перезапущен' if restarted else 'запущен'}: PID {process.pid}")
+        return process
+
+    async def adopt(self, project_id, saved) -> bool:
+        """Подхватывает процесс проекта, переживший перезапуск хоста. False, если процесса нет или PID уже чужой"""
+        if not saved.get('start_token') or read_process_start(saved['pid']) != saved['start_token']:
+            return False
+        process = DetachedProcess(
+            saved['pid'], saved['start_token'], project_id=project_id,
+            offsets=saved.get('output_offsets') or (None, None)
+        )
+        process_info = {
+            'process': process,
+            'user_id': saved['user_id'],
+            'project_name': saved['project_name'],
+            'start_time': saved.get('start_time') or datetime.now(),
+            'stop_reason': None
+        }
+        active_processes[project_id] = process_info
+        resource_limiter.adopt(project_id)
+        await append_project_log(project_id, f"🔗 Процесс подхвачен после перезапуска хоста: PID {process.pid}")
+        await update_project(project_id, is_running=True, process_id=process.pid)
+        process_info['monitor'] = asyncio.create_task(monitor_process_output(process_info, project_id))
+        process_info['watcher'] = asyncio.create_task(
+            self._watch(process, project_id, saved['user_id'], saved['project_name'])
+        )
+        logger.info(f"🔗 Проект {saved['project_name']} подхвачен: PID {process.pid}")
+        return True
+
+    async def detach_all(self):
+        """Перестаёт следить за отсоединёнными процессами, не останавливая их (при завершении работы хоста)"""
+        tasks = []
+        for project_id, process_info in list(active_processes.items()):
+            if not isinstance(process_info['process'], DetachedProcess):
+                continue
+            for name in ('watcher', 'monitor'):
+                task = process_info.get(name)
+                if task:
+                    task.cancel()
+                    tasks.append(task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def stop(self, project_id, reason=None) -> bool:
+        """Останавливает процесс проекта (SIGTERM, затем SIGKILL) и ждёт обновления его состояния"""
+        process_info = active_processes.get(project_id)
+        if not process_info:
+            return False
+        process_info['stop_reason'] = reason or "Процесс остановлен."
+        await self._terminate(process_info['process'])
+        watcher = process_info.get('watcher')
+        if watcher:
+            await asyncio.shield(watcher)
+        return True
+
+    async def kill_unhealthy(self, project_id, reason) -> bool:
+        """Останавливает зависший процесс так, чтобы его завершение считалось падением"""
+        process_info = active_processes.get(project_id)
+        if not process_info or process_info['stop_reason']:
+            return False
+        process_info['unhealthy'] = reason
+        await self._terminate(process_info['process'])
+        return True
+
+    async def stop_many(self, project_ids, reason=None):
+        """Останавливает несколько процессов одновременно: на всех уходит один период ожидания"""
+        results = await asyncio.gather(*(self.stop(project_id, reason) for project_id in project_ids), return_exceptions=True)
+        for project_id, result in zip(project_ids, results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка остановки процесса проекта {project_id}: {result}")
+
+    async def _terminate(self, process):
+        """Останавливает процесс вместе со всей его группой и потомками и убеждается, что никого не осталось"""
+        if os.name == 'nt':
+            if process.returncode is not None:
+                return
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                return
+            try:
+                await asyncio.wait_for(process.wait(), timeout=STOP_GRACE_PERIOD)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+            return
+        
+        # PID лидера совпадает с идентификатором группы, созданной при запуске
+        pgid = process.pid
+        pids = await process_table.find_tree(pgid, process.pid)
+        if process.returncode is not None and not pids:
+            return
+        signal_process_tree(pgid, pids, signal.SIGTERM)
+        
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + STOP_GRACE_PERIOD
+        while loop.time() < deadline:
+            pids = {pid for pid in pids if is_process_alive(pid)} | await process_table.find_tree(pgid)
+            if process.returncode is not None and not pids:
+                return
+            await asyncio.sleep(0.1)
+        
+        logger.warning(f"Процессы группы {pgid} не завершились за {STOP_GRACE_PERIOD} с, отправляем SIGKILL")
+        signal_process_tree(pgid, pids, signal.SIGKILL)
+        await self._wait_exit(process)
+        
+        # SIGKILL не перехватывается, но проверяем, что в группе действительно никого не осталось
+        deadline = loop.time() + 1
+        while (survivors := await process_table.find_tree(pgid)) and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if survivors:
+            logger.error(f"❌ После SIGKILL в группе {pgid} остались процессы: {sorted(survivors)}")
+
+    async def _wait_exit(self, process):
+        """Ждёт завершения самого процесса: process.wait() ждёт ещё и закрытия каналов, которые могут держать потомки"""
+        waiter = asyncio.ensure_future(process.wait())
+        try:
+            while process.returncode is None:
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), timeout=0.5)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            waiter.cancel()
+        return process.returncode
+
+    def _release(self, project_id, process):
+        """Убирает процесс из active_processes, если там не записан уже более новый процесс проекта"""
+        process_info = active_processes.get(project_id)
+        if process_info and process_info['process'] is process:
+            del active_processes[project_id]
+            return process_info
+        return None
+
+    async def _watch(self, process, project_id, user_id, project_name):
+        try:
+            await self._wait_exit(process)
+        except Exception as e:
+            logger.error(f"Ошибка ожидания процесса {process.pid}: {e}")
+        returncode = process.returncode
+        
+        # Потомки упавшего бота не должны переживать его: добиваем оставшуюся группу
+        process_info = active_processes.get(project_id)
+        stopping = process_info and process_info['process'] is process and process_info['stop_reason']
+        if os.name != 'nt' and not stopping:
+            leftovers = await process_table.find_tree(process.pid, fresh=True)
+            if leftovers:
+                await append_project_log(project_id, f"Останавливаем оставшиеся дочерние процессы: {len(leftovers)}")
+                await self._terminate(process)
+        
+        process_info = self._release(project_id, process)
+        if not process_info:
+            resource_limiter.release(project_id)
+            return
+        
+        # Даём дочитать хвост вывода, чтобы он попал в журнал раньше строки о завершении
+        monitor = process_info.get('monitor')
+        if monitor:
+            try:
+                await asyncio.wait_for(asyncio.shield(monitor), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+        limit_reason = resource_limiter.explain_exit(project_id, returncode)
+        resource_limiter.release(project_id)
+        unhealthy = process_info.get('unhealthy')
+        if unhealthy:
+            limit_reason = unhealthy
+        
+        # Освободившийся слот сразу отдаём следующему проекту из очереди
+        await scheduler.dispatch()
+        
+        try:
+            project = await get_project_by_id(project_id)
+            if not project or project_id in active_processes:
+                return
+            
+            stop_reason = process_info['stop_reason']
+            if stop_reason:
+                await append_project_log(project_id, stop_reason)
+                await update_project(project_id, is_running=False, process_id=None)
+                save_bot_state()
+                return
+            
+            if getattr(process, 'adopted', False):
+                await append_project_log(project_id, "Процесс завершён (код неизвестен: процесс был подхвачен после перезапуска хоста)")
+            else:
+                await append_project_log(project_id, f"Процесс завершён с кодом: {returncode}")
+            if limit_reason:
+                await append_project_log(project_id, f"⛔ Причина: {limit_reason}")
+            await update_project(project_id, is_running=False, process_id=None)
+            
+            # Сохраняем состояние
+            save_bot_state()
+            
+            if unhealthy and returncode == 0:
+                # Зависший бот мог штатно выйти по SIGTERM, но для политики рестартов это падение
+                returncode = -signal.SIGTERM
+            uptime = (datetime.now() - process_info['start_time']).total_seconds()
+            delay = restart_policy.record_exit(project_id, returncode, uptime, project['auto_restart'])
+            
+            # Авто-рестарт если включен
+            if project['auto_restart'] and delay is not None:
+                logger.info(f"🔄 Авто-рестарт проекта {project_name} через {delay:.0f} с")
+                await append_project_log(project_id, f"Авто-рестарт через {delay:.0f} с")
+                restart_policy.schedule(project_id, user_id, project_name, delay)
+            elif project['auto_restart'] and project_id in restart_policy.parked:
+                logger.warning(f"🔁 Проект {project_name} падает в цикле, авто-рестарт приостановлен")
+                await append_project_log(
+                    project_id,
+                    f"Авто-рестарт приостановлен: {CRASH_LOOP_MAX_FAILURES} падений подряд за {CRASH_LOOP_WINDOW // 60} мин"
+                )
+                try:
+                    await bot.send_message(
+                        user_id,
+                        f"🔁 Проект '{project_name}' падает сразу после запуска "
+                        f"({CRASH_LOOP_MAX_FAILURES} раз за {CRASH_LOOP_WINDOW // 60} мин, последний код: {returncode}).\n"
+                        f"Авто-рестарт приостановлен — проверьте логи, исправьте ошибку и запустите проект вручную."
+                    )
+                except Exception as e:
+                    logger.error(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
+            else:
+                try:
+                    status_text = "успешно завершён" if returncode == 0 else f"завершён с ошибкой (код: {returncode})"
+                    if limit_reason:
+                        status_text += f": {limit_reason}"
+                    await bot.send_message(user_id, f"📋 Проект '{project_name}' {status_text}.")
+                except Exception as e:
+                    logger.error(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка обработки завершения процесса проекта {project_id}: {e}")
+
+supervisor = ProcessSupervisor()
+
+# Сторож зависших проектов
+class ProjectWatchdog:
+    """Проверяет запущенные проекты на признаки зависания и останавливает зависшие как упавшие, чтобы их перезапустила политика рестартов"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        # project_id -> {'state': 'ok' | 'suspect' | 'hung', 'reason': причина или None, 'failures': проваленных проверок подряд}
+        self.health = {}
+        self._pending_updates = {}  # project_id -> очередь обновлений Telegram и время последнего вывода на прошлой проверке
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def forget(self, project_id):
+        self.health.pop(project_id, None)
+        self._pending_updates.pop(project_id, None)
+
+    def get(self, project_id):
+        return self.health.get(project_id)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check_all()
+            except Exception as e:
+                logger.error(f"Ошибка проверки зависания проектов: {e}")
+
+    async def check_all(self):
+        """Проверяет все запущенные проекты, у которых включена хотя бы одна проверка"""
+        checked = []
+        for project_id, process_info in list(active_processes.items()):
+            if process_info['process'].returncode is not None or process_info['stop_reason'] or process_info.get('unhealthy'):
+                continue
+            if 'watchdog' not in process_info:
+                # Новый процесс проекта: проверки читаются один раз, состояние прошлого процесса сбрасывается
+                self.forget(project_id)
+                process_info['watchdog'] = await get_project_watchdog(project_id)
+            checks = process_info['watchdog']
+            if checks['silence_minutes'] or checks['idle_minutes'] or checks['heartbeat_file'] or checks['probe']:
+                checked.append((project_id, process_info))
+        results = await asyncio.gather(*(self.check(*entry) for entry in checked), return_exceptions=True)
+        for (project_id, process_info), reason in zip(checked, results):
+            if isinstance(reason, Exception):
+                logger.error(f"Ошибка проверки зависания проекта {project_id}: {reason}")
+                continue
+            await self._update(project_id, process_info, reason)
+        # Отметка о зависании остаётся до следующего запуска, остальное — только у запущенных
+        for project_id in list(self.health):
+            if project_id not in active_processes and self.health[project_id]['state'] != 'hung':
+                self.forget(project_id)
+
+    async def check(self, project_id, process_info):
+        """Причина, по которой проект выглядит зависшим, или None"""
+        checks = process_info['watchdog']
+        now = datetime.now()
+        if checks['silence_minutes']:
+            silence = (now - process_info.get('last_output', process_info['start_time'])).total_seconds()
+            if silence > checks['silence_minutes'] * 60:
+                return f"нет вывода {format_uptime(silence)}"
+        if checks['idle_minutes']:
+            idle = process_sampler.idle_for(project_id)
+            if idle is not None and idle > checks['idle_minutes'] * 60:
+                return f"не расходует CPU {format_uptime(idle)}"
+        project = await get_project_by_id(project_id)
+        if not project or not project['file_path']:
+            return None
+        if checks['heartbeat_file']:
+            path = os.path.join(os.path.dirname(project['file_path']), checks['heartbeat_file'])
+            try:
+                beat = max(datetime.fromtimestamp(os.path.getmtime(path)), process_info['start_time'])
+            except OSError:
+                beat = process_info['start_time']
+            age = (now - beat).total_seconds()
+            if age > (checks['heartbeat_minutes'] or PROJECT_WATCHDOG['heartbeat_minutes']) * 60:
+                return f"файл {checks['heartbeat_file']} не обновлялся {format_uptime(age)}"
+        if checks['probe']:
+            return await self._probe(project_id, process_info, project['file_path'])
+        return None
+
+    async def _probe(self, project_id, process_info, file_path):
+        token = await asyncio.to_thread(extract_bot_token_from_code, file_path)
+        if not token:
+            return None
+        probe_bot = Bot(token=token)
+        try:
+            await probe_bot.get_me()
+            webhook = await probe_bot.get_webhook_info()
+        except TelegramUnauthorizedError:
+            return "Telegram отклонил токен бота"
+        except Exception as e:
+            # Сбой связи хоста с Telegram — не повод перезапускать бота
+            logger.warning(f"⚠️ Не удалось проверить бота проекта {project_id} через Telegram: {e}")
+            return None
+        finally:
+            await probe_bot.session.close()
+        pending = webhook.pending_update_count
+        now = datetime.now()
+        last_output = process_info.get('last_output')
+        previous = self._pending_updates.get(project_id)
+        self._pending_updates[project_id] = {'pending': pending, 'time': now, 'last_output': last_output}
+        if not pending or previous is None or pending < previous['pending']:
+            return None
+        # Очередь не пустеет и у бота с постоянным потоком обновлений, поэтому зависшим считается только бот,
+        # который с прошлой проверки ничего не вывел и не расходовал CPU
+        if last_output != previous['last_output']:
+            return None
+        idle = process_sampler.idle_for(project_id)
+        if idle is not None and idle < (now - previous['time']).total_seconds():
+            return None
+        return f"не забирает обновления из Telegram (в очереди {pending})"
+
+    async def _update(self, project_id, process_info, reason):
+        if reason is None:
+            self.health[project_id] = {'state': 'ok', 'reason': None, 'failures': 0}
+            return
+        failures = self.health.get(project_id, {}).get('failures', 0) + 1
+        if failures < WATCHDOG_FAILURES:
+            self.health[project_id] = {'state': 'suspect', 'reason': reason, 'failures': failures}
+            return
+        self.health[project_id] = {'state': 'hung', 'reason': reason, 'failures': failures}
+        logger.warning(f"🩺 Проект {process_info['project_name']} завис: {reason}")
+        await append_project_log(project_id, f"🩺 Проект завис ({reason}), останавливаем процесс")
+        # Остановка без stop_reason: завершение обрабатывается как падение, и рестарт решает политика рестартов
+        await supervisor.kill_unhealthy(project_id, f"завис: {reason}")
+
+watchdog = ProjectWatchdog(WATCHDOG_INTERVAL)
+
+# Контроль запуска проектов по нагрузке хоста
+class AdmissionController:
+    """Решает, хватит ли хосту памяти и CPU ещё на один проект, с учётом прошлого потребления этого проекта"""
+
+    def __init__(self):
+        self._reserved = {}  # project_id -> (до какого момента учитывать, байт)
+
+    @staticmethod
+    def read_memory():
+        """Возвращает (всего, доступно) байт по /proc/meminfo или None, если это недоступно"""
+        try:
+            with open('/proc/meminfo') as f:
+                info = {line.split(':')[0]: int(line.split()[1]) * 1024 for line in f}
+            return info['MemTotal'], info['MemAvailable']
+        except (OSError, KeyError, ValueError, IndexError):
+            return None
+
+    @staticmethod
+    def read_load():
+        if not hasattr(os, 'getloadavg'):
+            return None
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+    def footprint(self, project_id) -> int:
+        """Ожидаемая память проекта: пик RSS прошлых запусков или оценка по умолчанию"""
+        usage = process_sampler.summary(project_id, running_only=False)
+        if usage:
+            return usage['rss_peak']
+        return ADMISSION_DEFAULT_FOOTPRINT_MB * 1024 * 1024
+
+    def reserved(self) -> int:
+        now = asyncio.get_running_loop().time()
+        self._reserved = {
+            project_id: (until, size) for project_id, (until, size) in self._reserved.items()
+            if until > now and project_id in active_processes
+        }
+        return sum(size for _, size in self._reserved.values())
+
+    def check(self, project_id):
+        """Возвращает None, если проект можно запустить сейчас, иначе причину отказа"""
+        if scheduler.running_count() >= MAX_CONCURRENT_BOTS:
+            return f"достигнут предел в {MAX_CONCURRENT_BOTS} ботов"
+        # На пустом хосте хотя бы один проект запускается всегда, иначе очередь никогда не сдвинется
+        if not active_processes:
+            return None
+        memory = self.read_memory()
+        if memory:
+            need = self.footprint(project_id)
+            free = memory[1] - self.reserved()
+            if free - need < ADMISSION_MEMORY_RESERVE_MB * 1024 * 1024:
+                return f"мало памяти: свободно {format_size(max(0, free))}, проекту нужно около {format_size(need)}"
+        load = self.read_load()
+        if load is not None and load > ADMISSION_MAX_LOAD_PER_CPU:
+            return f"высокая нагрузка CPU: {load:.2f} на ядро"
+        return None
+
+    def admitted(self, project_id):
+        """Резервирует ожидаемую память проекта на время его разгона"""
+        until = asyncio.get_running_loop().time() + ADMISSION_WARMUP
+        self._reserved[project_id] = (until, self.footprint(project_id))
+
+admission = AdmissionController()
+
+# Планировщик запуска проектов
+class ProjectScheduler:
+    """Очередь запуска с приоритетами: следит за ресурсами хоста и лимитом ботов на пользователя"""
+
+    def __init__(self):
+        self._queue = []  # ожидающие запуска: project_id, user_id, project_name, priority, seq
+        self._seq = itertools.count()
+        self._lock = asyncio.Lock()
+        self._retry_task = None
+        self.blocked_reason = None  # почему очередь стоит, для меню
+        self.closed = False
+
+    def close(self):
+        """Очищает очередь и больше не запускает проекты (при завершении работы)"""
+        self.closed = True
+        self._queue = []
+        if self._retry_task:
+            self._retry_task.cancel()
+
+    def running_count(self) -> int:
+        # Слоты считаются по живым процессам, а не по отдельному счётчику
+        return len(active_processes)
+
+    def user_running_count(self, user_id: int) -> int:
+        return sum(1 for process_info in active_processes.values() if process_info['user_id'] == user_id)
+
+    def queue_length(self) -> int:
+        return len(self._queue)
+
+    def _ordered(self) -> list:
+        return sorted(self._queue, key=lambda entry: (entry['priority'], entry['seq']))
+
+    def position(self, project_id: int):
+        """Позиция проекта в очереди (с 1) или None, если проект не в очереди"""
+        for index, entry in enumerate(self._ordered(), start=1):
+            if entry['project_id'] == project_id:
+                return index
+        return None
+
+    def cancel(self, project_id: int) -> bool:
+        before = len(self._queue)
+        self._queue = [entry for entry in self._queue if entry['project_id'] != project_id]
+        return len(self._queue) != before
+
+    def _next_admissible(self):
+        candidates = [
+            entry for entry in self._queue
+            if self.user_running_count(entry['user_id']) < MAX_BOTS_PER_USER
+        ]
+        # При равном приоритете первым идёт пользователь, у которого сейчас меньше запущенных ботов
+        candidates.sort(key=lambda entry: (entry['priority'], self.user_running_count(entry['user_id']), entry['seq']))
+        self.blocked_reason = None
+        for entry in candidates:
+            # Небольшой проект может пройти, когда для более крупного перед ним памяти пока не хватает
+            reason = admission.check(entry['project_id'])
+            if reason is None:
+                return entry
+            self.blocked_reason = self.blocked_reason or reason
+        return None
+
+    def _schedule_retry(self):
+        # Освобождение памяти или спад нагрузки не порождают событий, поэтому очередь перепроверяется по таймеру
+        if self._retry_task and not self._retry_task.done():
+            return
+        
+        async def retry():
+            await asyncio.sleep(ADMISSION_RETRY_INTERVAL)
+            # Сбрасываем ссылку до проверки, иначе dispatch увидит эту задачу живой и не заведёт следующую
+            self._retry_task = None
+            await self.dispatch()
+        
+        self._retry_task = asyncio.create_task(retry())
+
+    async def request_start(self, project_id: int, user_id: int, project_name: str, priority: int = PRIORITY_USER):
+        """Запускает проект, если хватает ресурсов, иначе ставит в очередь. Возвращает позицию в очереди или None"""
+        if self.closed or project_id in active_processes:
+            return None
+        entry = next((entry for entry in self._queue if entry['project_id'] == project_id), None)
+        if entry:
+            entry['priority'] = min(entry['priority'], priority)
+        else:
+            self._queue.append({
+                'project_id': project_id,
+                'user_id': user_id,
+                'project_name': project_name,
+                'priority': priority,
+                'seq': next(self._seq),
+                'waited': False
+            })
+        await self.dispatch()
+        position = self.position(project_id)
+        if position:
+            for entry in self._queue:
+                if entry['project_id'] == project_id:
+                    entry['waited'] = True
+        return position
+
+    async def dispatch(self):
+        """Запускает ожидающие проекты, пока хватает ресурсов"""
+        async with self._lock:
+            while not self.closed:
+                entry = self._next_admissible()
+                if not entry:
+                    if self.blocked_reason:
+                        self._schedule_retry()
+                    return
+                self._queue.remove(entry)
+                await self._start(entry)
+
+    async def _start(self, entry: dict):
+        admission.admitted(entry['project_id'])
+        try:
+            await supervisor.spawn(
+                entry['project_id'], entry['user_id'], entry['project_name'],
+                restarted=entry['priority'] != PRIORITY_USER
+            )
+            message = f"▶️ Проект '{entry['project_name']}' запущен из очереди." if entry['waited'] else None
+        except Exception as e:
+            logger.error(f"❌ Ошибка при запуске проекта {entry['project_name']}: {e}")
+            await append_project_log(entry['project_id'], f"Ошибка запуска: {str(e)}")
+            message = f"❌ Ошибка при запуске '{entry['project_name']}': {str(e)}"
+        if message:
+            try:
+                await bot.send_message(entry['user_id'], message)
+            except Exception as e:
+                logger.error(f"Не удалось отправить уведомление пользователю {entry['user_id']}: {e}")
+
+scheduler = ProjectScheduler()
+
+# Функция для авто-рестарта проекта
+async def restart_project(project_id, user_id, project_name, priority=PRIORITY_RESTART):
+    project = await get_project_by_id(project_id)
+    if not project or not project['file_path'] or not os.path.exists(project['file_path']):
+        return
+    
+    queue_position = await scheduler.request_start(project_id, user_id, project_name, priority)
+    if queue_position:
+        logger.info(f"⏳ Проект {project_name} ждёт ресурсов для перезапуска, позиция {queue_position}")
+        try:
+            await bot.send_message(
+                user_id,
+                f"⏳ '{project_name}' ждёт свободных ресурсов хоста для перезапуска. Позиция в очереди: {queue_position}"
+            )
+        except Exception as e:
+            logger.error(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
+
+# Управление процессами проектов: через него к ним обращаются хэндлеры
+class ProcessControl:
+    """Выполняет операции с процессами в этом же процессе хоста, SupervisorClient повторяет его методы по RPC"""
+
+    remote = False
+
+    async def start(self, project_id, user_id, project_name, priority=PRIORITY_USER):
+        """Ставит проект на запуск, возвращает позицию в очереди или None, если он запущен сразу"""
+        return await scheduler.request_start(project_id, user_id, project_name, priority)
+
+    async def stop(self, project_id, reason):
+        return await supervisor.stop(project_id, reason)
+
+    async def stop_many(self, project_ids, reason):
+        await supervisor.stop_many(project_ids, reason)
+
+    async def cancel_start(self, project_id):
+        """Отменяет ожидающий запуск: место в очереди или отложенный рестарт"""
+        return scheduler.cancel(project_id) or restart_policy.cancel(project_id)
+
+    async def reset(self, project_id):
+        restart_policy.reset(project_id)
+
+    async def forget(self, project_id):
+        """Останавливает процесс удаляемого проекта и забывает всё, что о нём известно"""
+        await supervisor.stop(project_id, "Проект удаляется.")
+        scheduler.cancel(project_id)
+        restart_policy.forget(project_id)
+        process_sampler.forget(project_id)
+        watchdog.forget(project_id)
+        remove_project_output(project_id)
+        log_writer.discard(project_id)
+        save_bot_state()
+
+    async def status(self, project_id):
+        """Состояние проекта для меню: очередь, рестарты, потребление ресурсов и загрузка хоста"""
+        return {
+            'running': project_id in active_processes,
+            'queue_position': scheduler.position(project_id),
+            'blocked_reason': scheduler.blocked_reason,
+            'restart_in': restart_policy.restart_in(project_id),
+            'parked': project_id in restart_policy.parked,
+            'usage': process_sampler.summary(project_id),
+            'health': watchdog.get(project_id),
+            'history': [
+                dict(entry, time=entry['time'].isoformat()) for entry in restart_policy.get_history(project_id)
+            ],
+            'running_count': scheduler.running_count(),
+            'queue_length': scheduler.queue_length()
+        }
+
+    async def host_status(self):
+        return {
+            'running_count': scheduler.running_count(),
+            'queue_length': scheduler.queue_length(),
+            'usage': process_sampler.host_totals()
+        }
+
+    async def running(self, offset, limit):
+        """Запущенные проекты с потреблением ресурсов, самые затратные первыми"""
+        project_ids = sorted(active_processes, key=process_sampler.cost, reverse=True)
+        return {
+            'total': len(project_ids),
+            'projects': [
+                [project_id, process_sampler.summary(project_id), watchdog.get(project_id)]
+                for project_id in project_ids[offset:offset + limit]
+            ]
+        }
+
+    async def logs(self, project_id, max_chars=4000):
+        return await get_project_logs(project_id, max_chars)
+
+    async def stream(self, project_id):
+        """Отдаёт новые строки журнала проекта по мере появления"""
+        queue = log_writer.subscribe(project_id)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            log_writer.unsubscribe(project_id, queue)
+
+    def report(self):
+        """Ресурсы этого хоста и запущенные на нём проекты"""
+        memory = admission.read_memory()
+        return {
+            'total': memory[0] if memory else 0,
+            'available': max(0, memory[1] - admission.reserved()) if memory else 0,
+            'load': admission.read_load(),
+            'running': list(active_processes),
+            'queue_length': scheduler.queue_length(),
+            'usage': process_sampler.host_totals()
+        }
+
+    async def nodes(self):
+        return [dict(self.report(), name=LOCAL_NODE, draining=False, offline=False)]
+
+    async def drain(self, name, enabled=True):
+        raise SupervisorError("Рабочие агенты не настроены (CLUSTER_LISTEN)")
+
+process_control = ProcessControl()
+
+class SupervisorError(Exception):
+    """Супервизор недоступен или вернул ошибку"""
+
+def encode_rpc_message(message: dict) -> bytes:
+    return json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n'
+
+# RPC-сервер супервизора на Unix-сокете
+class SupervisorServer:
+    """Принимает по одному JSON-запросу на соединение и отвечает одной строкой, поток логов идёт до отключения клиента"""
+
+    METHODS = (
+        'start', 'stop', 'stop_many', 'cancel_start', 'reset', 'forget', 'status', 'host_status', 'running', 'logs',
+        'nodes', 'drain'
+    )
+
+    def __init__(self, control, path):
+        self.control = control
+        self.path = path
+        self._server = None
+        self._connections = set()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            try:
+                _, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                # Сокет остался от упавшего супервизора
+                os.remove(self.path)
+            else:
+                writer.close()
+                raise RuntimeError(f"Супервизор уже слушает {self.path}")
+        self._server = await asyncio.start_unix_server(self._handle, path=self.path, limit=SUPERVISOR_RPC_LIMIT)
+        os.chmod(self.path, 0o600)
+        logger.info(f"🔌 Супервизор слушает {self.path}")
+
+    async def close(self):
+        if not self._server:
+            return
+        self._server.close()
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            request = json.loads(await reader.readline() or 'null')
+            if not isinstance(request, dict):
+                return
+            method, params = request.get('method'), request.get('params') or {}
+            try:
+                if method == 'stream':
+                    await self._stream(reader, writer, self.control.stream(**params))
+                    return
+                if method not in self.METHODS:
+                    raise ValueError(f"неизвестный метод {method}")
+                response = {'result': await getattr(self.control, method)(**params)}
+            except ConnectionError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка RPC {method}: {e}")
+                response = {'error': str(e)}
+            writer.write(encode_rpc_message(response))
+            await writer.drain()
+        except (ConnectionError, ValueError, asyncio.LimitOverrunError) as e:
+            logger.warning(f"⚠️ Некорректный запрос к супервизору: {e}")
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _stream(self, reader, writer, lines):
+        # После запроса клиент ничего не шлёт: конец потока значит, что он отключился
+        disconnected = asyncio.create_task(reader.read())
+        try:
+            while True:
+                line = asyncio.create_task(anext(lines))
+                await asyncio.wait({line, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if not line.done():
+                    line.cancel()
+                    await asyncio.gather(line, return_exceptions=True)
+                    return
+                writer.write(encode_rpc_message({'line': line.result()}))
+                await writer.drain()
+        finally:
+            disconnected.cancel()
+            await lines.aclose()
+
+# Клиент RPC супервизора для фронтенда
+class SupervisorClient:
+    """Те же методы, что у ProcessControl, но выполняются в процессе супервизора"""
+
+    remote = True
+
+    def __init__(self, path):
+        self.path = path
+
+    async def _connect(self, method, params):
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.path, limit=SUPERVISOR_RPC_LIMIT)
+        except OSError as e:
+            raise SupervisorError(f"Супервизор недоступен: {e}")
+        writer.write(encode_rpc_message({'method': method, 'params': params}))
+        await writer.drain()
+        return reader, writer
+
+    async def _call(self, method, **params):
+        reader, writer = await self._connect(method, params)
+        try:
+            line = await reader.readline()
+        finally:
+            writer.close()
+        if not line:
+            raise SupervisorError(f"Супервизор закрыл соединение во время {method}")
+        response = json.loads(line)
+        if 'error' in response:
+            raise SupervisorError(response['error'])
+        return response['result']
+
+    async def start(self, project_id, user_id, project_name, priority=PRIORITY_USER):
+        return await self._call('start', project_id=project_id, user_id=user_id, project_name=project_name, priority=priority)
+
+    async def stop(self, project_id, reason):
+        return await self._call('stop', project_id=project_id, reason=reason)
+
+    async def stop_many(self, project_ids, reason):
+        await self._call('stop_many', project_ids=project_ids, reason=reason)
+
+    async def cancel_start(self, project_id):
+        return await self._call('cancel_start', project_id=project_id)
+
+    async def reset(self, project_id):
+        await self._call('reset', project_id=project_id)
+
+    async def forget(self, project_id):
+        await self._call('forget', project_id=project_id)
+
+    async def status(self, project_id):
+        return await self._call('status', project_id=project_id)
+
+    async def host_status(self):
+        return await self._call('host_status')
+
+    async def running(self, offset, limit):
+        return await self._call('running', offset=offset, limit=limit)
+
+    async def logs(self, project_id, max_chars=4000):
+        return await self._call('logs', project_id=project_id, max_chars=max_chars)
+
+    async def nodes(self):
+        return await self._call('nodes')
+
+    async def drain(self, name, enabled=True):
+        return await self._call('drain', name=name, enabled=enabled)
+
+    async def stream(self, project_id):
+        reader, writer = await self._connect('stream', {'project_id': project_id})
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                if 'error' in message:
+                    raise SupervisorError(message['error'])
+                yield message['line']
+        finally:
+            writer.close()
+
+# Функция для получения версии проекта: по ней видно, есть ли у агента актуальные файлы
+async def get_project_version(project) -> str:
+    digest = hashlib.sha256(json.dumps(await get_project_requirements(project['id'])).encode('utf-8'))
+    try:
+        stat = os.stat(project['file_path'])
+        digest.update(f"{project['file_path']}\0{stat.st_size}\0{stat.st_mtime_ns}".encode('utf-8'))
+    except (OSError, TypeError):
+        pass
+    return digest.hexdigest()
+
+# Функция для упаковки директории проекта в архив для пересылки агенту
+def pack_project_dir(project_dir: str) -> str:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for root, dirs, files in os.walk(project_dir):
+            # Окружение агент создаёт сам: пакеты в нём собраны под эту машину
+            dirs[:] = [name for name in dirs if name not in ('__pycache__', PROJECT_VENV_DIR)]
+            for name in files:
+                path = os.path.join(root, name)
+                archive.write(path, os.path.relpath(path, project_dir))
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+# Функция для распаковки присланного архива на место прежних файлов проекта
+def unpack_project_archive(archive: str, project_dir: str):
+    if os.path.exists(project_dir):
+        shutil.rmtree(project_dir)
+    os.makedirs(project_dir, exist_ok=True)
+    with zipfile.ZipFile(io.BytesIO(base64.b64decode(archive))) as zip_ref:
+        zip_ref.extractall(project_dir)
+
+# Функция для проверки, что общий секрет кластера задан: со значением по умолчанию агентом может назваться кто угодно
+def check_cluster_token():
+    if not CLUSTER_TOKEN or CLUSTER_TOKEN == 'change-me':
+        raise SupervisorError("Задайте собственный CLUSTER_TOKEN: с пустым или значением по умолчанию кластер не запускается")
+
+# Подключение рабочего агента на стороне управляющего хоста
+class AgentConnection:
+    """Мультиплексирует запросы к агенту по одному TCP-соединению и хранит его последний отчёт"""
+
+    def __init__(self, name, reader, writer, report):
+        self.name = name
+        self.reader = reader
+        self.writer = writer
+        self.report = report
+        self._ids = itertools.count(1)
+        self._pending = {}  # id запроса -> Future ответа или очередь строк потока
+
+    async def call(self, method, timeout=AGENT_RPC_TIMEOUT, **params):
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            self.writer.write(encode_rpc_message({'id': request_id, 'method': method, 'params': params}))
+            await self.writer.drain()
+            response = await asyncio.wait_for(future, timeout)
+        except ConnectionError as e:
+            raise SupervisorError(f"Агент {self.name} недоступен: {e}")
+        except asyncio.TimeoutError:
+            raise SupervisorError(f"Агент {self.name} не ответил на {method} за {timeout} с")
+        finally:
+            self._pending.pop(request_id, None)
+        if 'error' in response:
+            raise SupervisorError(response['error'])
+        return response['result']
+
+    async def stream(self, project_id):
+        request_id = next(self._ids)
+        queue = asyncio.Queue()
+        self._pending[request_id] = queue
+        try:
+            self.writer.write(encode_rpc_message({'id': request_id, 'method': 'stream', 'params': {'project_id': project_id}}))
+            await self.writer.drain()
+            while True:
+                message = await queue.get()
+                if 'error' in message:
+                    raise SupervisorError(message['error'])
+                yield message['line']
+        finally:
+            self._pending.pop(request_id, None)
+            if not self.writer.is_closing():
+                self.writer.write(encode_rpc_message({'id': request_id, 'cancel': True}))
+
+    async def serve(self, on_report):
+        """Читает ответы и отчёты агента до разрыва соединения"""
+        try:
+            while line := await self.reader.readline():
+                message = json.loads(line)
+                if message.get('method') == 'report':
+                    self.report = message.get('params') or {}
+                    await on_report(self)
+                    continue
+                target = self._pending.get(message.get('id'))
+                if isinstance(target, asyncio.Queue):
+                    target.put_nowait(message)
+                elif target is not None and not target.done():
+                    target.set_result(message)
+        finally:
+            error = f"Агент {self.name} отключился"
+            for target in self._pending.values():
+                if isinstance(target, asyncio.Queue):
+                    target.put_nowait({'error': error})
+                elif not target.done():
+                    target.set_exception(SupervisorError(error))
+            self.writer.close()
+
+# Распределение проектов между управляющим хостом и рабочими агентами
+class ClusterControl:
+    """Те же операции, что у ProcessControl, но каждый проект выполняется на своём узле"""
+
+    remote = False
+
+    def __init__(self, local):
+        self.local = local
+        self.agents = {}  # имя -> AgentConnection
+        self.draining = set()
+        self._server = None
+
+    async def start_server(self, host, port):
+        check_cluster_token()
+        context = None
+        if CLUSTER_TLS_CERT:
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(CLUSTER_TLS_CERT, CLUSTER_TLS_KEY)
+        else:
+            logger.warning("⚠️ TLS для агентов не настроен (CLUSTER_TLS_CERT): токен и код проектов передаются открытым текстом")
+        self._server = await asyncio.start_server(self._accept, host, port, limit=SUPERVISOR_RPC_LIMIT, ssl=context)
+        logger.info(f"🌐 Ожидаем рабочих агентов на {host}:{port}{' (TLS)' if context else ''}")
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+            self._server = None
+        for agent in list(self.agents.values()):
+            agent.writer.close()
+
+    async def _accept(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        try:
+            message = json.loads(await asyncio.wait_for(reader.readline(), AGENT_RPC_TIMEOUT) or 'null')
+        except (asyncio.TimeoutError, ValueError, ConnectionError):
+            writer.close()
+            return
+        params = message.get('params') if isinstance(message, dict) and message.get('method') == 'register' else None
+        name = params.get('name') if isinstance(params, dict) else None
+        if not name or name == LOCAL_NODE or not hmac.compare_digest(str(params.get('token', '')), CLUSTER_TOKEN):
+            logger.warning(f"⚠️ Отклонена регистрация агента с {peer}")
+            writer.close()
+            return
+        previous = self.agents.get(name)
+        if previous:
+            previous.writer.close()
+        agent = AgentConnection(name, reader, writer, params.get('report') or {})
+        self.agents[name] = agent
+        logger.info(f"🖥️ Агент {name} подключился с {peer}")
+        try:
+            await self._sync_running(agent)
+            asyncio.create_task(self._stop_orphans(agent))
+            await agent.serve(self._sync_running)
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"⚠️ Ошибка соединения с агентом {name}: {e}")
+        finally:
+            if self.agents.get(name) is agent:
+                del self.agents[name]
+                logger.warning(f"⚠️ Агент {name} отключился")
+                await self._mark_unknown(name)
+
+    async def _mark_unknown(self, node):
+        """Отмечает в журналах проектов отключившегося агента, что их состояние неизвестно: боты там могут работать дальше"""
+        async with db_pool.acquire() as db:
+            cursor = await db.execute('SELECT id FROM projects WHERE node = ? AND is_running = 1', (node,))
+            rows = await cursor.fetchall()
+        for (project_id,) in rows:
+            await append_project_log(project_id, f"⚠️ Агент {node} недоступен, состояние процесса неизвестно")
+
+    async def _stop_orphans(self, agent):
+        """Останавливает на вернувшемся агенте переехавшие за время его отсутствия проекты и удаляет с него удалённые"""
+        running = set(agent.report.get('running', []))
+        known = running | {int(project_id) for project_id in agent.report.get('deployed', {})}
+        if not known:
+            return
+        try:
+            async with db_pool.acquire() as db:
+                cursor = await db.execute(
+                    f"SELECT id, node FROM projects WHERE id IN ({', '.join('?' * len(known))})", tuple(known)
+                )
+                nodes = dict(await cursor.fetchall())
+        except Exception as e:
+            logger.error(f"Ошибка проверки проектов агента {agent.name}: {e}")
+            return
+        # Файлы переехавшего проекта остаются на агенте, чтобы при возврате не передавать их заново
+        moved = [project_id for project_id in running if project_id in nodes and nodes[project_id] != agent.name]
+        deleted = [project_id for project_id in known if project_id not in nodes]
+        if not moved and not deleted:
+            return
+        logger.warning(f"⚠️ Агент {agent.name}: останавливаем перенесённые проекты {moved}, удаляем удалённые {deleted}")
+        try:
+            if moved:
+                await agent.call('stop_many', project_ids=moved, reason="Проект перенесён на другой узел.")
+            for project_id in deleted:
+                await agent.call('remove', project_id=project_id)
+                agent.report.get('deployed', {}).pop(str(project_id), None)
+        except (SupervisorError, ConnectionError) as e:
+            logger.error(f"Не удалось убрать лишние копии проектов с агента {agent.name}: {e}")
+            return
+        agent.report['running'] = [
+            project_id for project_id in agent.report.get('running', []) if project_id not in moved and project_id not in deleted
+        ]
+
+    async def _sync_running(self, agent):
+        """Отмечает в БД, какие из размещённых на агенте проектов сейчас запущены"""
+        running = set(agent.report.get('running', []))
+        async with db_pool.acquire() as db:
+            cursor = await db.execute('SELECT id, is_running FROM projects WHERE node = ?', (agent.name,))
+            rows = await cursor.fetchall()
+        for project_id, is_running in rows:
+            if bool(is_running) != (project_id in running):
+                await update_project(project_id, is_running=project_id in running, process_id=None)
+
+    async def _node(self, project_id):
+        project = await get_project_by_id(project_id)
+        return (project and project['node']) or LOCAL_NODE
+
+    async def _invoke(self, node, method, **params):
+        if node == LOCAL_NODE:
+            return await getattr(self.local, method)(**params)
+        agent = self.agents.get(node)
+        if not agent:
+            raise SupervisorError(f"Узел {node} недоступен")
+        return await agent.call(method, **params)
+
+    def _candidates(self):
+        """Узлы, на которые можно поставить проект, с их последними отчётами"""
+        nodes = {}
+        if CLUSTER_RUN_LOCAL:
+            nodes[LOCAL_NODE] = dict(self.local.report(), deployed={})
+        for name, agent in self.agents.items():
+            if name not in self.draining:
+                nodes[name] = agent.report
+        return nodes
+
+    async def _place(self, project, version):
+        """Выбирает узел: прежний, если на нём есть место, затем агент с файлами проекта, затем наименее загруженный"""
+        nodes = self._candidates()
+        if not nodes:
+            raise SupervisorError("Нет доступных узлов для запуска проекта")
+        need = admission.footprint(project['id']) + ADMISSION_MEMORY_RESERVE_MB * 1024 * 1024
+        fits = {name: report for name, report in nodes.items() if report.get('available', 0) >= need}
+        current = project['node'] or LOCAL_NODE
+        if current in fits:
+            return current
+        deployed = [name for name, report in fits.items() if report.get('deployed', {}).get(str(project['id'])) == version]
+        if deployed:
+            return max(deployed, key=lambda name: fits[name]['available'])
+        # Если места нет нигде, проект ждёт в очереди наименее загруженного узла
+        candidates = fits or nodes
+        return max(candidates, key=lambda name: (candidates[name].get('available', 0), -len(candidates[name].get('running', []))))
+
+    async def _deploy(self, node, project, version):
+        """Передаёт агенту запись проекта и, если у него нет текущей версии, его файлы с зависимостями"""
+        agent = self.agents[node]
+        project_dir = get_project_path(project['user_id'], project['safe_name'])
+        archive = None
+        if agent.report.get('deployed', {}).get(str(project['id'])) != version:
+            archive = await asyncio.to_thread(pack_project_dir, project_dir)
+        async with db_pool.acquire() as db:
+            cursor = await db.execute('SELECT limits, watchdog FROM projects WHERE id = ?', (project['id'],))
+            row = await cursor.fetchone()
+        record = {key: project[key] for key in ('id', 'user_id', 'name', 'safe_name', 'auto_restart', 'bot_username')}
+        record['created'] = project['created'].isoformat()
+        record['file'] = os.path.relpath(project['file_path'], project_dir)
+        record['limits'], record['watchdog'] = row if row else (None, None)
+        await agent.call('deploy', timeout=AGENT_DEPLOY_TIMEOUT, project=record, version=version, archive=archive)
+        agent.report.setdefault('deployed', {})[str(project['id'])] = version
+
+    async def start(self, project_id, user_id, project_name, priority=PRIORITY_USER):
+        project = await get_project_by_id(project_id)
+        if not project or not project['file_path']:
+            return await self.local.start(project_id, user_id, project_name, priority)
+        version = await get_project_version(project)
+        node = await self._place(project, version)
+        if node != LOCAL_NODE:
+            await self._deploy(node, project, version)
+        if node != project['node']:
+            await update_project(project_id, node=node)
+            logger.info(f"🖥️ Проект {project_name} размещён на узле {node}")
+        queue_position = await self._invoke(node, 'start', project_id=project_id, user_id=user_id,
+                                            project_name=project_name, priority=priority)
+        if node != LOCAL_NODE:
+            # Учитываем запуск в отчёте агента до следующего отчёта, чтобы пачка запусков не легла на один узел
+            report = self.agents[node].report if node in self.agents else {}
+            report['available'] = report.get('available', 0) - admission.footprint(project_id)
+            if not queue_position:
+                report.setdefault('running', []).append(project_id)
+                await update_project(project_id, is_running=True)
+        return queue_position
+
+    async def _mark_stopped(self, node, project_ids):
+        """Отмечает проекты агента остановленными, не дожидаясь его следующего отчёта"""
+        agent = self.agents.get(node)
+        if agent:
+            agent.report['running'] = [project_id for project_id in agent.report.get('running', []) if project_id not in project_ids]
+        for project_id in project_ids:
+            await update_project(project_id, is_running=False, process_id=None)
+
+    async def stop(self, project_id, reason):
+        node = await self._node(project_id)
+        stopped = await self._invoke(node, 'stop', project_id=project_id, reason=reason)
+        if node != LOCAL_NODE:
+            await self._mark_stopped(node, [project_id])
+        return stopped
+
+    async def stop_many(self, project_ids, reason):
+        by_node = {}
+        for project_id in project_ids:
+            by_node.setdefault(await self._node(project_id), []).append(project_id)
+        results = await asyncio.gather(
+            *(self._invoke(node, 'stop_many', project_ids=ids, reason=reason) for node, ids in by_node.items()),
+            return_exceptions=True
+        )
+        for (node, ids), result in zip(by_node.items(), results):
+            if isinstance(result, Exception):
+                logger.error(f"Не удалось остановить проекты на узле {node}: {result}")
+            elif node != LOCAL_NODE:
+                await self._mark_stopped(node, ids)
+
+    async def cancel_start(self, project_id):
+        return await self._invoke(await self._node(project_id), 'cancel_start', project_id=project_id)
+
+    async def reset(self, project_id):
+        await self._invoke(await self._node(project_id), 'reset', project_id=project_id)
+
+    async def forget(self, project_id):
+        node = await self._node(project_id)
+        await self.local.forget(project_id)
+        # Файлы проекта могли остаться и на агентах, с которых его переносили
+        for name, agent in list(self.agents.items()):
+            if name != node and str(project_id) not in agent.report.get('deployed', {}):
+                continue
+            try:
+                await agent.call('remove', project_id=project_id)
+            except SupervisorError as e:
+                logger.warning(f"⚠️ Агент {name} не удалил проект {project_id}: {e}")
+
+    def _totals(self):
+        reports = [self.local.report()] + [agent.report for agent in self.agents.values()]
+        usage = {'cpu': 0.0, 'rss': 0, 'threads': 0, 'fds': 0, 'processes': 0, 'projects': 0}
+        for report in reports:
+            for key, value in report.get('usage', {}).items():
+                usage[key] = usage.get(key, 0) + (value or 0)
+        return {
+            'running_count': sum(len(report.get('running', [])) for report in reports),
+            'queue_length': sum(report.get('queue_length', 0) for report in reports),
+            'usage': usage
+        }
+
+    async def status(self, project_id):
+        node = await self._node(project_id)
+        try:
+            status = await self._invoke(node, 'status', project_id=project_id)
+        except SupervisorError as e:
+            logger.warning(f"⚠️ {e}")
+            status = {
+                'running': False, 'queue_position': None, 'blocked_reason': None, 'restart_in': None,
+                'parked': False, 'usage': None, 'health': None, 'history': [], 'offline': True
+            }
+        totals = self._totals()
+        status.update(node=node, running_count=totals['running_count'], queue_length=totals['queue_length'])
+        return status
+
+    async def host_status(self):
+        return self._totals()
+
+    async def running(self, offset, limit):
+        nodes = [LOCAL_NODE] + list(self.agents)
+        results = await asyncio.gather(
+            *(self._invoke(node, 'running', offset=0, limit=MAX_CONCURRENT_BOTS) for node in nodes),
+            return_exceptions=True
+        )
+        projects = [entry for result in results if not isinstance(result, Exception) for entry in result['projects']]
+        projects.sort(key=lambda entry: usage_cost(entry[1]), reverse=True)
+        return {'total': len(projects), 'projects': projects[offset:offset + limit]}
+
+    async def logs(self, project_id, max_chars=4000):
+        try:
+            return await self._invoke(await self._node(project_id), 'logs', project_id=project_id, max_chars=max_chars)
+        except SupervisorError as e:
+            return f"⚠️ {e}"
+
+    async def stream(self, project_id):
+        node = await self._node(project_id)
+        source = self.local if node == LOCAL_NODE else self.agents.get(node)
+        if not source:
+            raise SupervisorError(f"Узел {node} недоступен")
+        async for line in source.stream(project_id):
+            yield line
+
+    def report(self):
+        return self.local.report()
+
+    async def nodes(self):
+        nodes = [dict(self.local.report(), name=LOCAL_NODE, draining=not CLUSTER_RUN_LOCAL, offline=False)]
+        for name, agent in self.agents.items():
+            report = {key: value for key, value in agent.report.items() if key != 'deployed'}
+            nodes.append(dict(report, name=name, draining=name in self.draining, offline=False))
+        for name in self.draining - set(self.agents):
+            nodes.append({'name': name, 'draining': True, 'offline': True})
+        return nodes
+
+    async def drain(self, name, enabled=True):
+        """Выводит агента из работы: новые проекты на него не ставятся, запущенные переносятся на другие узлы"""
+        if not enabled:
+            self.draining.discard(name)
+            return 0
+        if name not in self.agents:
+            raise SupervisorError(f"Агент {name} не подключён")
+        self.draining.add(name)
+        async with db_pool.acquire() as db:
+            cursor = await db.execute('SELECT id, user_id, name FROM projects WHERE node = ? AND is_running = 1', (name,))
+            rows = await cursor.fetchall()
+        migrated = 0
+        for project_id, user_id, project_name in rows:
+            try:
+                await self.stop(project_id, "Проект переносится на другой узел.")
+                await self.start(project_id, user_id, project_name, PRIORITY_RESTORE)
+                migrated += 1
+            except SupervisorError as e:
+                logger.error(f"Не удалось перенести проект {project_name} с агента {name}: {e}")
+        logger.info(f"🚚 Агент {name} выведен из работы, перенесено проектов: {migrated} из {len(rows)}")
+        return migrated
+
+# Управление процессами на рабочем агенте
+class AgentControl(ProcessControl):
+    """Добавляет к операциям с процессами развёртывание файлов проекта и его удаление"""
+
+    def __init__(self):
+        self.deployed = {}  # str(project_id) -> версия развёрнутых файлов
+        if os.path.exists(DEPLOYMENTS_FILE):
+            try:
+                with open(DEPLOYMENTS_FILE, encoding='utf-8') as f:
+                    self.deployed = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f"❌ Ошибка чтения списка развёрнутых проектов: {e}")
+
+    def _save_deployed(self):
+        with open(DEPLOYMENTS_FILE, 'w', encoding='utf-8') as f:
+            json.dump(self.deployed, f)
+
+    async def deploy(self, project, version, archive=None):
+        """Записывает проект в локальную БД агента и, если прислан архив, заменяет его файлы и ставит зависимости"""
+        async with db_pool.acquire() as db:
+            cursor = await db.execute(
+                'SELECT id FROM projects WHERE user_id = ? AND name = ? AND id != ?',
+                (project['user_id'], project['name'], project['id'])
+            )
+            stale = [row[0] for row in await cursor.fetchall()]
+        for stale_id in stale:
+            # Одноимённый проект удалили, пока агент был отключён: его запись мешает UNIQUE(user_id, name), а файлы лежат в той же папке
+            logger.info(f"🗑️ Удаляем устаревший проект {stale_id} с тем же именем, что у проекта {project['id']}")
+            await self.remove(stale_id)
+        project_dir = get_project_path(project['user_id'], project['safe_name'])
+        if archive is not None:
+            if project['id'] in active_processes:
+                raise SupervisorError("Проект запущен, его файлы нельзя заменить")
+            await asyncio.to_thread(unpack_project_archive, archive, project_dir)
+            installed, error_output = await install_project_requirements(project_dir)
+            if not installed:
+                raise SupervisorError(f"Ошибка установки зависимостей: {error_output[-500:]}")
+            self.deployed[str(project['id'])] = version
+            self._save_deployed()
+        async with db_pool.acquire() as db:
+            await db.execute('INSERT OR IGNORE INTO users (user_id, last_active) VALUES (?, ?)', (project['user_id'], datetime.now()))
+            await db.execute('''
+                INSERT INTO projects (id, user_id, name, safe_name, created, file_path, auto_restart, bot_username, limits, watchdog)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    name = excluded.name, safe_name = excluded.safe_name, file_path = excluded.file_path,
+                    auto_restart = excluded.auto_restart, bot_username = excluded.bot_username,
+                    limits = excluded.limits, watchdog = excluded.watchdog
+            ''', (
+                project['id'], project['user_id'], project['name'], project['safe_name'], project['created'],
+                os.path.join(project_dir, project['file']), project['auto_restart'], project['bot_username'],
+                project['limits'], project.get('watchdog')
+            ))
+            await db.commit()
+        await project_registry.refresh_project(project['id'])
+
+    async def remove(self, project_id):
+        """Останавливает проект и удаляет его файлы и записи с агента"""
+        project = await get_project_by_id(project_id)
+        await self.forget(project_id)
+        async with db_pool.acquire() as db:
+            await db.execute('DELETE FROM projects WHERE id = ?', (project_id,))
+            await db.commit()
+        project_registry.remove(project_id)
+        if self.deployed.pop(str(project_id), None):
+            self._save_deployed()
+        if project:
+            project_dir = get_project_path(project['user_id'], project['safe_name'])
+            if os.path.exists(project_dir):
+                await asyncio.to_thread(shutil.rmtree, project_dir)
+
+    def report(self):
+        return dict(super().report(), deployed=self.deployed)
+
+# Рабочий агент: подключается к управляющему хосту и выполняет его запросы на этой машине
+class WorkerAgent:
+    """Держит соединение с управляющим хостом, переподключаясь при обрывах, и регулярно отправляет отчёт"""
+
+    METHODS = (
+        'start', 'stop', 'stop_many', 'cancel_start', 'reset', 'forget', 'status', 'host_status', 'running', 'logs',
+        'deploy', 'remove'
+    )
+
+    def __init__(self, control, host, port, name):
+        self.control = control
+        self.host = host
+        self.port = port
+        self.name = name
+
+    async def run(self):
+        context = None
+        if CLUSTER_TLS_CA:
+            context = ssl.create_default_context(cafile=CLUSTER_TLS_CA)
+        else:
+            logger.warning("⚠️ TLS для связи с управляющим хостом не настроен (CLUSTER_TLS_CA): токен передаётся открытым текстом")
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(
+                    self.host, self.port, limit=SUPERVISOR_RPC_LIMIT, ssl=context
+                )
+            except OSError as e:
+                logger.warning(f"⚠️ Управляющий хост {self.host}:{self.port} недоступен: {e}")
+            else:
+                logger.info(f"🌐 Агент {self.name} подключён к {self.host}:{self.port}")
+                try:
+                    await self._serve(reader, writer)
+                except (ConnectionError, ValueError) as e:
+                    logger.warning(f"⚠️ Ошибка соединения с управляющим хостом: {e}")
+                finally:
+                    writer.close()
+                logger.warning("⚠️ Соединение с управляющим хостом потеряно")
+            await asyncio.sleep(AGENT_RECONNECT_DELAY)
+
+    async def _serve(self, reader, writer):
+        tasks = {}  # id запроса -> задача, которая его выполняет
+        writer.write(encode_rpc_message({
+            'method': 'register',
+            'params': {'name': self.name, 'token': CLUSTER_TOKEN, 'report': self.control.report()}
+        }))
+        await writer.drain()
+        reporter = asyncio.create_task(self._report(writer))
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                request_id = message.get('id')
+                if message.get('cancel'):
+                    task = tasks.pop(request_id, None)
+                    if task:
+                        task.cancel()
+                    continue
+                task = asyncio.create_task(self._execute(writer, request_id, message.get('method'), message.get('params') or {}))
+                tasks[request_id] = task
+                task.add_done_callback(lambda _, request_id=request_id: tasks.pop(request_id, None))
+        finally:
+            reporter.cancel()
+            for task in list(tasks.values()):
+                task.cancel()
+
+    async def _execute(self, writer, request_id, method, params):
+        try:
+            if method == 'stream':
+                async for line in self.control.stream(**params):
+                    writer.write(encode_rpc_message({'id': request_id, 'line': line}))
+                    await writer.drain()
+                return
+            if method not in self.METHODS:
+                raise ValueError(f"неизвестный метод {method}")
+            response = {'id': request_id, 'result': await getattr(self.control, method)(**params)}
+        except ConnectionError:
+            return
+        except Exception as e:
+            logger.error(f"Ошибка запроса {method} от управляющего хоста: {e}")
+            response = {'id': request_id, 'error': str(e)}
+        try:
+            writer.write(encode_rpc_message(response))
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _report(self, writer):
+        while True:
+            await asyncio.sleep(AGENT_REPORT_INTERVAL)
+            writer.write(encode_rpc_message({'method': 'report', 'params': self.control.report()}))
+            await writer.drain()
+
+# Хэндлер для "Остановить"
+@dp.callback_query(lambda c: c.data.startswith("stop_"))
+async def stop_project(callback: CallbackQuery):
+    project_name = callback.data.replace("stop_", "")
+    user_id = callback.from_user.id
+    project = await get_project_by_name(user_id, project_name)
+    if not project:
+        await callback.message.answer("❌ Проект не найден.")
+        await callback.answer()
+        return
+    if not project['is_running']:
+        try:
+            cancelled = await process_control.cancel_start(project['id'])
+        except SupervisorError:
+            cancelled = False
+        if cancelled:
+            await append_project_log(project['id'], "Запуск отменён пользователем.")
+            text, keyboard = await get_project_menu(project_name, user_id)
+            await callback.message.edit_text(text, reply_markup=keyboard)
+            await callback.answer("✅ Запуск отменён")
+            return
+        await callback.message.answer("⚠️ Проект уже остановлен.")
+        await callback.answer()
+        return
+    try:
+        stopped = await process_control.stop(project['id'], "Процесс остановлен пользователем.")
+    except SupervisorError as e:
+        # Агент проекта отключён: бот там может работать дальше, меню покажет, что состояние неизвестно
+        logger.warning(f"⚠️ Не удалось остановить проект {project_name}: {e}")
+        text, keyboard = await get_project_menu(project_name, user_id)
+        await callback.message.edit_text(text, reply_markup=keyboard)
+        await callback.answer(f"⚠️ {e}, проект не остановлен", show_alert=True)
+        return
+    if not stopped:
+        # Процесса уже нет, а в базе проект числится запущенным
+        await update_project(project['id'], is_running=False, process_id=None)
+    text, keyboard = await get_project_menu(project_name, user_id)
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+# Хэндлер для "Логи"
 @dp.callback_query(lambda c: c.data.startswith("logs_"))
 async def show_logs(callback: CallbackQuery):
     project_name = callback.data.replace("logs_", "")
     user_id = callback.from_user.id
-    await update_user_activity(user_id)
     project = await get_project_by_name(user_id, project_name)
     if not project:
         await callback.message.answer("❌ Проект не найден.")
         await callback.answer()
         return
-    logs = project['logs'] or "Логи отсутствуют."
-    if len(logs) > 4000:
-        logs = logs[-4000:]
-        logs = "...\n" + logs
+    logs = await process_control.logs(project['id'], max_chars=4000) or "Логи отсутствуют."
     await callback.message.answer(f"📋 Логи проекта '{project_name}':\n\n```{logs}```")
     await callback.answer()
 
@@ -1560,30 +5118,19 @@ async def show_logs(callback: CallbackQuery):
 async def delete_project_handler(callback: CallbackQuery):
     project_name = callback.data.replace("delete_", "")
     user_id = callback.from_user.id
-    await update_user_activity(user_id)
     project = await get_project_by_name(user_id, project_name)
     if not project:
         await callback.message.answer("❌ Проект не найден.")
         await callback.answer()
         return
-    if project['is_running']:
-        global running_count
-        if project.get('process'):
-            try:
-                process_info = project['process']
-                if process_info and process_info['process'] and process_info['process'].poll() is None:
-                    if os.name == 'nt':
-                        process_info['process'].terminate()
-                    else:
-                        os.kill(process_info['process'].pid, signal.SIGTERM)
-                    process_info['process'].wait(timeout=5)
-            except Exception as e:
-                logger.error(f"Ошибка остановки процесса: {e}")
-            active_processes.pop(project['id'], None)
-            running_count = max(0, running_count - 1)
+    try:
+        await process_control.stop(project['id'], "Проект удаляется.")
+    except SupervisorError as e:
+        # Копию на отключённом агенте остановит и удалит _stop_orphans, когда агент переподключится
+        logger.warning(f"⚠️ Проект {project_name} удаляется без остановки: {e}")
     project_dir = get_project_path(user_id, project['safe_name'])
     if os.path.exists(project_dir):
-        shutil.rmtree(project_dir)
+        await asyncio.to_thread(shutil.rmtree, project_dir)
     await delete_project(project['id'])
     await callback.message.answer(f"🗑️ Проект '{project_name}' удалён.")
     keyboard = await get_main_menu(user_id)
@@ -1595,81 +5142,146 @@ async def delete_project_handler(callback: CallbackQuery):
     )
     await callback.answer()
 
+# Функция для восстановления одного проекта после перезапуска хоста
+async def restore_project(project_id, user_id, project_name, semaphore) -> str:
+    """Запускает проект и ждёт, переживёт ли он первые RESTORE_STARTUP_GRACE секунд. Возвращает итог"""
+    try:
+        queue_position = await scheduler.request_start(project_id, user_id, project_name, PRIORITY_RESTORE)
+        if queue_position:
+            return 'queued'
+        process_info = active_processes.get(project_id)
+        if not process_info:
+            return 'failed'
+        try:
+            await asyncio.wait_for(asyncio.shield(process_info['watcher']), timeout=RESTORE_STARTUP_GRACE)
+        except asyncio.TimeoutError:
+            return 'restored'
+        return 'failed'
+    except Exception as e:
+        logger.error(f"Ошибка восстановления проекта {project_name}: {e}")
+        return 'failed'
+    finally:
+        semaphore.release()
+
 # Функция для восстановления состояния запущенных проектов
 async def restore_running_projects():
-    global running_count
     logger.info("🔍 Восстанавливаем состояние запущенных проектов...")
+    started = asyncio.get_running_loop().time()
     
     # Загружаем состояние из файла
-    load_bot_state()
+    saved_processes = load_bot_state()
+    
+    # Отсоединённые боты, пережившие перезапуск, подхватываем, если PID всё ещё принадлежит тому же процессу
+    adopted = []
+    if DETACH_PROJECTS and os.name != 'nt':
+        for project_id, saved in saved_processes.items():
+            if await get_project_by_id(project_id) and await supervisor.adopt(project_id, saved):
+                adopted.append(f"{saved['project_name']} [{saved['user_id']}]")
     
-    async with aiosqlite.connect(DB_PATH) as db:
+    # Остальные процессы умерли вместе с ботом: разом помечаем их проекты остановленными
+    async with db_pool.acquire() as db:
         cursor = await db.execute(
-            'SELECT id, user_id, name, safe_name, file_path, process_id, logs, auto_restart FROM projects WHERE is_running = 1'
+            'SELECT id, user_id, name, file_path, auto_restart FROM projects WHERE is_running = 1 AND COALESCE(node, ?) = ? ORDER BY id',
+            (LOCAL_NODE, LOCAL_NODE)
         )
-        running_projects = await cursor.fetchall()
+        running_projects = [row for row in await cursor.fetchall() if row[0] not in active_processes]
+        await db.executemany(
+            'UPDATE projects SET is_running = 0, process_id = NULL WHERE id = ?',
+            [(row[0],) for row in running_projects]
+        )
+        await db.commit()
+    for project_id, *_ in running_projects:
+        project_registry.update(project_id, {'is_running': False, 'process_id': None})
     
-    restored_count = 0
-    for project_row in running_projects:
-        project_id, user_id, project_name, safe_name, file_path, process_id, logs, auto_restart = project_row
-        
+    to_restore, missing, disabled = {}, [], []
+    for project_id, user_id, project_name, file_path, auto_restart in running_projects:
         if not file_path or not os.path.exists(file_path):
             logger.warning(f"❌ Файл проекта {project_name} не найден, помечаем как остановленный")
-            await update_project(project_id, is_running=False, logs=f"{logs}\n[{datetime.now().strftime('%H:%M:%S')}] Файл не найден при восстановлении", process_id=None)
-            continue
-        
-        if running_count >= MAX_CONCURRENT_BOTS:
-            logger.warning(f"❌ Достигнут лимит ботов при восстановлении {project_name}")
-            await update_project(project_id, is_running=False, logs=f"{logs}\n[{datetime.now().strftime('%H:%M:%S')}] Не восстановлен - достигнут лимит ботов", process_id=None)
-            continue
-        
-        # Автоматически перезапускаем проекты с включенным авто-рестартом
-        if auto_restart:
-            logger.info(f"🔄 Авто-восстановление проекта: {project_name}")
-            await restart_project(project_id, user_id, project_name)
-            restored_count += 1
+            await append_project_log(project_id, "Файл не найден при восстановлении")
+            missing.append(f"{project_name} [{user_id}]")
+        elif auto_restart:
+            to_restore.setdefault(user_id, []).append((project_id, user_id, project_name))
         else:
             logger.info(f"❌ Проект {project_name} помечен как остановленный (авто-рестарт выключен)")
-            await update_project(project_id, is_running=False, logs=f"{logs}\n[{datetime.now().strftime('%H:%M:%S')}] Процесс остановлен при перезапуске бота", process_id=None)
+            await append_project_log(project_id, "Процесс остановлен при перезапуске бота")
+            disabled.append(f"{project_name} [{user_id}]")
     
-    logger.info(f"✅ Восстановлено проектов: {restored_count}")
+    # По кругу между пользователями: сначала у каждого поднимается первый проект, потом второй и т.д.
+    order = [entry for group in itertools.zip_longest(*to_restore.values()) for entry in group if entry]
+    
+    # Ограниченное число одновременных запусков с паузой между ними, чтобы не запускать всех разом
+    semaphore = asyncio.Semaphore(RESTORE_CONCURRENCY)
+    tasks = []
+    for project_id, user_id, project_name in order:
+        await semaphore.acquire()
+        logger.info(f"🔄 Авто-восстановление проекта: {project_name}")
+        tasks.append(asyncio.create_task(restore_project(project_id, user_id, project_name, semaphore)))
+        await asyncio.sleep(RESTORE_STAGGER)
+    results = await asyncio.gather(*tasks)
+    
+    outcome = {'adopted': adopted, 'restored': [], 'queued': [], 'failed': []}
+    for (_, user_id, project_name), result in zip(order, results):
+        outcome[result].append(f"{project_name} [{user_id}]")
+    elapsed = asyncio.get_running_loop().time() - started
+    logger.info(
+        f"✅ Подхвачено проектов: {len(adopted)}, восстановлено: {len(outcome['restored'])}, в очереди: {len(outcome['queued'])}, "
+        f"с ошибкой: {len(outcome['failed'])} за {elapsed:.1f} с"
+    )
+    if running_projects or adopted:
+        await notify_admins_restore_summary(outcome, missing, disabled, elapsed)
+
+# Функция для отправки админам итогов восстановления проектов
+async def notify_admins_restore_summary(outcome, missing, disabled, elapsed):
+    lines = [f"♻️ Восстановление проектов после перезапуска ({elapsed:.1f} с), в скобках ID владельца:\n"]
+    for title, names in (
+        ("🔗 Подхвачено работающими", outcome['adopted']),
+        ("✅ Восстановлено", outcome['restored']),
+        ("⏳ Ждут ресурсов в очереди", outcome['queued']),
+        ("❌ Упали при запуске", outcome['failed']),
+        ("📄 Файл не найден", missing),
+        ("⏸️ Авто-рестарт выключен", disabled),
+    ):
+        if names:
+            lines.append(f"{title}: {len(names)} — {', '.join(names)}")
+    text = fit_message("\n".join(lines))
+    for admin_id in ADMIN_IDS:
+        try:
+            await bot.send_message(admin_id, text)
+        except Exception as e:
+            logger.error(f"Не удалось отправить итоги восстановления админу {admin_id}: {e}")
 
 # Функция для периодической очистки неактивных пользователей
 async def cleanup_inactive_users():
     while True:
         try:
+            await activity_tracker.flush()
             cutoff_date = datetime.now().timestamp() - (30 * 24 * 60 * 60)
-            async with aiosqlite.connect(DB_PATH) as db:
+            async with db_pool.acquire() as db:
                 cursor = await db.execute(
                     'SELECT user_id FROM users WHERE last_active < ?',
                     (datetime.fromtimestamp(cutoff_date),)
                 )
                 inactive_users = await cursor.fetchall()
-                for user_row in inactive_users:
-                    user_id = user_row[0]
-                    projects = await get_user_projects(user_id)
+            if inactive_users:
+                user_projects = {user_row[0]: await get_user_projects(user_row[0]) for user_row in inactive_users}
+                # Останавливаем все процессы неактивных пользователей разом, а не по очереди
+                await process_control.stop_many(
+                    [project['id'] for projects in user_projects.values() for project in projects if project['is_running']],
+                    "Процесс остановлен: пользователь неактивен."
+                )
+                for user_id, projects in user_projects.items():
                     for project in projects:
-                        if project['is_running'] and project.get('process'):
-                            try:
-                                process_info = project['process']
-                                if process_info and process_info['process'] and process_info['process'].poll() is None:
-                                    if os.name == 'nt':
-                                        process_info['process'].terminate()
-                                    else:
-                                        os.kill(process_info['process'].pid, signal.SIGTERM)
-                                    process_info['process'].wait(timeout=5)
-                            except Exception as e:
-                                logger.error(f"Ошибка остановки процесса для пользователя {user_id}: {e}")
-                            active_processes.pop(project['id'], None)
-                            global running_count
-                            running_count = max(0, running_count - 1)
+                        await process_control.forget(project['id'])
+                        log_writer.discard(project['id'])
                         project_dir = get_project_path(user_id, project['safe_name'])
                         if os.path.exists(project_dir):
-                            shutil.rmtree(project_dir)
-                    await db.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
-                    await db.execute('DELETE FROM projects WHERE user_id = ?', (user_id,))
+                            await asyncio.to_thread(shutil.rmtree, project_dir)
+                    async with db_pool.acquire() as db:
+                        await db.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+                        await db.execute('DELETE FROM projects WHERE user_id = ?', (user_id,))
+                        await db.commit()
+                    project_registry.remove_user(user_id)
                     logger.info(f"🗑️ Удалён неактивный пользователь: {user_id}")
-                await db.commit()
                 
                 # Сохраняем состояние после очистки
                 save_bot_state()
@@ -1680,49 +5292,112 @@ async def cleanup_inactive_users():
 
 # Функция для graceful shutdown
 async def on_shutdown():
-    global running_count
     logger.info("🔌 Выполняем graceful shutdown...")
     
+    if process_control.remote:
+        # Процессами проектов владеет супервизор, фронтенду остаётся сохранить активность пользователей
+        await activity_tracker.close()
+        return
+    
+    # Останавливаем очередь запуска, чтобы завершающиеся процессы не освобождали слоты под новые
+    scheduler.close()
+    restart_policy.close()
+    
     # Сохраняем состояние перед завершением
     save_bot_state()
     
-    for project_id, process_info in list(active_processes.items()):
-        try:
-            if process_info and process_info['process'] and process_info['process'].poll() is None:
-                if os.name == 'nt':
-                    process_info['process'].terminate()
-                else:
-                    os.kill(process_info['process'].pid, signal.SIGTERM)
-                try:
-                    await asyncio.wait_for(process_info['process'].wait(), timeout=5)
-                except asyncio.TimeoutError:
-                    process_info['process'].kill()
-                    await process_info['process'].wait()
-                await update_project(project_id, is_running=False, process_id=None)
-                logger.info(f"Остановлен процесс для проекта {project_id}")
-        except Exception as e:
-            logger.error(f"Ошибка остановки процесса {process_info['process'].pid if process_info and process_info['process'] else 'N/A'}: {e}")
+    # Записываем накопленную активность пользователей
+    await activity_tracker.close()
+    await process_sampler.close()
+    await watchdog.close()
+    
+    if DETACH_PROJECTS and os.name != 'nt':
+        # Отсоединённые боты продолжают работать: следующий запуск хоста подхватит их по файлу состояния
+        await supervisor.detach_all()
+        save_bot_state()
+        logger.info(f"✅ Процессы проектов оставлены работать: {len(active_processes)}")
+        active_processes.clear()
+        forkserver.close()
+        return
+    
+    # Все процессы останавливаются параллельно, так что завершение занимает не больше одного периода ожидания
+    await supervisor.stop_many(list(active_processes), "Процесс остановлен при завершении работы хоста.")
+    logger.info("✅ Процессы проектов остановлены")
     
-    running_count = 0
     active_processes.clear()
+    forkserver.close()
     
     # Очищаем файл состояния при корректном завершении
     cleanup_state_file()
 
 # Основная функция
-async def main():
+async def main(mode: str = 'embedded', agent_args: tuple = ()):
+    """embedded — фронтенд и процессы в одном процессе, supervisor — только процессы, frontend — только бот,
+    agent — рабочий агент, который выполняет проекты по запросам управляющего хоста (agent_args: хост, порт, имя)"""
+    global process_control
+    server = None
+    cluster = None
     try:
         # Создаем необходимые директории в первую очередь
         create_necessary_directories()
         
         # Инициализируем базу данных
-        await check_and_create_tables()
+        await ensure_db_ready()
+        
+        # Открываем пул соединений с базой данных
+        await db_pool.open()
+        
+        # Прогреваем кэш проектов; в раздельном режиме проекты меняет и второй процесс
+        project_registry.shared = mode in ('supervisor', 'frontend')
+        await project_registry.load()
+        
+        # Запускаем фоновую запись логов проектов
+        log_writer.start()
+        
+        if mode == 'frontend':
+            process_control = SupervisorClient(SUPERVISOR_SOCKET)
+        else:
+            if mode == 'agent':
+                check_cluster_token()
+                process_control = AgentControl()
+            elif CLUSTER_LISTEN:
+                cluster = process_control = ClusterControl(process_control)
+                await cluster.start_server(*CLUSTER_LISTEN)
+            process_sampler.start()
+            watchdog.start()
+            
+            # Готовим cgroup для лимитов ресурсов проектов
+            resource_limiter.setup()
+
+            if PROJECT_VENVS and PROJECT_VENV_USE_UV and not shutil.which('uv'):
+                logger.warning("⚠️ uv не найден: зависимости проектов ставятся через pip, это медленнее и без общих жёстких ссылок")
+
+            # Прогреваем интерпретатор для быстрого запуска проектов форком
+            if FORKSERVER_ENABLED and DETACH_PROJECTS and os.name != 'nt':
+                forkserver.start()
+            
+            # Восстанавливаем запущенные проекты в фоне, чтобы бот сразу начал отвечать пользователям
+            asyncio.create_task(restore_running_projects())
         
-        # Восстанавливаем запущенные проекты
-        await restore_running_projects()
+        if mode in ('supervisor', 'agent'):
+            if mode == 'supervisor':
+                server = SupervisorServer(process_control, SUPERVISOR_SOCKET)
+                await server.start()
+            else:
+                asyncio.create_task(WorkerAgent(process_control, *agent_args).run())
+            stop_event = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, stop_event.set)
+            logger.info("🛡️ Супервизор процессов запущен" if mode == 'supervisor' else "🛠️ Рабочий агент запущен")
+            await stop_event.wait()
+            return
         
-        # Запускаем фоновые задачи
+        # Запускаем учёт активности пользователей и фоновые задачи
+        activity_tracker.start()
         asyncio.create_task(cleanup_inactive_users())
+        if DB_FULL_CHECK_INTERVAL:
+            asyncio.create_task(periodic_integrity_check())
         
         logger.info("🤖 Бот запущен! (без Docker)")
         logger.info("💾 Система сохранения состояния активна")
@@ -1739,12 +5414,39 @@ async def main():
         except:
             pass
     finally:
+        if server:
+            await server.close()
+        if cluster:
+            await cluster.close()
         await on_shutdown()
+        await log_writer.close()
+        await db_pool.close()
         await bot.session.close()
 
+# Функция для просмотра журнала проекта в реальном времени: python youhost.py logs <id проекта>
+async def stream_project_logs(project_id: int):
+    async for line in SupervisorClient(SUPERVISOR_SOCKET).stream(project_id):
+        print(line, flush=True)
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ['logs'] and len(sys.argv) == 3:
+        try:
+            asyncio.run(stream_project_logs(int(sys.argv[2])))
+        except KeyboardInterrupt:
+            pass
+        sys.exit()
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'embedded'
+    agent_args = ()
+    if mode == 'agent' and len(sys.argv) in (3, 4) and ':' in sys.argv[2]:
+        host, _, port = sys.argv[2].rpartition(':')
+        agent_args = (host, int(port), sys.argv[3] if len(sys.argv) == 4 else socket.gethostname())
+    elif mode not in ('embedded', 'supervisor', 'frontend'):
+        sys.exit(
+            "Использование: python youhost.py [embedded|supervisor|frontend], "
+            "python youhost.py agent <хост>:<порт> [имя] или python youhost.py logs <id проекта>"
+        )
     try:
-        asyncio.run(main())
+        asyncio.run(main(mode, agent_args))
     except KeyboardInterrupt:
         logger.info("Бот остановлен пользователем")
         # Сохраняем состояние при принудительной остановке